@@ -0,0 +1,158 @@
+"""ログインとセッショントークン
+
+- password.txt は一度だけ読み込み、ファイルの更新 (mtime / サイズ) を検知したときだけ読み直す
+- ログイン成功時に HMAC-SHA256 で署名したトークンを発行する。検証はメモリ上の鍵との比較だけ (ディスク I/O なし)
+- パスワードが変更されると (次のログイン時に検知)、署名鍵も変わるので発行済みのトークンは無効になる
+- 送信元ごとにログイン失敗を数え、一定回数を超えると待ち時間を指数的に伸ばす
+
+WebSocket はハンドシェイク時に 1 回だけ検証するので、操作メッセージごとの認証コストはない。
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import time
+
+log = logging.getLogger("auth")
+
+DEFAULT_PASSWORD = "password"
+TOKEN_TTL = 12 * 3600
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class Credential:
+    """password.txt の内容を保持し、ファイルが変わったら読み直す"""
+
+    def __init__(self, path, default=DEFAULT_PASSWORD, check_interval=1.0):
+        self.path = path
+        self.default = default
+        self.check_interval = check_interval
+        self._stamp = None
+        self._checked_at = 0.0
+        self._digest = None
+        self.reload_if_changed(force=True)
+
+    def reload_if_changed(self, force=False):
+        """変更があれば読み直して True を返す。stat は check_interval 秒に 1 回まで"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._stamp and self._digest is not None:
+            return False
+        self._stamp = stamp
+        if stamp is None:
+            password = self.default
+        else:
+            with open(self.path, "r") as f:
+                password = f.read().strip()
+        self._digest = hashlib.sha256(password.encode()).digest()
+        log.info("Credential loaded from %s", self.path if stamp else "default")
+        return True
+
+    @property
+    def digest(self):
+        return self._digest
+
+    def verify(self, password):
+        # 長さに依存しないよう、ハッシュ同士を定数時間で比較する
+        candidate = hashlib.sha256(password.encode()).digest()
+        return hmac.compare_digest(candidate, self._digest)
+
+
+class LoginThrottle:
+    """送信元ごとのログイン失敗回数を数え、free_attempts を超えたら待ち時間を 2 倍ずつ伸ばす"""
+
+    def __init__(self, free_attempts=5, base_delay=1.0, max_delay=300.0, forget_after=3600.0):
+        self.free_attempts = free_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.forget_after = forget_after
+        self._clients = {}   # client -> [失敗回数, 次に試行できる時刻, 最終失敗時刻]
+
+    def retry_after(self, client):
+        """まだ待つ必要があれば残り秒数、なければ 0"""
+        entry = self._clients.get(client)
+        if entry is None:
+            return 0.0
+        return max(0.0, entry[1] - time.monotonic())
+
+    def failure(self, client):
+        now = time.monotonic()
+        entry = self._clients.setdefault(client, [0, 0.0, now])
+        entry[0] += 1
+        entry[2] = now
+        if entry[0] > self.free_attempts:
+            delay = min(self.max_delay, self.base_delay * 2 ** (entry[0] - self.free_attempts - 1))
+            entry[1] = now + delay
+            log.warning("Login failed %d times", entry[0], extra={"client_addr": client, "retry_after": delay})
+        if len(self._clients) > 10000:
+            self._clients = {c: e for c, e in self._clients.items() if now - e[2] < self.forget_after}
+
+    def success(self, client):
+        self._clients.pop(client, None)
+
+
+class SessionAuth:
+    def __init__(self, password_path, ttl=TOKEN_TTL, secret=None):
+        self.credential = Credential(password_path)
+        self.ttl = ttl
+        # 再起動で発行済みトークンを無効にしたくない場合は AUTH_SECRET を設定する
+        secret = secret or os.environ.get("AUTH_SECRET")
+        self._secret = secret.encode() if secret else secrets.token_bytes(32)
+        self._key = None
+        self._update_key()
+        self.throttle = LoginThrottle()
+
+    def _update_key(self):
+        # パスワードを鍵に含め、変更されたら古いトークンが通らないようにする
+        self._key = hmac.new(self._secret, self.credential.digest, hashlib.sha256).digest()
+
+    def _sign(self, payload):
+        return hmac.new(self._key, payload, hashlib.sha256).digest()
+
+    def login(self, password, client):
+        """(token | None, retry_after) を返す。retry_after > 0 なら試行自体を拒否した"""
+        wait = self.throttle.retry_after(client)
+        if wait > 0:
+            return None, wait
+        if self.credential.reload_if_changed():
+            self._update_key()
+        if not self.credential.verify(password):
+            self.throttle.failure(client)
+            return None, 0.0
+        self.throttle.success(client)
+        return self.issue(), 0.0
+
+    def issue(self):
+        payload = f"{int(time.time()) + self.ttl}.{secrets.token_hex(8)}".encode()
+        return _b64encode(payload) + "." + _b64encode(self._sign(payload))
+
+    def verify(self, token):
+        """トークンが有効なら True。ファイルや外部には一切アクセスしない"""
+        if not token:
+            return False
+        try:
+            payload_text, signature_text = token.split(".", 1)
+            payload = _b64decode(payload_text)
+            signature = _b64decode(signature_text)
+            expires = int(payload.split(b".", 1)[0])
+        except (ValueError, TypeError):
+            return False
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return False
+        return expires > time.time()
@@ -0,0 +1,183 @@
+"""バックエンドの起動時間ベンチマーク (コンテナ / start_dev.sh の再起動でリンクが戻るまでの時間)
+
+バックエンド (uvicorn main:app) を新しいプロセスで起動し、プロセス起動からの時間 (ms) を計る:
+
+- health:    /api/health が初めて 200 を返すまで
+- heartbeat: /ws に接続したクライアントへ最初の HEARTBEAT が転送されるまで
+
+機体は sim_vehicle.py を先に起動しておく (再起動中も機体は動いている想定)。--no-vehicle なら外部の
+SITL / 実機を使う。結果は --history の JSON Lines に追記するので、変更ごとの推移を追える。
+
+    python bench_startup.py --runs 5
+    python bench_startup.py --importtime     # import の内訳 (上位) も表示する
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def wait_health(port, started, deadline):
+    """/api/health が 200 を返した時刻 (ms) を返す"""
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1.0)
+            conn.request("GET", "/api/health")
+            if conn.getresponse().status == 200:
+                return (time.monotonic() - started) * 1000
+        except (ConnectionError, socket.timeout, http.client.HTTPException):
+            pass
+        time.sleep(0.005)
+    raise TimeoutError("/api/health did not respond")
+
+
+def login(port, password):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5.0)
+    conn.request("POST", "/api/login", json.dumps({"password": password}), {"Content-Type": "application/json"})
+    body = json.loads(conn.getresponse().read())
+    if body.get("status") != "ok":
+        raise RuntimeError(f"login failed: {body}")
+    return body["token"]
+
+
+def wait_heartbeat(port, token, started, deadline):
+    """/ws で最初の HEARTBEAT を受け取った時刻 (ms) を返す"""
+    from websockets.sync.client import connect
+
+    with connect(f"ws://127.0.0.1:{port}/ws?token={token}", open_timeout=5.0) as ws:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("no HEARTBEAT forwarded")
+            msg = json.loads(ws.recv(timeout=remaining))
+            if msg.get("type") == "HEARTBEAT":
+                return (time.monotonic() - started) * 1000
+
+
+def run_once(args, password):
+    env = dict(os.environ, LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"))
+    started = time.monotonic()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                             "--port", str(args.port)], cwd=BASE_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    try:
+        deadline = started + args.timeout
+        health = wait_health(args.port, started, deadline)
+        heartbeat = None
+        if not args.health_only:
+            heartbeat = wait_heartbeat(args.port, login(args.port, password), started, deadline)
+        return health, heartbeat
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def import_breakdown(top):
+    """python -X importtime で main の import 時間 (累積) の上位を返す"""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=BASE_DIR,
+                         capture_output=True, text=True, env=dict(os.environ, LOG_LEVEL="WARNING")).stderr
+    rows = []
+    for line in out.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative) / 1000, name.rstrip()))
+    total = next((ms for ms, name in rows if name.strip() == "main"), None)
+    # 直接 import しているもの (インデントの浅いもの) だけ
+    direct = sorted(((ms, name.strip()) for ms, name in rows if name.startswith("   ") and not name.startswith("    ")),
+                    reverse=True)
+    return total, direct[:top]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {"min": round(min(values), 1), "median": round(statistics.median(values), 1), "max": round(max(values), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure backend cold start: process start -> /api/health -> "
+                                                 "first HEARTBEAT on /ws")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765, help="port for the backend under test")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds per run")
+    parser.add_argument("--password", default=None, help="login password (default: password.txt or 'password')")
+    parser.add_argument("--no-vehicle", action="store_true", help="don't start sim_vehicle.py (use a running SITL)")
+    parser.add_argument("--health-only", action="store_true", help="only measure /api/health")
+    parser.add_argument("--importtime", action="store_true", help="also show the slowest imports of main.py")
+    parser.add_argument("--history", default=os.path.join(BASE_DIR, "logs", "bench_startup.jsonl"),
+                        help="JSON Lines file the results are appended to ('' to disable)")
+    parser.add_argument("--verbose", action="store_true", help="show the backend's log output")
+    args = parser.parse_args()
+
+    password = args.password
+    if password is None:
+        try:
+            with open(os.path.join(BASE_DIR, "password.txt"), "r") as f:
+                password = f.read().strip()
+        except FileNotFoundError:
+            password = "password"
+
+    vehicle = None
+    if not args.no_vehicle and not args.health_only:
+        vehicle = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "sim_vehicle.py")], cwd=BASE_DIR,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(1.0)
+
+    health, heartbeat = [], []
+    try:
+        for i in range(args.runs):
+            h, hb = run_once(args, password)
+            health.append(h)
+            heartbeat.append(hb)
+            print(f"run {i + 1}: health {h:7.1f} ms" + (f"   heartbeat {hb:7.1f} ms" if hb is not None else ""))
+    finally:
+        if vehicle is not None:
+            vehicle.terminate()
+            vehicle.wait()
+
+    result = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "runs": args.runs,
+        "health_ms": summarize(health),
+        "heartbeat_ms": summarize(heartbeat),
+    }
+    if args.importtime:
+        total, direct = import_breakdown(10)
+        result["import_ms"] = round(total, 1) if total is not None else None
+        print(f"import main: {total:.1f} ms")
+        for ms, name in direct:
+            print(f"  {ms:7.1f} ms  {name}")
+    print(json.dumps(result))
+
+    if args.history:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""ジオフェンス (敷地境界 / 立入禁止区域) の判定
+
+- ゾーンはポリゴン (緯度経度) で、inclusion (この中にいること) と exclusion (入ってはいけない) の2種類
+- 判定は geofence_index.GeofenceIndex (基準点まわりの平面に投影した一様グリッド索引) で行う
+- GLOBAL_POSITION_INT ごとに現在位置を、/api/command/goto ごとに目標を判定し、
+  違反時は目標を拒否 (block) または最寄りの許可位置へ寄せる (clamp)。位置の違反は通知する
+"""
+import json
+import logging
+import math
+import os
+import time
+
+ZONE_TYPES = ("inclusion", "exclusion")
+GOTO_ACTIONS = ("block", "clamp")
+
+log = logging.getLogger("geofence")
+
+
+class GeofenceError(ValueError):
+    pass
+
+
+def _coordinate(value, limit):
+    """有限の数値で ±limit に収まれば float、そうでなければ None"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    value = float(value)
+    return value if math.isfinite(value) and -limit <= value <= limit else None
+
+
+class Zone:
+    def __init__(self, name, zone_type, polygon):
+        if zone_type not in ZONE_TYPES:
+            raise GeofenceError(f"zone '{name}': type must be one of {ZONE_TYPES}")
+        if not isinstance(polygon, (list, tuple)) or len(polygon) < 3:
+            raise GeofenceError(f"zone '{name}': polygon needs at least 3 points")
+        self.name = name
+        self.type = zone_type
+        self.polygon = []
+        for i, point in enumerate(polygon):
+            if not isinstance(point, (list, tuple)) or len(point) != 2:
+                raise GeofenceError(f"zone '{name}': point {i} must be [lat, lon]")
+            lat, lon = _coordinate(point[0], 90.0), _coordinate(point[1], 180.0)
+            if lat is None or lon is None:
+                raise GeofenceError(f"zone '{name}': point {i} {point!r} is not a valid lat/lon")
+            self.polygon.append([lat, lon])
+
+    def to_dict(self):
+        return {"name": self.name, "type": self.type, "polygon": self.polygon}
+
+
+class GeofenceManager:
+    def __init__(self, path, notify=None):
+        self.path = path
+        self.notify = notify or (lambda event: None)
+        self.mav = None
+        self.zones = []
+        self.goto_action = "block"
+        self.clamp_margin = 1.0   # clamp 時に境界から内側へ寄せる距離 (m)
+        self.breach_mode = None   # 位置が違反したときに切り替えるモード (例: "HOLD")。None なら通知のみ
+        self.index = None
+        self.violations = []      # 現在位置の違反 (ゾーン名)
+        self.last_check_us = None
+        self.load()
+
+    def attach(self, mav):
+        self.mav = mav
+
+    # --- 設定 ---
+
+    def configure(self, zones, goto_action=None, breach_mode=None, clamp_margin=None):
+        """設定を置き換える。すべて検証して索引まで作ってから差し替えるので、不正なら何も変わらない"""
+        if not isinstance(zones, list) or not all(isinstance(z, dict) for z in zones):
+            raise GeofenceError("zones must be a list of objects")
+        zones = [Zone(z.get("name") or f"zone{i}", z.get("type", "exclusion"), z.get("polygon", []))
+                 for i, z in enumerate(zones)]
+        if goto_action is not None and goto_action not in GOTO_ACTIONS:
+            raise GeofenceError(f"goto_action must be one of {GOTO_ACTIONS}")
+        if clamp_margin is not None:
+            clamp_margin = _coordinate(clamp_margin, math.inf)
+            if clamp_margin is None or clamp_margin < 0:
+                raise GeofenceError("clamp_margin must be a non-negative number")
+        index = None
+        if zones:
+            # 索引は numpy を使うので、ゾーンがあるときだけ読み込む (起動を速くするため)
+            from geofence_index import GeofenceIndex
+            index = GeofenceIndex(zones)
+
+        if goto_action is not None:
+            self.goto_action = goto_action
+        if clamp_margin is not None:
+            self.clamp_margin = clamp_margin
+        self.breach_mode = breach_mode or None
+        self.zones = zones
+        self.index = index
+        self.violations = []
+
+    def to_dict(self):
+        return {"zones": [z.to_dict() for z in self.zones], "goto_action": self.goto_action,
+                "breach_mode": self.breach_mode, "clamp_margin": self.clamp_margin}
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            log.warning("Failed to load %s: %s", self.path, e)
+            return
+        try:
+            self.configure(data.get("zones", []), data.get("goto_action"), data.get("breach_mode"),
+                           data.get("clamp_margin"))
+        except GeofenceError as e:
+            log.warning("Ignoring invalid geofence in %s: %s", self.path, e)
+            return
+        log.info("Loaded %d zones from %s", len(self.zones), self.path)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    # --- 判定 ---
+
+    def _violating(self, lat, lon):
+        """違反しているゾーンの index (inclusion のどれにも入っていない / exclusion の中)"""
+        inside = set(self.index.containing(lat, lon))
+        violations = []
+        inclusion = [z for z, zone in enumerate(self.zones) if zone.type == "inclusion"]
+        if inclusion and not inside.intersection(inclusion):
+            violations.extend(inclusion)
+        violations.extend(z for z in sorted(inside) if self.zones[z].type == "exclusion")
+        return violations
+
+    def check(self, lat, lon):
+        """違反しているゾーン名のリスト"""
+        if self.index is None:
+            return []
+        started = time.perf_counter()
+        violations = [self.zones[z].name for z in self._violating(lat, lon)]
+        self.last_check_us = (time.perf_counter() - started) * 1e6
+        return violations
+
+    def check_many(self, lats, lons):
+        """点群の違反フラグ (bool 配列)。ミッションの事前チェックなどに使う"""
+        if self.index is None:
+            return [False] * len(lats)
+        import numpy as np
+        inside = self.index.containing_many(lats, lons)
+        types = np.array([z.type for z in self.zones])
+        bad = inside[types == "exclusion"].any(axis=0)
+        if (types == "inclusion").any():
+            bad |= ~inside[types == "inclusion"].any(axis=0)
+        return bad
+
+    def filter_target(self, lat, lon):
+        """goto 目標を判定する。(許可するか, 緯度, 経度, 違反ゾーン, clamp したか) を返す"""
+        if self.index is None:
+            return True, lat, lon, [], False
+        started = time.perf_counter()
+        violating = self._violating(lat, lon)
+        self.last_check_us = (time.perf_counter() - started) * 1e6
+        violations = [self.zones[z].name for z in violating]
+        if not violating:
+            return True, lat, lon, [], False
+        if self.goto_action != "clamp":
+            return False, lat, lon, violations, False
+
+        # 違反ゾーンの境界上の最寄り点から、さらに clamp_margin だけ同じ向きへ寄せる
+        # (inclusion の外なら内側へ、exclusion の中なら外側へ向かう)。
+        # inclusion は全部の外にいるときに違反なので、一番近い inclusion だけに寄せればよい
+        px, py = (float(v) for v in self.index.project(lat, lon))
+        targets = [z for z in violating if self.zones[z].type == "exclusion"]
+        inclusion = [z for z in violating if self.zones[z].type == "inclusion"]
+        if inclusion:
+            targets.insert(0, min(inclusion, key=lambda z: self.index.nearest_boundary(z, px, py)[2]))
+        for z in targets:
+            cx, cy, dist = self.index.nearest_boundary(z, px, py)
+            dist = dist or 1.0
+            px = cx + (cx - px) / dist * self.clamp_margin
+            py = cy + (cy - py) / dist * self.clamp_margin
+        new_lat, new_lon = (float(v) for v in self.index.unproject(px, py))
+        if self._violating(new_lat, new_lon):
+            return False, lat, lon, violations, False
+        return True, new_lat, new_lon, violations, True
+
+    # --- MAVLink 受信 ---
+
+    def handle_message(self, msg):
+        if self.index is None or msg.get_type() != "GLOBAL_POSITION_INT":
+            return
+        if msg.lat == 0 and msg.lon == 0:
+            return
+        lat, lon = msg.lat / 1e7, msg.lon / 1e7
+        violations = self.check(lat, lon)
+        if violations == self.violations:
+            return
+
+        # 状態が変わったときだけ通知する
+        self.violations = violations
+        if violations:
+            log.warning("BREACH at %.7f,%.7f: %s", lat, lon, violations)
+            if self.breach_mode and self.mav is not None:
+                mode_id = self.mav.mode_mapping().get(self.breach_mode)
+                if mode_id is not None:
+                    self.mav.set_mode(mode_id)
+                    log.warning("Mode set to %s", self.breach_mode)
+        else:
+            log.info("Breach cleared")
+        self.notify({"type": "GEOFENCE_ALERT",
+                     "data": {"breached": bool(violations), "zones": violations, "lat": lat, "lon": lon}})
@@ -0,0 +1,144 @@
+"""ジオフェンスの空間索引 (numpy)
+
+基準点まわりの平面 (m) に投影し、一様グリッドで索引する。境界辺がかからないセルは内外が
+事前計算済みなので O(1)、境界セルだけそのセル行にかかる辺に対してベクトル化したレイキャストを行う。
+numpy の import が重いので、geofence.GeofenceManager はゾーンが設定されたときだけこのモジュールを読み込む。
+"""
+import math
+
+import numpy as np
+
+EARTH_RADIUS = 6378137.0
+
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+
+class GeofenceIndex:
+    """ゾーン群の空間索引 (構築後は読み取り専用)"""
+
+    def __init__(self, zones, max_cells=128):
+        self.zones = zones
+        points = np.array([p for z in zones for p in z.polygon], dtype=np.float64)
+        self.lat0, self.lon0 = points.mean(axis=0)
+        self._m_per_deg_lat = math.radians(1) * EARTH_RADIUS
+        self._m_per_deg_lon = self._m_per_deg_lat * math.cos(math.radians(self.lat0))
+
+        # ゾーンごとの辺 (x1, y1, x2, y2)
+        self._edges = []
+        for zone in zones:
+            lat = np.array([p[0] for p in zone.polygon])
+            lon = np.array([p[1] for p in zone.polygon])
+            x, y = self.project(lat, lon)
+            edges = np.column_stack((x, y, np.roll(x, -1), np.roll(y, -1)))
+            self._edges.append(edges)
+
+        all_edges = np.vstack(self._edges)
+        x_min = min(all_edges[:, 0].min(), all_edges[:, 2].min())
+        y_min = min(all_edges[:, 1].min(), all_edges[:, 3].min())
+        x_max = max(all_edges[:, 0].max(), all_edges[:, 2].max())
+        y_max = max(all_edges[:, 1].max(), all_edges[:, 3].max())
+        self.cell = max(1.0, max(x_max - x_min, y_max - y_min) / max_cells)
+        self.x0 = x_min - self.cell
+        self.y0 = y_min - self.cell
+        self.nx = int((x_max - self.x0) / self.cell) + 2
+        self.ny = int((y_max - self.y0) / self.cell) + 2
+
+        # セル状態 (ゾーン, 行, 列) と、行ごとにかかる辺
+        self._state = np.empty((len(zones), self.ny, self.nx), np.int8)
+        self._row_edges = []
+        cx = self.x0 + (np.arange(self.nx) + 0.5) * self.cell
+        cy = self.y0 + (np.arange(self.ny) + 0.5) * self.cell
+        gx, gy = np.meshgrid(cx, cy)
+        for z, edges in enumerate(self._edges):
+            inside = self._contains_many(edges, gx.ravel(), gy.ravel()).reshape(self.ny, self.nx)
+            state = np.where(inside, INSIDE, OUTSIDE).astype(np.int8)
+
+            # 辺の外接矩形がかかるセルは境界 (保守的)
+            ex0 = np.minimum(edges[:, 0], edges[:, 2])
+            ex1 = np.maximum(edges[:, 0], edges[:, 2])
+            ey0 = np.minimum(edges[:, 1], edges[:, 3])
+            ey1 = np.maximum(edges[:, 1], edges[:, 3])
+            ix0, ix1 = self._col(ex0), self._col(ex1)
+            iy0, iy1 = self._row(ey0), self._row(ey1)
+            for a, b, c, d in zip(ix0, ix1, iy0, iy1):
+                state[c:d + 1, a:b + 1] = BOUNDARY
+            self._state[z] = state
+
+            rows = []
+            for iy in range(self.ny):
+                mask = (iy0 <= iy) & (iy1 >= iy)
+                rows.append(self._ray_table(edges[mask]))
+            self._row_edges.append(rows)
+
+    # --- 座標 ---
+
+    def project(self, lat, lon):
+        return ((np.asarray(lon) - self.lon0) * self._m_per_deg_lon,
+                (np.asarray(lat) - self.lat0) * self._m_per_deg_lat)
+
+    def unproject(self, x, y):
+        return self.lat0 + y / self._m_per_deg_lat, self.lon0 + x / self._m_per_deg_lon
+
+    def _col(self, x):
+        return np.clip(((x - self.x0) // self.cell).astype(np.intp), 0, self.nx - 1)
+
+    def _row(self, y):
+        return np.clip(((y - self.y0) // self.cell).astype(np.intp), 0, self.ny - 1)
+
+    # --- 内外判定 ---
+
+    @staticmethod
+    def _ray_table(edges):
+        """レイキャスト用に (y1, y2, x1, dx/dy) を並べておく"""
+        dy = edges[:, 3] - edges[:, 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = np.where(dy != 0, (edges[:, 2] - edges[:, 0]) / dy, 0.0)
+        return np.column_stack((edges[:, 1], edges[:, 3], edges[:, 0], slope))
+
+    @staticmethod
+    def _contains_many(edges, px, py, chunk=4096):
+        """点群 (px, py) がポリゴン内か (+x 方向のレイと辺の交差数の偶奇)"""
+        table = GeofenceIndex._ray_table(edges)
+        y1, y2, x1, slope = (table[:, i][None, :] for i in range(4))
+        result = np.empty(len(px), bool)
+        for start in range(0, len(px), chunk):
+            x = px[start:start + chunk, None]
+            y = py[start:start + chunk, None]
+            crosses = ((y1 > y) != (y2 > y)) & (x < x1 + (y - y1) * slope)
+            result[start:start + chunk] = np.count_nonzero(crosses, axis=1) & 1
+        return result
+
+    def _zone_contains(self, z, x, y, ix, iy):
+        state = self._state[z, iy, ix]
+        if state != BOUNDARY:
+            return state == INSIDE
+        y1, y2, x1, slope = self._row_edges[z][iy].T
+        crosses = ((y1 > y) != (y2 > y)) & (x < x1 + (y - y1) * slope)
+        return bool(np.count_nonzero(crosses) & 1)
+
+    def containing(self, lat, lon):
+        """点を含むゾーンの index リスト"""
+        x, y = self.project(lat, lon)
+        ix = int((x - self.x0) // self.cell)
+        iy = int((y - self.y0) // self.cell)
+        if not (0 <= ix < self.nx and 0 <= iy < self.ny):
+            return []
+        return [z for z in range(len(self.zones)) if self._zone_contains(z, x, y, ix, iy)]
+
+    def containing_many(self, lat, lon):
+        """点群版: (ゾーン数, 点数) の bool 配列"""
+        x, y = self.project(np.asarray(lat, np.float64), np.asarray(lon, np.float64))
+        return np.array([self._contains_many(edges, x, y) for edges in self._edges]).reshape(len(self.zones), -1)
+
+    def nearest_boundary(self, z, px, py):
+        """ゾーン z の境界上で (px, py) に最も近い点 (x, y) と、その距離"""
+        edges = self._edges[z]
+        ax, ay = edges[:, 0], edges[:, 1]
+        dx, dy = edges[:, 2] - ax, edges[:, 3] - ay
+        length2 = dx * dx + dy * dy
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.clip(np.where(length2 > 0, ((px - ax) * dx + (py - ay) * dy) / length2, 0.0), 0.0, 1.0)
+        cx, cy = ax + t * dx, ay + t * dy
+        dist2 = (cx - px) ** 2 + (cy - py) ** 2
+        i = int(np.argmin(dist2))
+        return float(cx[i]), float(cy[i]), math.sqrt(dist2[i])
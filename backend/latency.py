@@ -0,0 +1,160 @@
+"""操縦系の遅延計測 (ブラウザ入力 -> RC_CHANNELS_OVERRIDE -> 機体の RC_CHANNELS)
+
+区間ごとにヒストグラムを持つ (単位 ms):
+
+- ws_rtt:   ブラウザ -> バックエンド -> ブラウザ の往復。MANUAL_CONTROL の seq/t を CONTROL_ACK で返し、
+            ブラウザが測った値を次の MANUAL_CONTROL の rtt として送ってくる (時計合わせが不要)
+- backend:  MANUAL_CONTROL の受信から RC_CHANNELS_OVERRIDE の送信まで
+- vehicle:  RC_CHANNELS_OVERRIDE の送信から、同じ値が機体の RC_CHANNELS に現れるまで
+            (RC_CHANNELS の送信間隔ぶんの遅れを含む。STREAM_RATES で RC_CHANNELS を上げると精度が上がる)
+- total:    ws_rtt / 2 + backend + vehicle (ブラウザの入力から機体が値を反映するまでの推定)
+
+値が変わらない override は機体側の反映と区別できないので、vehicle / total は送信値と機体の報告値が
+どちらも変わったときだけ計測する。
+"""
+import bisect
+import time
+
+# バケット上限 (ms)。最後は上限なし
+BUCKETS_MS = (1, 2, 3, 5, 7, 10, 15, 20, 30, 50, 70, 100, 150, 200, 300, 500, 700, 1000, 1500, 2000, 3000, 5000)
+STAGES = ("ws_rtt", "backend", "vehicle", "total")
+PENDING_TIMEOUT = 2.0
+MAX_CLIENTS = 32
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, p):
+        """バケット内を線形補間した p パーセンタイル (ms)"""
+        if not self.count:
+            return None
+        target = self.count * p / 100.0
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= target:
+                low = BUCKETS_MS[i - 1] if i > 0 else 0.0
+                high = BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+                value = low + (high - low) * (target - seen) / c
+                return round(min(max(value, self.min), self.max), 2)
+            seen += c
+        return round(self.max, 2)
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 2),
+            "min": round(self.min, 2),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": round(self.max, 2),
+            "buckets": {("le_%g" % b if i < len(BUCKETS_MS) else "inf"): c
+                        for i, (b, c) in enumerate(zip(BUCKETS_MS + (None,), self.counts)) if c},
+        }
+
+
+class ControlLatencyTracer:
+    def __init__(self):
+        self.clients = {}     # client_id -> {stage: Histogram}
+        self._rtt = {}        # client_id -> 直近の ws_rtt (ms)
+        self._last_sent = {}  # client_id -> (steer, throttle)
+        self._pending = []    # [(steer, throttle, 送信時刻, client_id, backend_ms)] 古い順
+        self._last_echo = None  # 機体が最後に報告した (chan1, chan3)
+
+    def _hist(self, client_id, stage):
+        stages = self.clients.get(client_id)
+        if stages is None:
+            # 切断済みのクライアントの結果も API で見られるよう残すが、古いものから捨てる
+            if len(self.clients) >= MAX_CLIENTS:
+                del self.clients[next(iter(self.clients))]
+            stages = self.clients[client_id] = {s: Histogram() for s in STAGES}
+        return stages[stage]
+
+    def remove_client(self, client_id):
+        self._rtt.pop(client_id, None)
+        self._last_sent.pop(client_id, None)
+        self._pending = [p for p in self._pending if p[3] != client_id]
+
+    def record_rtt(self, client_id, rtt_ms):
+        # ブラウザのタブが裏に回ったときなどの異常値は捨てる
+        if 0 <= rtt_ms < 60000:
+            self._rtt[client_id] = rtt_ms
+            self._hist(client_id, "ws_rtt").add(rtt_ms)
+
+    def record_override(self, client_id, steer, throttle, received, sent):
+        """MANUAL_CONTROL の受信時刻 received と RC_CHANNELS_OVERRIDE の送信時刻 sent (time.monotonic)"""
+        backend_ms = (sent - received) * 1000.0
+        self._hist(client_id, "backend").add(backend_ms)
+        values = (steer, throttle)
+        if self._last_sent.get(client_id) == values:
+            return
+        self._last_sent[client_id] = values
+        self._pending.append((steer, throttle, sent, client_id, backend_ms))
+        # 応答が無いまま溜まらないよう古いものを捨てる
+        if len(self._pending) > 64 or sent - self._pending[0][2] > PENDING_TIMEOUT:
+            self._pending = [p for p in self._pending[-64:] if sent - p[2] <= PENDING_TIMEOUT]
+
+    def handle_message(self, msg):
+        if msg.get_type() not in ("RC_CHANNELS", "RC_CHANNELS_RAW"):
+            return
+        values = (msg.chan1_raw, msg.chan3_raw)
+        # 値が変わった (機体が新しい override を反映した) ときだけ対応付ける
+        if values == self._last_echo:
+            return
+        self._last_echo = values
+        if not self._pending:
+            return
+        now = time.monotonic()
+        # 最新の一致を採用し、それより前の要求は上書きされたものとして捨てる
+        for i in range(len(self._pending) - 1, -1, -1):
+            steer, throttle, sent, client_id, backend_ms = self._pending[i]
+            if (steer, throttle) != values:
+                continue
+            vehicle_ms = (now - sent) * 1000.0
+            self._hist(client_id, "vehicle").add(vehicle_ms)
+            rtt = self._rtt.get(client_id)
+            if rtt is not None:
+                self._hist(client_id, "total").add(rtt / 2 + backend_ms + vehicle_ms)
+            del self._pending[:i + 1]
+            return
+
+    def reset(self):
+        self.clients = {}
+        self._pending = []
+        self._last_echo = None
+
+    def summary(self):
+        overall = {s: Histogram() for s in STAGES}
+        for stages in self.clients.values():
+            for stage, hist in stages.items():
+                overall[stage].merge(hist)
+        return {
+            "unit": "ms",
+            "overall": {s: h.summary() for s, h in overall.items()},
+            "clients": {str(cid): {s: h.summary() for s, h in stages.items()}
+                        for cid, stages in self.clients.items()},
+        }
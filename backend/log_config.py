@@ -0,0 +1,152 @@
+"""ログ設定 (イベントループを止めない非同期ログ)
+
+print() は stdout (本番では Docker のログドライバ) への同期書き込みになり、ジョイスティック操作中の
+RC_OVERRIDE ごとに呼ぶとイベントループの遅延になる。ここでは
+
+- 呼び出し側は QueueHandler でキューに積むだけ (一杯なら捨てて数える。待たない)
+- 整形と書き込みは QueueListener の別スレッドで行う
+- 同じメッセージ (logger + 書式文字列) が続くときは一定間隔あたりの件数に制限し、抑制した件数を次の出力に付ける。
+  制限するのは INFO 以下だけで、WARNING 以上は常に出す
+- extra={...} で渡したフィールド (client, sysid, command など) を LOG_FORMAT=json なら JSON の項目として出す
+
+環境変数: LOG_LEVEL (既定 INFO), LOG_FORMAT (text | json), LOG_RATE_LIMIT (同一メッセージの 1 秒あたり上限, 0 で無制限)
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+QUEUE_SIZE = 10000
+
+# LogRecord が元から持つ属性 (これ以外は extra で渡された構造化フィールドとして扱う)
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+_listener = None
+_queue_handler = None
+
+
+def record_fields(record):
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS}
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """キューが一杯なら待たずに捨てる QueueHandler"""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 書式の展開だけここで行い (引数が後で変わっても良いように)、整形は書き込みスレッドに任せる
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """同じメッセージを interval 秒あたり burst 件までに制限する (WARNING 以上は制限しない)"""
+
+    def __init__(self, burst=5, interval=1.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}   # key -> [窓の開始時刻, 件数, 抑制数]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        # 警告やエラーは繰り返しても捨てない (抑制件数は次の同じメッセージが来るまで出ないため)
+        if self.burst <= 0 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if len(self._windows) > 1000:
+                    # 書式に値を埋め込んだメッセージで key が増え続けないよう、古い窓を捨てる
+                    self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.interval}
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class TextFormatter(logging.Formatter):
+    """従来の print と同じ "[name] message" 形式。構造化フィールドは key=value で後ろに付ける"""
+
+    def format(self, record):
+        text = f"[{record.name}] {record.getMessage()}"
+        fields = record_fields(record)
+        if fields:
+            text += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **record_fields(record),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup(level=None, fmt=None, rate_limit=None, stream=None):
+    """ルートロガーを非同期出力に設定する。2 回目以降の呼び出しは何もしない"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return _listener
+    level = level or os.environ.get("LOG_LEVEL", "INFO")
+    fmt = fmt or os.environ.get("LOG_FORMAT", "text")
+    if rate_limit is None:
+        rate_limit = int(os.environ.get("LOG_RATE_LIMIT", "5"))
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(QUEUE_SIZE))
+    _queue_handler.addFilter(RateLimitFilter(burst=rate_limit))
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, writer, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+    return _listener
+
+
+def shutdown():
+    """キューに残ったログを書き出して書き込みスレッドを止める"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped_count():
+    return _queue_handler.dropped if _queue_handler is not None else 0
@@ -1,17 +1,75 @@
-from fastapi import FastAPI, WebSocket
+import time
+
+# 起動時間の計測用 (import を含む)。ログの "Backend ready" に出る
+STARTED = time.monotonic()
+
+from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pymavlink import mavutil
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, JSONResponse, Response
+from pydantic import BaseModel, field_validator
 import asyncio
+import contextlib
+import itertools
 import json
+import logging
+import math
 import os
+import threading
+
+import auth
+import geofence
+import latency
+import log_config
+import mavlink_dialect
+import mavlink_passthrough
+import mavlink_router
+import mission
+import occupancy_proxy
+import params
+import stream_rates
+import tile_cache
+from mavlink_dialect import mavlink
+
+log_config.setup()
+log = logging.getLogger("backend")
+
+# シャットダウン時にハートビート待ちのスレッドを止める
+stopping = threading.Event()
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    log.info("Backend ready in %.0f ms", (time.monotonic() - STARTED) * 1000)
+    # 最初のクライアントを待たずに機体とのリンクを上げておく (再起動時のダウンタイムを短くする)
+    link_task = asyncio.create_task(ensure_mavlink())
+    yield
+    stopping.set()
+    link_task.cancel()
+    # 地図タイルの使われた順序を次回起動時に引き継ぐ
+    await asyncio.get_running_loop().run_in_executor(None, tiles.persist_order)
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # グローバル変数としてMAVLink接続を保持
 mav = None
+mav_lock = asyncio.Lock()
+mavlink_reader_task = None
+
+# 受信メッセージを処理するサブシステム (パラメータ管理など) のハンドラ
+mavlink_handlers = []
+# WebSocketクライアントごとの送信キュー (MAVLinkメッセージ または 通知用dict)
+client_queues = set()
+CLIENT_QUEUE_SIZE = 1000
+# ログで WebSocket クライアントを区別するための連番
+client_ids = itertools.count(1)
+# /ws/mavlink クライアントの送信キュー (tick ごとの生フレームをまとめた bytes)
+raw_client_queues = set()
+raw_allowlist = mavlink_passthrough.load_allowlist()
+raw_stats = mavlink_passthrough.PassthroughStats()
+# QGroundControl などへの追加リンク (MAVLINK_ROUTES)
+router = mavlink_router.MavlinkRouter(os.environ.get("MAVLINK_ROUTES", ""))
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # React (localhost:5173) からのアクセスを許可
 app.add_middleware(
@@ -23,26 +81,142 @@ app.add_middleware(
 
 # ★重要: WSLの全インターフェースで待ち受けるため "0.0.0.0" を指定
 # Rpanionからは "WSLのTailscale IP:14552" 宛に投げてもらう
-CONNECTION_STRING = 'udp:0.0.0.0:14552'
+# MAVLINK_CONNECTION で変更可 (例: SITL に直接 "tcp:127.0.0.1:5760")
+CONNECTION_STRING = os.environ.get("MAVLINK_CONNECTION", 'udp:0.0.0.0:14552')
+
+# バックエンド自身の送信元 ID。ArduPilot は SYSID_MYGCS (既定 255) からの RC_CHANNELS_OVERRIDE しか
+# 受け付けないので system は 255 のまま。component は QGC / Mission Planner (190) や MAVProxy (230) と
+# 別にして、ルーター越しに同じ機体へつながった他の GCS 宛ての応答 (COMMAND_ACK など) と区別する
+SOURCE_SYSTEM = int(os.environ.get("MAVLINK_SOURCE_SYSTEM", 255))
+SOURCE_COMPONENT = int(os.environ.get("MAVLINK_SOURCE_COMPONENT", mavlink.MAV_COMP_ID_USER1))
+
+def broadcast(event):
+    """全WebSocketクライアントへ通知 (dict) を送る"""
+    for queue in list(client_queues):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+# 機体ごとのパラメータのキャッシュ (PARAMS_CACHE_DIR で変更可。Docker ではボリュームで永続化)
+param_manager = params.ParamManager(os.environ.get("PARAMS_CACHE_DIR", os.path.join(BASE_DIR, "params_cache")),
+                                    notify=broadcast)
+mavlink_handlers.append(param_manager.handle_message)
+mission_manager = mission.MissionManager(notify=broadcast)
+mavlink_handlers.append(mission_manager.handle_message)
+geofence_manager = geofence.GeofenceManager(os.path.join(BASE_DIR, "missions", "geofence.json"), notify=broadcast)
+mavlink_handlers.append(geofence_manager.handle_message)
+rate_manager = stream_rates.StreamRateManager()
+mavlink_handlers.append(rate_manager.handle_message)
+latency_tracer = latency.ControlLatencyTracer()
+mavlink_handlers.append(latency_tracer.handle_message)
+tiles = tile_cache.from_env(os.path.join(BASE_DIR, "tile_cache"))
+occupancy = occupancy_proxy.from_env()
+
+async def mavlink_reader():
+    # MAVLink受信はここだけで行い、ハンドラと各クライアントのキューへ配る
+    while True:
+        received = 0
+        # /ws/mavlink 向けに、この tick で受信したフレームをそのまま連結する
+        raw = bytearray() if raw_client_queues else None
+        while received < 200:
+            msg = mav.recv_match(blocking=False)
+            if msg is None:
+                break
+            received += 1
+            if raw is not None and msg.get_type() != "BAD_DATA":
+                raw += msg.get_msgbuf()
+            if router.enabled:
+                router.from_vehicle(msg)
+            for handler in mavlink_handlers:
+                try:
+                    handler(msg)
+                except Exception as e:
+                    log.exception("Error in MAVLink handler", extra={"msg_type": msg.get_type()})
+            for queue in list(client_queues):
+                try:
+                    queue.put_nowait(msg)
+                except asyncio.QueueFull:
+                    pass
+        if raw:
+            batch = bytes(raw)
+            raw_stats.batches_out += 1
+            raw_stats.bytes_out += len(batch)
+            for queue in list(raw_client_queues):
+                try:
+                    queue.put_nowait(batch)
+                except asyncio.QueueFull:
+                    raw_stats.dropped_batches += 1
+        if router.enabled:
+            router.poll()
+        await asyncio.sleep(0.01 if received == 0 else 0)
+
+def wait_heartbeat(conn):
+    """ハートビートを受信するまで待つ。シャットダウン時は False を返す"""
+    while not stopping.is_set():
+        if conn.wait_heartbeat(timeout=1.0) is not None:
+            return True
+    return False
+
+async def ensure_mavlink():
+    """MAVLink接続を確立する (接続済みなら再利用)"""
+    global mav, mavlink_reader_task
+    async with mav_lock:
+        if mav is not None:
+            log.debug("Using existing MAVLink connection")
+            return mav
+
+        # mavutil (numpy を含む) の import とハートビート待ちはイベントループを止めないよう別スレッドで行う
+        loop = asyncio.get_running_loop()
+        mavutil = await loop.run_in_executor(None, mavlink_dialect.load_mavutil)
+
+        # SITL からの出力を 14552 で待ち受け
+        log.info("Waiting for MAVLink heartbeat on %s...", CONNECTION_STRING)
+        conn = mavutil.mavlink_connection(CONNECTION_STRING, source_system=SOURCE_SYSTEM,
+                                          source_component=SOURCE_COMPONENT)
+
+        if not await loop.run_in_executor(None, wait_heartbeat, conn):
+            conn.close()
+            raise ConnectionError("Backend is shutting down")
+
+        log.info("MAVLink heartbeat received", extra={"sysid": conn.target_system,
+                                                      "uptime_ms": round((time.monotonic() - STARTED) * 1000)})
+        mav = conn
+        router.attach(mav, mavutil)
+        mavlink_reader_task = asyncio.create_task(mavlink_reader())
+        mission_manager.attach(mav)
+        geofence_manager.attach(mav)
+        rate_manager.attach(mav)
+        asyncio.create_task(param_manager.attach(mav))
+        return mav
 
 class LoginRequest(BaseModel):
     password: str
 
-def get_password():
-    try:
-        # backend/main.py と同じディレクトリにある password.txt を探す
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        password_path = os.path.join(base_dir, "password.txt")
-        with open(password_path, "r") as f:
-            return f.read().strip()
-    except FileNotFoundError:
-        return "password"
+# backend/main.py と同じディレクトリにある password.txt (無ければ "password")
+session_auth = auth.SessionAuth(os.path.join(BASE_DIR, "password.txt"))
+
+def require_token(request: Request):
+    """REST の操作系エンドポイント用: Authorization: Bearer <token> を検証する"""
+    header = request.headers.get("authorization", "")
+    token = header[7:] if header[:7].lower() == "bearer " else None
+    if not session_auth.verify(token):
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+
+# 認証が必要なエンドポイントに付ける
+AUTH = [Depends(require_token)]
 
 @app.post("/api/login")
-async def login(req: LoginRequest):
-    if req.password == get_password():
-        return {"status": "ok"}
-    return {"status": "error", "message": "Invalid password"}
+async def login(req: LoginRequest, request: Request):
+    client = request.client.host if request.client else "unknown"
+    token, retry_after = session_auth.login(req.password, client)
+    if retry_after > 0:
+        return JSONResponse(status_code=429, headers={"Retry-After": str(int(retry_after) + 1)},
+                            content={"status": "error", "message": "Too many attempts",
+                                     "retry_after": round(retry_after, 1)})
+    if token is None:
+        return {"status": "error", "message": "Invalid password"}
+    return {"status": "ok", "token": token, "expires_in": session_auth.ttl}
 
 @app.get("/api/health")
 async def health_check():
@@ -52,28 +226,45 @@ async def health_check():
 async def websocket_endpoint(websocket: WebSocket):
     global mav
     await websocket.accept()
-    print("[backend] Client connected via WebSocket")
+    # ブラウザの WebSocket はヘッダを付けられないので、トークンはクエリで受け取る。
+    # 検証は接続時の 1 回だけで、以降の操作メッセージは認証済みとして扱う。
+    # フロントエンドがログイン画面に戻れるよう、accept してから 1008 (policy violation) で閉じる
+    if not session_auth.verify(websocket.query_params.get("token")):
+        log.warning("WebSocket rejected: invalid token",
+                    extra={"client_addr": websocket.client.host if websocket.client else None})
+        await websocket.close(code=1008)
+        return
+    client_id = next(client_ids)
+    log.info("Client connected via WebSocket", extra={"client": client_id})
+
+    queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+    # 時間のかかる転送 (PARAM / MISSION) は別タスクで実行し、その間も操縦コマンドを受け付ける。
+    # 切断したら止める (機体側の転送を塞いだまま、閉じたソケットへ結果を送ろうとしないように)
+    transfers = {}  # "PARAM" | "MISSION" -> 実行中のタスク
+
+    def transfer_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            log.info("transfer ended: %r", task.exception(), extra={"client": client_id})
 
     try:
-        # MAVLink接続の確立（SITL からの出力を 14552 で待ち受け）
-        # 既に接続済みの場合は再利用、なければ新規作成
-        if mav is None:
-            print(f"[backend] Waiting for MAVLink heartbeat on {CONNECTION_STRING}...")
-            mav = mavutil.mavlink_connection(CONNECTION_STRING, source_system=255, source_component=190)
-            
-            # ブロッキング回避のため、別スレッドでハートビートを待つ
-            loop = asyncio.get_running_loop()
-            await loop.run_in_executor(None, mav.wait_heartbeat)
-            
-            print("[backend] MAVLink heartbeat received")
-        else:
-            print("[backend] Using existing MAVLink connection")
+        # MAVLink接続の確立（既に接続済みの場合は再利用）
+        await ensure_mavlink()
+        client_queues.add(queue)
+        # 次のハートビート (1Hz) を待たずに、受信済みの最新の HEARTBEAT で機体の状態を表示させる
+        last_heartbeat = mav.messages.get("HEARTBEAT")
+        if last_heartbeat is not None:
+            queue.put_nowait(last_heartbeat)
+        # このクライアントが必要なテレメトリレートを登録 (切断時に解除)
+        rate_manager.subscribe(queue, stream_rates.CLIENT_RATES)
 
         async def mavlink_to_frontend():
-            import math, time
             last_sonar = None
             while True:
-                msg = mav.recv_match(blocking=False)
+                msg = await queue.get()
+                if isinstance(msg, dict):
+                    # サブシステムからの通知 (PARAM_PROGRESS など)
+                    await websocket.send_text(json.dumps(msg))
+                    continue
                 if msg:
                     msg_type = msg.get_type()
                     # 個別メッセージをそのまま送信
@@ -93,7 +284,6 @@ async def websocket_endpoint(websocket: WebSocket):
                             "type": "TELEMETRY",
                             "data": {"sonar_range": last_sonar}
                         }))
-                await asyncio.sleep(0.01)
 
         async def commands_from_frontend():
             # デフォルトはニュートラル
@@ -110,22 +300,46 @@ async def websocket_endpoint(websocket: WebSocket):
                     throttle,
                     0, 0, 0, 0, 0
                 )
-                print(f"[backend] RC_OVERRIDE sent: steer={steer}, throttle={throttle}")
+                # ジョイスティック操作中は毎回呼ばれるので DEBUG (LOG_LEVEL=DEBUG で確認できる)
+                log.debug("RC_OVERRIDE sent", extra={"client": client_id, "sysid": mav.target_system,
+                                                     "steer": steer, "throttle": throttle})
+
+            async def start_transfer(kind, handler, msg):
+                """転送を開始する。同じ種類の転送が実行中なら <kind>_ERROR を返して拒否する"""
+                running = transfers.get(kind)
+                if running is not None and not running.done():
+                    await websocket.send_text(json.dumps({"type": kind + "_ERROR", "data": {
+                        "command": msg.get("command"), "message": f"another {kind} transfer is in progress"}}))
+                    return
+                task = transfers[kind] = asyncio.create_task(handler(websocket, msg))
+                task.add_done_callback(transfer_done)
 
             while True:
                 try:
                     data = await websocket.receive_text()
+                    received = time.monotonic()
                     msg = json.loads(data)
 
                     if msg.get("type") == "MANUAL_CONTROL":
                         throttle = int(msg.get("throttle", 1500))
                         steer = int(msg.get("steer", 1500))
-                        # print(f"[backend] MANUAL_CONTROL: steer={steer}, throttle={throttle}")
                         send_rc_override()
+                        # 遅延計測: ブラウザが付けた seq/t をそのまま返し、往復時間は次の送信で rtt として受け取る
+                        latency_tracer.record_override(client_id, steer, throttle, received, time.monotonic())
+                        # 計測値が壊れていても操縦は止めない (この try を抜けると接続ごとの操縦が切れる)
+                        rtt = msg.get("rtt")
+                        if isinstance(rtt, (int, float)) and math.isfinite(rtt):
+                            latency_tracer.record_rtt(client_id, float(rtt))
+                        if "seq" in msg:
+                            try:
+                                queue.put_nowait({"type": "CONTROL_ACK", "data": {"seq": msg["seq"], "t": msg.get("t")}})
+                            except asyncio.QueueFull:
+                                pass
 
                     elif msg.get("type") == "COMMAND":
                         cmd = msg.get("command")
-                        print(f"[backend] COMMAND received: {msg}")
+                        log.info("COMMAND received", extra={"client": client_id, "sysid": mav.target_system,
+                                                            "command": cmd, "value": msg.get("value")})
 
                         if cmd == "FORWARD":
                             throttle = 2000
@@ -141,25 +355,43 @@ async def websocket_endpoint(websocket: WebSocket):
                         elif cmd == "SET_MODE":
                             mode_name = msg.get("value")
                             if mode_name:
-                                print(f"[backend] Requesting mode change to: {mode_name}")
                                 # モードIDを取得
                                 mode_map = mav.mode_mapping()
                                 if mode_name in mode_map:
                                     mode_id = mode_map[mode_name]
                                     mav.set_mode(mode_id)
-                                    print(f"[backend] Mode set to {mode_name} (ID: {mode_id})")
+                                    log.info("Mode set to %s (ID: %s)", mode_name, mode_id, extra={"client": client_id})
                                 else:
-                                    print(f"[backend] Unknown mode: {mode_name}. Available: {list(mode_map.keys())}")
+                                    log.warning("Unknown mode: %s. Available: %s", mode_name, list(mode_map.keys()),
+                                                extra={"client": client_id})
                         elif cmd == "ARM":
-                            print("[backend] Sending ARM command")
                             mav.arducopter_arm()
                         elif cmd == "DISARM":
-                            print("[backend] Sending DISARM command")
                             mav.arducopter_disarm()
 
                         send_rc_override()
+
+                    elif msg.get("type") == "PARAM":
+                        if msg.get("command") == "LIST":
+                            await handle_param_command(websocket, msg)
+                        else:
+                            # DOWNLOAD は 20 秒以上かかることがある
+                            await start_transfer("PARAM", handle_param_command, msg)
+
+                    elif msg.get("type") == "MISSION":
+                        await start_transfer("MISSION", handle_mission_command, msg)
+
+                    elif msg.get("type") == "STREAM_RATES":
+                        # {"type": "STREAM_RATES", "rates": {"ATTITUDE": 50, ...}} 既定レートに上書きする
+                        rates = msg.get("rates") or {}
+                        try:
+                            if not isinstance(rates, dict):
+                                raise ValueError("rates must be an object of {message: Hz}")
+                            rate_manager.subscribe(queue, {**stream_rates.CLIENT_RATES, **rates})
+                        except (TypeError, ValueError) as e:
+                            log.warning("STREAM_RATES rejected: %s", e, extra={"client": client_id})
                 except Exception as e:
-                    print(f"[backend] Error in commands_from_frontend: {e}")
+                    log.info("commands_from_frontend ended: %r", e, extra={"client": client_id})
                     break
 
         await asyncio.gather(
@@ -168,8 +400,97 @@ async def websocket_endpoint(websocket: WebSocket):
         )
 
     except Exception as e:
-        print(f"[backend] Error in websocket_endpoint: {e}")
+        log.warning("Error in websocket_endpoint: %r", e, extra={"client": client_id})
         await websocket.close()
+    finally:
+        for task in transfers.values():
+            task.cancel()
+        client_queues.discard(queue)
+        rate_manager.unsubscribe(queue)
+        latency_tracer.remove_client(client_id)
+
+@app.websocket("/ws/mavlink")
+async def mavlink_passthrough_endpoint(websocket: WebSocket):
+    """生の MAVLink フレームをバイナリメッセージで双方向に中継する (デコードはクライアント側で行う)"""
+    await websocket.accept()
+    if not session_auth.verify(websocket.query_params.get("token")):
+        log.warning("Raw MAVLink WebSocket rejected: invalid token",
+                    extra={"client_addr": websocket.client.host if websocket.client else None})
+        await websocket.close(code=1008)
+        return
+    client_id = next(client_ids)
+    log.info("Client connected via raw MAVLink WebSocket", extra={"client": client_id})
+
+    queue = asyncio.Queue(maxsize=mavlink_passthrough.QUEUE_SIZE)
+    client_filter = mavlink_passthrough.ClientFilter(raw_allowlist)
+    try:
+        await ensure_mavlink()
+        raw_client_queues.add(queue)
+        raw_stats.clients += 1
+        rate_manager.subscribe(queue, stream_rates.CLIENT_RATES)
+
+        async def vehicle_to_client():
+            while True:
+                await websocket.send_bytes(await queue.get())
+
+        async def client_to_vehicle():
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                data = message.get("bytes")
+                if not data:
+                    continue
+                frames, count, rejected, bad = client_filter.feed(data)
+                if frames:
+                    mav.write(frames)
+                    raw_stats.frames_in += count
+                if rejected or bad:
+                    raw_stats.rejected_in += len(rejected)
+                    raw_stats.bad_in += bad
+                    log.warning("Raw MAVLink frames dropped", extra={"client": client_id, "rejected": rejected,
+                                                                      "bad": bad})
+                    await websocket.send_text(json.dumps({"type": "RAW_REJECTED",
+                                                          "data": {"messages": rejected, "bad": bad}}))
+
+        # どちらかが終われば (切断 / 送信失敗) もう片方も止める
+        tasks = [asyncio.create_task(vehicle_to_client()), asyncio.create_task(client_to_vehicle())]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception() is not None:
+                log.info("Raw MAVLink WebSocket ended: %r", task.exception(), extra={"client": client_id})
+    except Exception as e:
+        log.warning("Error in mavlink_passthrough_endpoint: %r", e, extra={"client": client_id})
+        await websocket.close()
+    finally:
+        if queue in raw_client_queues:
+            raw_client_queues.discard(queue)
+            raw_stats.clients -= 1
+        rate_manager.unsubscribe(queue)
+        log.info("Raw MAVLink client disconnected", extra={"client": client_id})
+
+async def handle_param_command(websocket, msg):
+    # {"type": "PARAM", "command": "LIST" | "DOWNLOAD" | "SET" | "UPLOAD", ...}
+    cmd = msg.get("command")
+    try:
+        if cmd == "LIST":
+            result = param_manager.snapshot()
+        elif cmd == "DOWNLOAD":
+            # 進捗は PARAM_PROGRESS で通知される
+            result = await param_manager.download()
+        elif cmd == "SET":
+            result = await param_manager.set_params({msg["name"]: float(msg["value"])})
+        elif cmd == "UPLOAD":
+            result = await param_manager.upload_diff(params.parse_param_file(msg.get("text", "")),
+                                                     dry_run=bool(msg.get("dry_run", False)))
+        else:
+            return
+        await websocket.send_text(json.dumps({"type": "PARAM_" + cmd + "_RESULT", "data": result}))
+    except Exception as e:
+        log.warning("PARAM %s failed: %s", cmd, e, extra={"command": cmd})
+        await websocket.send_text(json.dumps({"type": "PARAM_ERROR", "data": {"command": cmd, "message": str(e)}}))
 
 # 移動指令用のデータモデル
 class GoToCommand(BaseModel):
@@ -177,10 +498,23 @@ class GoToCommand(BaseModel):
     lon: float
     speed: float | None = None
 
-@app.post("/api/command/goto")
+@app.post("/api/command/goto", dependencies=AUTH)
 async def goto_position(cmd: GoToCommand):
     global mav
     if mav:
+        # 0. ジオフェンス判定 (違反なら拒否、clamp 設定なら許可位置へ寄せる)
+        allowed, lat, lon, violations, clamped = geofence_manager.filter_target(cmd.lat, cmd.lon)
+        if not allowed:
+            log.warning("GoTo blocked by geofence", extra={"lat": cmd.lat, "lon": cmd.lon, "zones": violations})
+            broadcast({"type": "GEOFENCE_ALERT",
+                       "data": {"blocked": True, "zones": violations, "lat": cmd.lat, "lon": cmd.lon}})
+            return {"status": "error", "message": "Target violates geofence", "zones": violations}
+        if clamped:
+            log.info("GoTo clamped by geofence: (%s, %s) -> (%.7f, %.7f)", cmd.lat, cmd.lon, lat, lon)
+            broadcast({"type": "GEOFENCE_ALERT",
+                       "data": {"clamped": True, "zones": violations, "lat": lat, "lon": lon}})
+            cmd.lat, cmd.lon = lat, lon
+
         # 1. モードを GUIDED に変更 (自律移動には必須)
         # GUIDEDモードのIDを取得 (ArduRoverでは通常 10 または 15 ですが、マッピングから取得するのが確実)
         mode_id = mav.mode_mapping().get('GUIDED')
@@ -190,7 +524,7 @@ async def goto_position(cmd: GoToCommand):
         
         mav.mav.set_mode_send(
             mav.target_system,
-            mavutil.mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
+            mavlink.MAV_MODE_FLAG_CUSTOM_MODE_ENABLED,
             mode_id
         )
 
@@ -199,14 +533,14 @@ async def goto_position(cmd: GoToCommand):
             mav.mav.command_long_send(
                 mav.target_system,
                 mav.target_component,
-                mavutil.mavlink.MAV_CMD_DO_CHANGE_SPEED,
+                mavlink.MAV_CMD_DO_CHANGE_SPEED,
                 0, # confirmation
                 1, # param1: Speed type (1=Ground Speed)
                 cmd.speed, # param2: Speed (m/s)
                 -1, # param3: Throttle (-1=no change)
                 0, 0, 0, 0 # param4-7
             )
-            print(f"[backend] Set speed to {cmd.speed} m/s")
+            log.info("Set speed to %s m/s", cmd.speed, extra={"sysid": mav.target_system})
         
         # 3. ターゲット座標を送信 (int型: 緯度経度は 1e7 倍する)
         # MAV_FRAME_GLOBAL_RELATIVE_ALT_INT = 3 (ホームからの相対高度)
@@ -214,7 +548,7 @@ async def goto_position(cmd: GoToCommand):
             0, # time_boot_ms (not used)
             mav.target_system,
             mav.target_component,
-            mavutil.mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT_INT,
+            mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT_INT,
             # type_mask: 速度や加速度を無視し、位置だけ指定するビットマスク
             # (0b0000111111111000 = 0x0DF8)
             0x0DF8,
@@ -225,11 +559,258 @@ async def goto_position(cmd: GoToCommand):
             0, 0, 0, # accel
             0, 0 # yaw
         )
-        print(f"[backend] GoTo command sent: lat={cmd.lat}, lon={cmd.lon}")
-        return {"status": "success", "target": cmd}
+        log.info("GoTo command sent", extra={"sysid": mav.target_system, "lat": cmd.lat, "lon": cmd.lon})
+        return {"status": "success", "target": cmd, "clamped": clamped}
     
     return {"status": "error", "message": "No connection"}
 
+# ミッションのデータモデル
+class Waypoint(BaseModel):
+    lat: float
+    lon: float
+    alt: float = 0.0
+    command: int = mavlink.MAV_CMD_NAV_WAYPOINT
+
+class MissionItem(BaseModel):
+    # MISSION_ITEM_INT のフィールド (x, y は緯度経度の 1e7 倍)
+    seq: int
+    frame: int = mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT_INT
+    command: int = mavlink.MAV_CMD_NAV_WAYPOINT
+    current: int = 0
+    autocontinue: int = 1
+    param1: float = 0.0
+    param2: float = 0.0
+    param3: float = 0.0
+    param4: float = 0.0
+    x: int
+    y: int
+    z: float = 0.0
+
+class MissionUploadRequest(BaseModel):
+    # waypoints を渡すと seq 0 (ホーム) を付けて変換する。items なら MISSION_ITEM_INT のフィールドをそのまま使う
+    waypoints: list[Waypoint] | None = None
+    items: list[MissionItem] | None = None
+
+    @field_validator("items")
+    @classmethod
+    def check_sequence(cls, items):
+        # 機体は seq を位置として要求するので、欠番・重複・ホーム (seq 0) なしは受け付けない
+        if items is not None:
+            for i, item in enumerate(items):
+                if item.seq != i:
+                    raise ValueError(f"items[{i}].seq is {item.seq}, expected {i}")
+        return items
+
+def mission_items(items=None, waypoints=None):
+    """items / waypoints を検証して MISSION_ITEM_INT の dict のリストにする (不正なら ValueError)"""
+    req = MissionUploadRequest.model_validate({"items": items, "waypoints": waypoints})
+    if req.items is not None:
+        return [item.model_dump() for item in req.items]
+    return mission.waypoints_to_items([wp.model_dump() for wp in req.waypoints or []])
+
+def check_mission_geofence(items):
+    """ミッションの位置がジオフェンスに違反していれば、その seq のリストを返す"""
+    points = [item for item in items if item["seq"] > 0 and (item["x"] or item["y"])]
+    if not points:
+        return []
+    bad = geofence_manager.check_many([i["x"] / 1e7 for i in points], [i["y"] / 1e7 for i in points])
+    return [item["seq"] for item, b in zip(points, bad) if b]
+
+async def handle_mission_command(websocket, msg):
+    # {"type": "MISSION", "command": "UPLOAD" | "DOWNLOAD" | "CLEAR", "waypoints": [...] | "items": [...]}
+    cmd = msg.get("command")
+    try:
+        if cmd == "UPLOAD":
+            items = mission_items(msg.get("items") or None, msg.get("waypoints"))
+            violating = check_mission_geofence(items)
+            if violating:
+                raise mission.MissionTransferError(f"waypoints {violating} violate geofence")
+            result = await mission_manager.upload(items)
+        elif cmd == "DOWNLOAD":
+            # 進捗は MISSION_PROGRESS で通知される
+            result = await mission_manager.download()
+        elif cmd == "CLEAR":
+            await mission_manager.clear()
+            result = {"count": 0}
+        else:
+            return
+        await websocket.send_text(json.dumps({"type": "MISSION_" + cmd + "_RESULT", "data": result}))
+    except (mission.MissionTransferError, KeyError, TypeError, ValueError) as e:
+        log.warning("MISSION %s failed: %s", cmd, e, extra={"command": cmd})
+        await websocket.send_text(json.dumps({"type": "MISSION_ERROR", "data": {"command": cmd, "message": str(e)}}))
+
+@app.get("/api/mission", dependencies=AUTH)
+async def get_mission():
+    return {"status": "ok", "count": len(mission_manager.items), "items": mission_manager.items}
+
+@app.post("/api/mission/upload", dependencies=AUTH)
+async def upload_mission(req: MissionUploadRequest):
+    if req.items is not None:
+        items = [item.model_dump() for item in req.items]
+    else:
+        items = mission.waypoints_to_items([wp.model_dump() for wp in req.waypoints or []])
+    violating = check_mission_geofence(items)
+    if violating:
+        return {"status": "error", "message": "Waypoints violate geofence", "seq": violating}
+    try:
+        result = await mission_manager.upload(items)
+    except mission.MissionTransferError as e:
+        return {"status": "error", "message": str(e)}
+    return {"status": "ok", **result}
+
+@app.post("/api/mission/download", dependencies=AUTH)
+async def download_mission():
+    try:
+        result = await mission_manager.download()
+    except mission.MissionTransferError as e:
+        return {"status": "error", "message": str(e)}
+    return {"status": "ok", **result}
+
+@app.post("/api/mission/clear", dependencies=AUTH)
+async def clear_mission():
+    try:
+        await mission_manager.clear()
+    except mission.MissionTransferError as e:
+        return {"status": "error", "message": str(e)}
+    return {"status": "ok"}
+
+@app.get("/api/latency", dependencies=AUTH)
+async def get_latency():
+    """操縦系の遅延ヒストグラム (クライアントごと / 全体, ms)"""
+    return latency_tracer.summary()
+
+@app.post("/api/latency/reset", dependencies=AUTH)
+async def reset_latency():
+    latency_tracer.reset()
+    return {"status": "ok"}
+
+@app.get("/api/mavlink/passthrough", dependencies=AUTH)
+async def get_passthrough_stats():
+    """/ws/mavlink の中継状況と送信を許可しているメッセージ"""
+    allowed = None if raw_allowlist is None else sorted(mavlink.mavlink_map[i].msgname for i in raw_allowlist)
+    return {"status": "ok", "allowed": allowed or "*", **raw_stats.to_dict()}
+
+@app.get("/api/mavlink/routes", dependencies=AUTH)
+async def get_mavlink_routes():
+    """MAVLINK_ROUTES の各エンドポイントの送受信数と、その先に見えている sysid/compid"""
+    return {"status": "ok", **router.status()}
+
+@app.get("/api/tiles/status", dependencies=AUTH)
+async def get_tile_cache_status():
+    return {"status": "ok", **tiles.status()}
+
+@app.get("/api/tiles/{source}/{z}/{x}/{y}")
+async def get_tile(source: str, z: int, x: int, y: int, token: str = ""):
+    """地図タイル (キャッシュになければ上流から取得)。Leaflet の <img> はヘッダを付けられないのでトークンはクエリで受け取る"""
+    if not session_auth.verify(token):
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    try:
+        data = await tiles.get(source, z, x, y)
+    except tile_cache.TileNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except OSError as e:
+        log.warning("Tile fetch failed: %s", e, extra={"tile": f"{source}/{z}/{x}/{y}"})
+        raise HTTPException(status_code=502, detail="Tile server unavailable")
+    # トークンが URL に入るので、ブラウザのキャッシュはユーザーごと (private) にする
+    return Response(data, media_type=tile_cache.SOURCES[source]["type"],
+                    headers={"Cache-Control": "private, max-age=604800"})
+
+@app.get("/api/occupancy/meta", dependencies=AUTH)
+async def get_occupancy_meta(since: int = 0):
+    """Webots の占有格子地図の情報と、版 since より後に変わったタイル"""
+    try:
+        return {"status": "ok", **await occupancy.meta(since)}
+    except occupancy_proxy.OccupancyUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/api/occupancy/tiles/{i}/{j}.png")
+async def get_occupancy_tile(i: int, j: int, token: str = ""):
+    """占有格子地図のタイル (トークンは地図タイルと同じくクエリで受け取る)"""
+    if not session_auth.verify(token):
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    try:
+        data = await occupancy.tile(i, j)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="No such tile")
+    except occupancy_proxy.OccupancyUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    # URL に版 (v=) が入っているので、同じ URL の内容は変わらない
+    return Response(data, media_type="image/png", headers={"Cache-Control": "private, max-age=3600"})
+
+@app.get("/api/stream_rates", dependencies=AUTH)
+async def get_stream_rates():
+    return {"status": "ok", **rate_manager.status()}
+
+# ジオフェンス API
+class GeofenceConfig(BaseModel):
+    # zones: [{"name": str, "type": "inclusion" | "exclusion", "polygon": [[lat, lon], ...]}, ...]
+    zones: list[dict]
+    goto_action: str = "block"
+    breach_mode: str | None = None
+    clamp_margin: float = 1.0
+
+class GeofenceCheckRequest(BaseModel):
+    lat: float
+    lon: float
+
+@app.get("/api/geofence", dependencies=AUTH)
+async def get_geofence():
+    return {"status": "ok", **geofence_manager.to_dict(),
+            "violations": geofence_manager.violations, "last_check_us": geofence_manager.last_check_us}
+
+@app.put("/api/geofence", dependencies=AUTH)
+async def set_geofence(req: GeofenceConfig):
+    try:
+        geofence_manager.configure(req.zones, req.goto_action, req.breach_mode, req.clamp_margin)
+    except geofence.GeofenceError as e:
+        return {"status": "error", "message": str(e)}
+    geofence_manager.save()
+    log.info("Geofence updated: %d zones", len(geofence_manager.zones))
+    return {"status": "ok", "zones": len(geofence_manager.zones)}
+
+@app.post("/api/geofence/check", dependencies=AUTH)
+async def check_geofence(req: GeofenceCheckRequest):
+    allowed, lat, lon, violations, clamped = geofence_manager.filter_target(req.lat, req.lon)
+    return {"status": "ok", "allowed": allowed, "violations": violations, "clamped": clamped,
+            "lat": lat, "lon": lon, "check_us": geofence_manager.last_check_us}
+
+# パラメータ API
+class ParamSetRequest(BaseModel):
+    params: dict[str, float]
+
+class ParamUploadRequest(BaseModel):
+    # mav.parm 形式のテキスト (NAME VALUE を1行ずつ)
+    text: str
+    dry_run: bool = False
+
+@app.get("/api/params", dependencies=AUTH)
+async def get_params():
+    return {"status": "ok", **param_manager.snapshot()}
+
+@app.post("/api/params/download", dependencies=AUTH)
+async def download_params():
+    if mav is None:
+        return {"status": "error", "message": "No connection"}
+    try:
+        result = await param_manager.download()
+    except TimeoutError as e:
+        return {"status": "error", "message": str(e)}
+    return {"status": "ok", "source": result["source"], "count": result["count"]}
+
+@app.post("/api/params/set", dependencies=AUTH)
+async def set_params(req: ParamSetRequest):
+    if mav is None:
+        return {"status": "error", "message": "No connection"}
+    return {"status": "ok", "results": await param_manager.set_params(req.params)}
+
+@app.post("/api/params/upload", dependencies=AUTH)
+async def upload_params(req: ParamUploadRequest):
+    # dry_run=true なら差分の確認のみ
+    if mav is None and not req.dry_run:
+        return {"status": "error", "message": "No connection"}
+    result = await param_manager.upload_diff(params.parse_param_file(req.text), dry_run=req.dry_run)
+    return {"status": "ok", **result}
+
 # フロントエンドの静的ファイル配信設定
 # backend/main.py から見て ../frontend/dist が存在する場合のみマウント
 frontend_dist_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "frontend", "dist")
@@ -244,7 +825,7 @@ if os.path.exists(frontend_dist_path):
     if os.path.exists(vdo_path):
         app.mount("/vdo", StaticFiles(directory=vdo_path), name="vdo")
     else:
-        print(f"Warning: VDO path not found at {vdo_path}")
+        log.warning("VDO path not found at %s", vdo_path)
 
     # その他のルートは index.html を返す (SPA対応)
     @app.get("/{full_path:path}")
@@ -256,4 +837,4 @@ if os.path.exists(frontend_dist_path):
         # 存在しない場合は index.html を返す
         return FileResponse(os.path.join(frontend_dist_path, "index.html"))
 else:
-    print(f"Frontend dist not found at {frontend_dist_path}. Running in API-only mode.")
+    log.warning("Frontend dist not found at %s. Running in API-only mode.", frontend_dist_path)
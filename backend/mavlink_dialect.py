@@ -0,0 +1,26 @@
+"""MAVLink の定義 (メッセージ ID / enum / メッセージクラス) を軽く読み込む
+
+pymavlink.mavutil を import すると、numpy (mavextra 経由) と既定の "all" dialect を MAVLink1 で読み込み、
+機体から最初の MAVLink2 パケットが届いた時点で v20 の dialect をもう一度読み込む。
+起動を速くするため、定数だけが必要なモジュールは生成済みの dialect をここで 1 回だけ import し、
+mavutil は接続を開くときに load_mavutil() で読み込む (接続後は mavutil.mavlink がこのモジュールと同じになる)。
+
+    from mavlink_dialect import mavlink
+    mavlink.MAV_CMD_NAV_WAYPOINT
+"""
+import importlib
+import os
+
+# ArduPilot は MAVLink2 で話すので最初から v20 を使う (mavutil の自動切り替えによる読み直しを避ける)
+os.environ.setdefault("MAVLINK20", "1")
+os.environ.setdefault("MAVLINK_DIALECT", "ardupilotmega")
+
+DIALECT = os.environ["MAVLINK_DIALECT"]
+mavlink = importlib.import_module(
+    "pymavlink.dialects.%s.%s" % ("v20" if "MAVLINK20" in os.environ else "v10", DIALECT))
+
+
+def load_mavutil():
+    """pymavlink.mavutil を読み込んで返す (重いので接続時まで遅らせる。スレッドから呼んでもよい)"""
+    from pymavlink import mavutil
+    return mavutil
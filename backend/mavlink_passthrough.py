@@ -0,0 +1,87 @@
+"""生の MAVLink フレームを WebSocket (/ws/mavlink) でそのまま中継する
+
+- 機体 -> クライアント: mavlink_reader が 1 tick 分の受信フレームを 1 つの bytes にまとめ、全クライアントの
+  キューに同じオブジェクトを入れる (クライアントごとのデコード / JSON 化はしない)
+- クライアント -> 機体: バイナリメッセージ内のフレームを CRC 込みで検証し、許可リストにあるメッセージだけ送る
+
+許可リストは環境変数 RAW_MAVLINK_ALLOW (メッセージ名のカンマ区切り、"*" で全て許可)。
+既定は読み出し系 (パラメータ / ミッションの取得、データストリーム要求、ハートビートなど) だけで、
+ARM やモード変更、ミッション書き込みなどの操作系は既存の /ws や REST を使う。
+"""
+import logging
+import os
+
+from mavlink_dialect import mavlink
+
+log = logging.getLogger("mavlink_passthrough")
+
+DEFAULT_ALLOW = (
+    "HEARTBEAT", "TIMESYNC", "SYSTEM_TIME",
+    "REQUEST_DATA_STREAM",
+    "PARAM_REQUEST_READ", "PARAM_REQUEST_LIST",
+    "MISSION_REQUEST_LIST", "MISSION_REQUEST", "MISSION_REQUEST_INT", "MISSION_ACK",
+)
+QUEUE_SIZE = 200   # tick 単位のバッチ数 (10ms tick なら約 2 秒分)
+
+
+def parse_allowlist(text):
+    """"NAME,NAME,..." -> メッセージ ID の set。"*" なら None (全て許可)"""
+    names = [n.strip().upper() for n in text.split(",") if n.strip()]
+    if "*" in names:
+        return None
+    ids = set()
+    for name in names:
+        msg_id = getattr(mavlink, "MAVLINK_MSG_ID_" + name, None)
+        if msg_id is None:
+            raise ValueError(f"unknown MAVLink message {name}")
+        ids.add(msg_id)
+    return ids
+
+
+class ClientFilter:
+    """クライアントから届いたバイト列をフレームに分け、許可されたものだけを返す (クライアントごとに 1 つ)"""
+
+    def __init__(self, allowed):
+        self.allowed = allowed
+        # 途中で切れたフレームは次のメッセージと繋げて解析する
+        self._parser = mavlink.MAVLink(None)
+        self._parser.robust_parsing = True
+
+    def feed(self, data):
+        """(送ってよいフレームを連結した bytes, そのフレーム数, 拒否したメッセージ名のリスト, 壊れたフレーム数)"""
+        accepted = bytearray()
+        count = 0
+        rejected = []
+        bad = 0
+        for msg in self._parser.parse_buffer(data) or []:
+            if msg.get_type() == "BAD_DATA":
+                bad += 1
+            elif self.allowed is None or msg.get_msgId() in self.allowed:
+                accepted += msg.get_msgbuf()
+                count += 1
+            else:
+                rejected.append(msg.get_type())
+        return bytes(accepted), count, rejected, bad
+
+
+class PassthroughStats:
+    def __init__(self):
+        self.clients = 0
+        self.batches_out = 0
+        self.bytes_out = 0
+        self.dropped_batches = 0
+        self.frames_in = 0
+        self.rejected_in = 0
+        self.bad_in = 0
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def load_allowlist():
+    text = os.environ.get("RAW_MAVLINK_ALLOW")
+    if not text:
+        return parse_allowlist(",".join(DEFAULT_ALLOW))
+    allowed = parse_allowlist(text)
+    log.info("Raw MAVLink allowlist: %s", "all messages" if allowed is None else text)
+    return allowed
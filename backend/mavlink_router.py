@@ -0,0 +1,146 @@
+"""MAVLink ルーター (QGroundControl やロガーなど、追加の GCS リンクへの中継)
+
+機体リンク (main.py の mav) と、環境変数 MAVLINK_ROUTES で指定したエンドポイント
+(mavutil の接続文字列をカンマ区切り、例 "udpout:192.168.1.10:14550,tcpin:0.0.0.0:5770") の間で
+MAVLink を中継する。MAVProxy などのルーターを別に立てる必要がなく、ホップが 1 つ減る。
+
+- 各パケットは受信したリンクで 1 回だけ解析し、送信先へは受信したバイト列をそのままコピーする
+- リンクごとに見えた (sysid, compid) を覚え、target_system / target_component を持つメッセージは
+  その相手が見えたリンクにだけ送る (ArduPilot の MAVLink_routing と同じ規則)。宛先なしは受信元以外の全リンクへ
+- 冗長な経路から同じフレームが届いた場合は、(sysid, compid, seq, msgid) が DEDUP_TTL 以内に
+  一致する 2 回目以降を捨てる
+- 送信は受信ループの 1 tick ごとにエンドポイント単位でまとめる
+"""
+import collections
+import logging
+import time
+
+log = logging.getLogger("mavlink_router")
+
+DEDUP_TTL = 0.15         # 重複とみなす間隔 (s)。seq が一周する時間 (50Hz でも 5 s) より十分短くする
+MAX_READ_PER_TICK = 200  # 1 tick にエンドポイントごとに読むメッセージ数の上限
+VEHICLE = "vehicle"
+
+
+class Link:
+    """ルーティング対象のリンク (機体 or エンドポイント)"""
+
+    def __init__(self, name, conn):
+        self.name = name
+        self.conn = conn
+        self.systems = set()   # このリンクの先に見えた (sysid, compid)
+        self.pending = bytearray()
+        self.rx = 0
+        self.tx = 0
+        self.errors = 0
+
+    def knows(self, sysid, compid):
+        if compid == 0:
+            return any(s == sysid for s, _ in self.systems)
+        return (sysid, compid) in self.systems
+
+    def flush(self):
+        if not self.pending:
+            return
+        try:
+            self.conn.write(bytes(self.pending))
+        except OSError as e:
+            # 相手がいない (TCP 未接続、ICMP unreachable など)。次の tick で再送はしない
+            self.errors += 1
+            if self.errors <= 3 or self.errors % 1000 == 0:
+                log.warning("Write to %s failed (%d times): %s", self.name, self.errors, e)
+        self.pending.clear()
+
+    def status(self):
+        return {"name": self.name, "rx": self.rx, "tx": self.tx, "errors": self.errors,
+                "systems": sorted(f"{s}/{c}" for s, c in self.systems)}
+
+
+class MavlinkRouter:
+    def __init__(self, routes):
+        """routes: mavutil の接続文字列をカンマ区切り (空ならルーティングしない)"""
+        self.specs = [r.strip() for r in routes.split(",") if r.strip()]
+        self.endpoints = []
+        self.vehicle = None
+        self.duplicates = 0
+        self._recent = {}                        # (sysid, compid, seq, msgid) -> 受信時刻
+        self._recent_order = collections.deque()  # (受信時刻, key) 古い順
+
+    @property
+    def enabled(self):
+        return bool(self.endpoints)
+
+    def attach(self, mav, mavutil):
+        """機体リンクが確立したら呼ぶ。エンドポイントを開く"""
+        self.vehicle = Link(VEHICLE, mav)
+        if self.endpoints:
+            return
+        for spec in self.specs:
+            try:
+                # 受信したバイト列をそのまま送るだけなので、送信元 ID は機体リンクに合わせておく
+                conn = mavutil.mavlink_connection(spec, source_system=mav.mav.srcSystem,
+                                                  source_component=mav.mav.srcComponent)
+            except Exception as e:
+                log.error("Cannot open MAVLink route %s: %s", spec, e)
+                continue
+            self.endpoints.append(Link(spec, conn))
+            log.info("MAVLink route opened: %s", spec)
+
+    def _duplicate(self, msg):
+        # 重複が届くのは同じ相手に 2 つの経路がある場合 (機体が無線と VPN の両方でつながっている、
+        # 同じ GCS を 2 つのエンドポイントに書いた、受信したものを送り返すルーターがつながっている等)。
+        # 送信元が付けた seq ごと比較するので、値が変わらない正当な繰り返し (HEARTBEAT など) は捨てない
+        now = time.monotonic()
+        while self._recent_order and now - self._recent_order[0][0] > DEDUP_TTL:
+            seen, old = self._recent_order.popleft()
+            if self._recent.get(old) == seen:
+                del self._recent[old]
+        key = (msg.get_srcSystem(), msg.get_srcComponent(), msg.get_seq(), msg.get_msgId())
+        if key in self._recent:
+            self.duplicates += 1
+            return True
+        self._recent[key] = now
+        self._recent_order.append((now, key))
+        return False
+
+    def _route(self, source, msg):
+        if msg.get_type() == "BAD_DATA":
+            return
+        if self._duplicate(msg):
+            return
+        frame = msg.get_msgbuf()
+        source.rx += 1
+        source.systems.add((msg.get_srcSystem(), msg.get_srcComponent()))
+        target_system = getattr(msg, "target_system", 0)
+        target_component = getattr(msg, "target_component", 0)
+        for link in [self.vehicle] + self.endpoints:
+            if link is source:
+                continue
+            if target_system and not link.knows(target_system, target_component):
+                continue
+            link.pending += frame
+            link.tx += 1
+
+    def from_vehicle(self, msg):
+        """機体から受信したメッセージ (mavlink_reader で解析済み) をエンドポイントへ"""
+        self._route(self.vehicle, msg)
+
+    def poll(self):
+        """エンドポイントからの受信を読み、機体と他のエンドポイントへ振り分けて送信する (1 tick に 1 回)"""
+        for link in self.endpoints:
+            for _ in range(MAX_READ_PER_TICK):
+                try:
+                    msg = link.conn.recv_msg()
+                except OSError:
+                    link.errors += 1
+                    break
+                if msg is None:
+                    break
+                self._route(link, msg)
+        for link in [self.vehicle] + self.endpoints:
+            link.flush()
+
+    def status(self):
+        return {"vehicle": self.vehicle.status() if self.vehicle else None,
+                "endpoints": [link.status() for link in self.endpoints],
+                "duplicates": self.duplicates}
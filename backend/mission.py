@@ -0,0 +1,336 @@
+"""ミッション転送 (MAVLink mission protocol, MISSION_ITEM_INT)
+
+- アップロード: MISSION_COUNT を送り、機体からの MISSION_REQUEST(_INT) に受信ハンドラ内で即座に応答する。
+  要求された item の先 window 件まで先送りし、往復待ちを減らす
+- ダウンロード: MISSION_COUNT 受信後、MISSION_REQUEST_INT を window 件まで同時に投げてパイプライン化し、
+  応答のない item だけを個別にタイムアウト/再送する
+- 進捗は notify(dict) で WebSocket へ通知する
+mission_type を指定すればフェンス / ラリーポイントの転送にも使える
+"""
+import asyncio
+import logging
+import time
+
+from mavlink_dialect import mavlink
+
+MISSION_FIELDS = ("seq", "frame", "command", "current", "autocontinue",
+                  "param1", "param2", "param3", "param4", "x", "y", "z")
+
+log = logging.getLogger("mission")
+
+
+def make_item(seq, lat, lon, alt=0.0, command=mavlink.MAV_CMD_NAV_WAYPOINT,
+              frame=mavlink.MAV_FRAME_GLOBAL_RELATIVE_ALT_INT,
+              param1=0.0, param2=0.0, param3=0.0, param4=0.0):
+    return {"seq": seq, "frame": frame, "command": command, "current": 0, "autocontinue": 1,
+            "param1": param1, "param2": param2, "param3": param3, "param4": param4,
+            "x": int(lat * 1e7), "y": int(lon * 1e7), "z": float(alt)}
+
+
+def waypoints_to_items(waypoints):
+    """[{lat, lon, alt?, command?}, ...] を seq 0 (ホーム) 付きのミッションに変換する
+
+    ArduPilot は seq 0 をホーム位置として扱い上書きするため、先頭の座標をダミーとして入れる
+    """
+    if not waypoints:
+        return []
+    first = waypoints[0]
+    items = [make_item(0, first["lat"], first["lon"], frame=mavlink.MAV_FRAME_GLOBAL)]
+    for i, wp in enumerate(waypoints, start=1):
+        items.append(make_item(i, wp["lat"], wp["lon"], wp.get("alt", 0.0),
+                               command=wp.get("command", mavlink.MAV_CMD_NAV_WAYPOINT)))
+    return items
+
+
+class MissionTransferError(Exception):
+    pass
+
+
+def retry_timeout(rtt, item_timeout):
+    """item_timeout 未指定なら、最初の応答で測った往復時間から再送タイムアウトを決める"""
+    if item_timeout is not None:
+        return item_timeout
+    return 1.0 if rtt is None else min(2.0, max(0.2, 3 * rtt))
+
+
+class MissionManager:
+    def __init__(self, notify=None):
+        self.notify = notify or (lambda event: None)
+        self.mav = None
+        self.items = []           # 最後に機体と同期したミッション (dict のリスト)
+        self._lock = asyncio.Lock()
+        self._transfer = None     # 実行中の転送状態
+        self._activity = asyncio.Event()
+
+    def attach(self, mav):
+        self.mav = mav
+
+    # --- MAVLink 受信 ---
+
+    def handle_message(self, msg):
+        transfer = self._transfer
+        if transfer is None:
+            return
+        msg_type = msg.get_type()
+        if msg_type not in ("MISSION_REQUEST_INT", "MISSION_REQUEST", "MISSION_COUNT",
+                            "MISSION_ITEM_INT", "MISSION_ACK"):
+            return
+        if getattr(msg, "mission_type", 0) != transfer["mission_type"]:
+            return
+
+        if transfer["direction"] == "upload":
+            if msg_type in ("MISSION_REQUEST_INT", "MISSION_REQUEST"):
+                self._answer_request(transfer, msg.seq)
+            elif msg_type == "MISSION_COUNT":
+                # 最終 ACK ロス確認の応答: 件数が一致すれば受理済みとみなす
+                if transfer["probing"] and msg.count == len(transfer["items"]):
+                    transfer["ack"] = mavlink.MAV_MISSION_ACCEPTED
+            elif msg_type == "MISSION_ACK":
+                if transfer["probing"] and msg.type == mavlink.MAV_MISSION_DENIED:
+                    # 確認要求への応答 (まだ受信中)
+                    pass
+                elif msg.type == mavlink.MAV_MISSION_INVALID_SEQUENCE:
+                    # 先送りした item が機体の待っている item を追い越した (= 途中の item が落ちた)。
+                    # 転送自体は継続しているので、機体の再要求を待たずに送り直す (連続した NACK では半往復に 1 回まで)
+                    now = time.monotonic()
+                    if transfer["last_seq"] is not None and now - transfer["resent_at"] > (transfer["rtt"] or 0.5) * 0.5:
+                        transfer["resent_at"] = now
+                        self._resend_window(transfer)
+                else:
+                    transfer["ack"] = msg.type
+        elif transfer["direction"] == "clear":
+            if msg_type == "MISSION_ACK":
+                transfer["ack"] = msg.type
+        else:
+            if msg_type == "MISSION_COUNT":
+                transfer["count"] = msg.count
+            elif msg_type == "MISSION_ITEM_INT":
+                if transfer["count"] is not None and 0 <= msg.seq < transfer["count"]:
+                    transfer["items"][msg.seq] = {f: getattr(msg, f) for f in MISSION_FIELDS}
+        transfer["last_rx"] = time.monotonic()
+        self._activity.set()
+
+    def _answer_request(self, transfer, seq):
+        """要求された item を送り、window 件先まで先送りする
+
+        機体は seq 順に item を受け付けるので、先送りした item は要求が追いつき次第そのまま採用され、
+        1 往復ごとに 1 件という往復待ちがなくなる。再要求 (ロス) の場合はそこから送り直す。
+        応答の遅れがそのまま転送時間になるので、受信ハンドラ内で待たずに送る
+        """
+        items = transfer["items"]
+        if not 0 <= seq < len(items):
+            return
+        # 往復時間: item seq-1 を最初に送ってから seq が要求されるまで (過大評価にしかならないので最小値を取る)
+        now = time.monotonic()
+        sent = transfer["count_sent"] if seq == 0 else transfer["first_sent"].get(seq - 1)
+        if sent is not None:
+            sample = now - sent
+            transfer["rtt"] = sample if transfer["rtt"] is None else min(transfer["rtt"], sample)
+        retry = transfer["last_seq"] is not None and seq <= transfer["last_seq"]
+        transfer["requested"].add(seq)
+        transfer["last_seq"] = seq
+        if retry:
+            # NACK で送り直した直後の重複した再要求では送らない
+            if now - transfer["resent_at"] > (transfer["rtt"] or 0.5) * 0.5:
+                transfer["resent_at"] = now
+                self._resend_window(transfer)
+        else:
+            end = min(len(items), seq + transfer["window"])
+            for i in range(max(seq, transfer["sent_upto"] + 1), end):
+                self._send_item(items[i], transfer["mission_type"])
+                transfer["first_sent"].setdefault(i, now)
+            transfer["sent_upto"] = max(transfer["sent_upto"], end - 1)
+        transfer["attempts"] = 0
+
+    def _resend_window(self, transfer):
+        items = transfer["items"]
+        last_seq = transfer["last_seq"]
+        end = min(len(items), last_seq + transfer["window"])
+        now = time.monotonic()
+        for i in range(last_seq, end):
+            self._send_item(items[i], transfer["mission_type"])
+            transfer["first_sent"].setdefault(i, now)
+        transfer["sent_upto"] = end - 1
+
+    def _send_item(self, item, mission_type):
+        mav = self.mav
+        mav.mav.mission_item_int_send(
+            mav.target_system, mav.target_component,
+            item["seq"], item["frame"], item["command"], item["current"], item["autocontinue"],
+            item["param1"], item["param2"], item["param3"], item["param4"],
+            item["x"], item["y"], item["z"], mission_type,
+        )
+
+    async def _wait_activity(self, timeout):
+        self._activity.clear()
+        try:
+            await asyncio.wait_for(self._activity.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _progress(self, direction, done, total, **extra):
+        self.notify({"type": "MISSION_PROGRESS",
+                     "data": {"direction": direction, "done": done, "total": total, **extra}})
+
+    # --- アップロード ---
+
+    async def upload(self, items, mission_type=mavlink.MAV_MISSION_TYPE_MISSION,
+                     window=24, item_timeout=None, retries=10):
+        if self.mav is None:
+            raise MissionTransferError("No connection")
+        # 機体が要求する seq は items の位置なので、seq が位置と違うと別の item を送ってしまう
+        misplaced = [i for i, item in enumerate(items) if item["seq"] != i]
+        if misplaced:
+            raise MissionTransferError(f"item seq must match its position (mismatch at {misplaced[:10]})")
+        async with self._lock:
+            mav = self.mav
+            started = time.monotonic()
+            transfer = self._transfer = {
+                "direction": "upload", "mission_type": mission_type, "items": items,
+                "window": max(1, window), "requested": set(), "last_seq": None, "sent_upto": -1,
+                "ack": None, "attempts": 0, "last_rx": started, "count_sent": started, "rtt": None,
+                "resent_at": 0.0, "probing": False, "first_sent": {},
+            }
+            try:
+                mav.mav.mission_count_send(mav.target_system, mav.target_component, len(items), mission_type)
+                last_notify = 0.0
+                while transfer["ack"] is None:
+                    await self._wait_activity(0.1)
+                    now = time.monotonic()
+                    if now - last_notify >= 0.25:
+                        last_notify = now
+                        self._progress("upload", len(transfer["requested"]), len(items))
+                    if now - transfer["last_rx"] < retry_timeout(transfer["rtt"], item_timeout):
+                        continue
+
+                    # 機体からの要求が途絶えた: 要求前なら MISSION_COUNT を、途中なら直近の要求から window 件を再送
+                    # (機体が待っている item がどれでも、その先も含めてまとめて届く)
+                    transfer["attempts"] += 1
+                    if transfer["attempts"] > retries:
+                        raise MissionTransferError(
+                            f"upload timed out ({len(transfer['requested'])}/{len(items)} items requested)")
+                    if transfer["last_seq"] is None:
+                        mav.mav.mission_count_send(mav.target_system, mav.target_component,
+                                                   len(items), mission_type)
+                        transfer["count_sent"] = now
+                    else:
+                        self._resend_window(transfer)
+                        if transfer["last_seq"] == len(items) - 1 and transfer["attempts"] >= 2:
+                            # 最後の item まで要求されたのに ACK が来ない: ACK が落ちた可能性があるので
+                            # 機体のミッション件数を問い合わせて確認する
+                            transfer["probing"] = True
+                            mav.mav.mission_request_list_send(mav.target_system, mav.target_component,
+                                                              mission_type)
+                    transfer["last_rx"] = now
+            finally:
+                self._transfer = None
+
+            if transfer["ack"] != mavlink.MAV_MISSION_ACCEPTED:
+                result = mavlink.enums["MAV_MISSION_RESULT"].get(transfer["ack"])
+                raise MissionTransferError(f"upload rejected: {result.name if result else transfer['ack']}")
+
+            if mission_type == mavlink.MAV_MISSION_TYPE_MISSION:
+                self.items = list(items)
+            elapsed = time.monotonic() - started
+            log.info("Uploaded %d items in %.2fs", len(items), elapsed)
+            self._progress("upload", len(items), len(items), finished=True)
+            return {"count": len(items), "elapsed": elapsed}
+
+    # --- ダウンロード ---
+
+    async def download(self, mission_type=mavlink.MAV_MISSION_TYPE_MISSION,
+                       window=16, item_timeout=None, retries=10):
+        if self.mav is None:
+            raise MissionTransferError("No connection")
+        async with self._lock:
+            mav = self.mav
+            started = time.monotonic()
+            transfer = self._transfer = {
+                "direction": "download", "mission_type": mission_type,
+                "count": None, "items": {}, "last_rx": started,
+            }
+            try:
+                # 1. 件数を取得
+                for _ in range(retries):
+                    sent = time.monotonic()
+                    mav.mav.mission_request_list_send(mav.target_system, mav.target_component, mission_type)
+                    deadline = sent + retry_timeout(None, item_timeout)
+                    while transfer["count"] is None and time.monotonic() < deadline:
+                        await self._wait_activity(deadline - time.monotonic())
+                    if transfer["count"] is not None:
+                        break
+                else:
+                    raise MissionTransferError("no MISSION_COUNT from vehicle")
+                count = transfer["count"]
+                timeout = retry_timeout(time.monotonic() - sent, item_timeout)
+
+                # 2. window 件まで要求を先行送信し、タイムアウトした seq だけ再要求する
+                sent_at = {}
+                attempts = {}
+                next_seq = 0
+                last_notify = 0.0
+                received = transfer["items"]
+                while len(received) < count:
+                    now = time.monotonic()
+                    for seq in [s for s in sent_at if s in received]:
+                        del sent_at[seq]
+                    for seq, t in list(sent_at.items()):
+                        if now - t >= timeout:
+                            attempts[seq] += 1
+                            if attempts[seq] > retries:
+                                raise MissionTransferError(f"item {seq} not received after {retries} retries")
+                            mav.mav.mission_request_int_send(mav.target_system, mav.target_component,
+                                                             seq, mission_type)
+                            sent_at[seq] = now
+                    while next_seq < count and len(sent_at) < window:
+                        if next_seq not in received:
+                            mav.mav.mission_request_int_send(mav.target_system, mav.target_component,
+                                                             next_seq, mission_type)
+                            sent_at[next_seq] = now
+                            attempts[next_seq] = 0
+                        next_seq += 1
+                    if now - last_notify >= 0.25:
+                        last_notify = now
+                        self._progress("download", len(received), count)
+                    await self._wait_activity(0.05)
+
+                mav.mav.mission_ack_send(mav.target_system, mav.target_component,
+                                         mavlink.MAV_MISSION_ACCEPTED, mission_type)
+            finally:
+                self._transfer = None
+
+            items = [received[seq] for seq in range(count)]
+            if mission_type == mavlink.MAV_MISSION_TYPE_MISSION:
+                self.items = items
+            elapsed = time.monotonic() - started
+            log.info("Downloaded %d items in %.2fs", count, elapsed)
+            self._progress("download", count, count, finished=True)
+            return {"count": count, "elapsed": elapsed, "items": items}
+
+    async def clear(self, mission_type=mavlink.MAV_MISSION_TYPE_MISSION, item_timeout=None, retries=10):
+        """MISSION_CLEAR_ALL を送り、MISSION_ACK が来るまで再送する (何度送っても結果は同じ)"""
+        if self.mav is None:
+            raise MissionTransferError("No connection")
+        async with self._lock:
+            mav = self.mav
+            transfer = self._transfer = {
+                "direction": "clear", "mission_type": mission_type, "ack": None, "last_rx": time.monotonic(),
+            }
+            try:
+                for _ in range(retries):
+                    mav.mav.mission_clear_all_send(mav.target_system, mav.target_component, mission_type)
+                    deadline = time.monotonic() + retry_timeout(None, item_timeout)
+                    while transfer["ack"] is None and time.monotonic() < deadline:
+                        await self._wait_activity(deadline - time.monotonic())
+                    if transfer["ack"] is not None:
+                        break
+                else:
+                    raise MissionTransferError("no MISSION_ACK for clear from vehicle")
+            finally:
+                self._transfer = None
+
+            if transfer["ack"] != mavlink.MAV_MISSION_ACCEPTED:
+                result = mavlink.enums["MAV_MISSION_RESULT"].get(transfer["ack"])
+                raise MissionTransferError(f"clear rejected: {result.name if result else transfer['ack']}")
+            if mission_type == mavlink.MAV_MISSION_TYPE_MISSION:
+                self.items = []
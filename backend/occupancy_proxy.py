@@ -0,0 +1,57 @@
+"""Webots の占有格子地図 (ardupilot_vehicle_controller.py --occupancy-port) をフロントエンドへ中継する
+
+コントローラは Windows 側で動くので、ブラウザからは直接見えない。バックエンドが OCCUPANCY_URL
+(例 "http://172.30.96.1:5620") から取得して返す。
+
+- /api/occupancy/meta?since=V: 地図の情報と、版 V より後に変わったタイルの一覧
+- /api/occupancy/tiles/{i}/{j}.png?v=...: タイル画像。URL に版が入るので、ブラウザは変わったタイルだけを取り直す
+"""
+import asyncio
+import json
+import logging
+import os
+import urllib.error
+import urllib.request
+
+log = logging.getLogger("occupancy_proxy")
+
+FETCH_TIMEOUT = 2.0
+
+
+class OccupancyUnavailable(Exception):
+    """OCCUPANCY_URL が未設定、またはコントローラに繋がらない"""
+
+
+class OccupancyProxy:
+    def __init__(self, url):
+        self.url = url.rstrip("/") if url else None
+
+    @property
+    def enabled(self):
+        return self.url is not None
+
+    def _fetch(self, path):
+        try:
+            with urllib.request.urlopen(self.url + path, timeout=FETCH_TIMEOUT) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise KeyError(path)
+            raise OccupancyUnavailable(str(e))
+        except OSError as e:
+            raise OccupancyUnavailable(str(e))
+
+    async def meta(self, since=0):
+        if not self.enabled:
+            raise OccupancyUnavailable("OCCUPANCY_URL is not set")
+        data = await asyncio.get_running_loop().run_in_executor(None, self._fetch, f"/meta?since={int(since)}")
+        return json.loads(data)
+
+    async def tile(self, i, j):
+        if not self.enabled:
+            raise OccupancyUnavailable("OCCUPANCY_URL is not set")
+        return await asyncio.get_running_loop().run_in_executor(None, self._fetch, f"/tiles/{int(i)}/{int(j)}.png")
+
+
+def from_env():
+    return OccupancyProxy(os.environ.get("OCCUPANCY_URL"))
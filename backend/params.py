@@ -0,0 +1,269 @@
+"""パラメータ管理 (一括ダウンロード / ディスクキャッシュ / 差分アップロード)
+
+- PARAM_REQUEST_LIST で一括取得し、欠番 index は PARAM_REQUEST_READ で個別に再要求する
+- 取得結果は機体 (sysid) とファームウェアごとに JSON でキャッシュし、再接続時は即座に読み込む
+- mav.parm 形式のファイルとの差分だけを PARAM_SET し、同時送信数 (in-flight) を制限してパイプライン化する
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+
+from mavlink_dialect import mavlink
+
+# float32 に丸められた値と比較するための許容誤差
+_REL_TOLERANCE = 1e-5
+
+log = logging.getLogger("params")
+
+
+def parse_param_file(text):
+    """mav.parm / Mission Planner (.param) 形式のテキストを {name: value} に変換する"""
+    values = {}
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        parts = re.split(r"[\s,]+", line)
+        if len(parts) < 2:
+            continue
+        try:
+            values[parts[0]] = float(parts[1])
+        except ValueError:
+            continue
+    return values
+
+
+def values_equal(a, b):
+    return abs(a - b) <= _REL_TOLERANCE * max(1.0, abs(a), abs(b))
+
+
+class ParamManager:
+    def __init__(self, cache_dir, notify=None):
+        """
+        cache_dir: キャッシュ JSON の保存先
+        notify: 進捗などをフロントエンドへ通知するコールバック notify(dict)
+        """
+        self.cache_dir = cache_dir
+        self.notify = notify or (lambda event: None)
+        self.mav = None
+        self.params = {}       # name -> value
+        self.types = {}        # name -> MAV_PARAM_TYPE
+        self.count = 0         # 機体が報告するパラメータ総数
+        self.source = None     # "cache" | "vehicle" | None
+        self.firmware = None
+        self.vehicle_key = None
+        self._received = set()
+        self._incoming = None  # ダウンロード中に受信した ({name: value}, {name: type})。成功したら差し替える
+        self._last_rx = 0.0
+        self._pending = {}     # name -> asyncio.Future (PARAM_SET の応答待ち)
+        self._version_event = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    # --- MAVLink 受信 ---
+
+    def handle_message(self, msg):
+        msg_type = msg.get_type()
+        if msg_type == "PARAM_VALUE":
+            name = msg.param_id
+            if isinstance(name, bytes):
+                name = name.decode(errors="ignore")
+            name = name.rstrip("\x00")
+            self.params[name] = float(msg.param_value)
+            self.types[name] = msg.param_type
+            if self._incoming is not None:
+                self._incoming[0][name] = float(msg.param_value)
+                self._incoming[1][name] = msg.param_type
+            if msg.param_count and msg.param_count != 0xFFFF:
+                self.count = msg.param_count
+            if 0 <= msg.param_index < 0xFFFF:
+                self._received.add(msg.param_index)
+            self._last_rx = time.monotonic()
+
+            future = self._pending.get(name)
+            if future is not None and not future.done():
+                future.set_result(float(msg.param_value))
+        elif msg_type == "AUTOPILOT_VERSION":
+            v = msg.flight_sw_version
+            self.firmware = f"{v >> 24 & 0xFF}.{v >> 16 & 0xFF}.{v >> 8 & 0xFF}"
+            self._version_event.set()
+
+    # --- 接続 / キャッシュ ---
+
+    async def attach(self, mav):
+        """MAVLink 接続確立後に呼ぶ。ファームウェアを確認してキャッシュを読み込む"""
+        self.mav = mav
+        self.firmware = None
+        self._version_event.clear()
+        mav.mav.command_long_send(
+            mav.target_system, mav.target_component,
+            mavlink.MAV_CMD_REQUEST_MESSAGE, 0,
+            mavlink.MAVLINK_MSG_ID_AUTOPILOT_VERSION, 0, 0, 0, 0, 0, 0,
+        )
+        try:
+            await asyncio.wait_for(self._version_event.wait(), timeout=2.0)
+        except asyncio.TimeoutError:
+            pass
+
+        self.vehicle_key = f"sys{mav.target_system}_{self.firmware or 'unknown'}"
+        if self.load_cache():
+            log.info("Loaded %d params from cache (%s)", len(self.params), self.vehicle_key)
+            # 総数だけ安価に確認し、変わっていれば取り直す
+            self.count = 0
+            mav.mav.param_request_read_send(mav.target_system, mav.target_component, b"", 0)
+            await asyncio.sleep(1.0)
+            if self.count and self.count != len(self.params):
+                log.info("Param count changed (%d -> %d), downloading", len(self.params), self.count)
+                asyncio.create_task(self.download())
+
+    def _cache_path(self):
+        return os.path.join(self.cache_dir, f"params_{self.vehicle_key}.json")
+
+    def load_cache(self):
+        try:
+            with open(self._cache_path(), "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+        self.params = {k: float(v) for k, v in data.get("params", {}).items()}
+        self.types = {k: int(v) for k, v in data.get("types", {}).items()}
+        self.count = len(self.params)
+        self.source = "cache"
+        return True
+
+    def save_cache(self):
+        # attach() が機体を確認する前はキャッシュの置き場所が決まらない
+        if self.vehicle_key is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self._cache_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "vehicle": self.vehicle_key,
+                "saved_at": time.time(),
+                "params": self.params,
+                "types": self.types,
+            }, f)
+        os.replace(tmp_path, self._cache_path())
+
+    def snapshot(self):
+        return {"source": self.source, "vehicle": self.vehicle_key,
+                "count": len(self.params), "params": dict(sorted(self.params.items()))}
+
+    # --- ダウンロード ---
+
+    async def download(self, stall_timeout=0.5, batch=50, max_rounds=40):
+        """全パラメータを取得する。欠番は個別に再要求して埋める
+
+        取得中は新しい表に集め、全件揃ってから差し替える (失敗しても今の表は残る)
+        """
+        if self.mav is None:
+            raise RuntimeError("No connection")
+        async with self._lock:
+            mav = self.mav
+            self._received.clear()
+            self.count = 0
+            incoming = self._incoming = ({}, {})
+            self._last_rx = time.monotonic()
+            started = time.monotonic()
+            mav.mav.param_request_list_send(mav.target_system, mav.target_component)
+
+            try:
+                rounds = 0
+                last_notify = 0.0
+                while not (self.count and len(self._received) >= self.count):
+                    await asyncio.sleep(0.05)
+                    now = time.monotonic()
+                    if now - last_notify >= 0.25:
+                        last_notify = now
+                        self.notify({"type": "PARAM_PROGRESS",
+                                     "data": {"received": len(self._received), "total": self.count}})
+                    if now - self._last_rx < stall_timeout:
+                        continue
+
+                    # 受信が途切れた: 欠番を要求 (総数不明ならリスト要求からやり直す)
+                    rounds += 1
+                    if rounds > max_rounds:
+                        raise TimeoutError(f"param download incomplete ({len(self._received)}/{self.count})")
+                    if not self.count:
+                        mav.mav.param_request_list_send(mav.target_system, mav.target_component)
+                    else:
+                        missing = [i for i in range(self.count) if i not in self._received][:batch]
+                        for index in missing:
+                            mav.mav.param_request_read_send(mav.target_system, mav.target_component, b"", index)
+                    self._last_rx = now
+            finally:
+                self._incoming = None
+
+            self.params, self.types = incoming
+            self.source = "vehicle"
+            self.save_cache()
+            elapsed = time.monotonic() - started
+            log.info("Downloaded %d params in %.1fs (%d gap-fill rounds)", len(self.params), elapsed, rounds)
+            self.notify({"type": "PARAM_PROGRESS",
+                         "data": {"received": len(self._received), "total": self.count, "done": True}})
+            return self.snapshot()
+
+    # --- 差分アップロード ---
+
+    def diff(self, values):
+        """values のうち現在値と異なるもの (未知の名前は unknown) を返す"""
+        changed = {}
+        unknown = []
+        for name, value in values.items():
+            if name not in self.params:
+                unknown.append(name)
+            elif not values_equal(self.params[name], value):
+                changed[name] = {"current": self.params[name], "new": value}
+        return {"changed": changed, "unknown": unknown}
+
+    async def set_params(self, values, max_in_flight=8, timeout=1.0, retries=3):
+        """PARAM_SET を同時 max_in_flight 件までパイプライン送信し、PARAM_VALUE のエコーで確認する"""
+        if self.mav is None:
+            raise RuntimeError("No connection")
+        mav = self.mav
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max_in_flight)
+        results = {}
+        done = 0
+
+        async def set_one(name, value):
+            nonlocal done
+            async with semaphore:
+                param_type = self.types.get(name, mavlink.MAV_PARAM_TYPE_REAL32)
+                for _ in range(retries):
+                    future = loop.create_future()
+                    self._pending[name] = future
+                    mav.mav.param_set_send(mav.target_system, mav.target_component,
+                                           name.encode(), float(value), param_type)
+                    try:
+                        echoed = await asyncio.wait_for(future, timeout)
+                    except asyncio.TimeoutError:
+                        continue
+                    finally:
+                        self._pending.pop(name, None)
+                    if values_equal(echoed, value):
+                        results[name] = "ok"
+                        break
+                    # 範囲外などで機体が値を受け付けなかった
+                    results[name] = f"rejected (vehicle value {echoed})"
+                    break
+                else:
+                    results[name] = "timeout"
+                done += 1
+                self.notify({"type": "PARAM_UPLOAD_PROGRESS", "data": {"done": done, "total": len(values)}})
+
+        await asyncio.gather(*(set_one(n, v) for n, v in values.items()))
+        if self.source is not None:
+            self.save_cache()
+        return results
+
+    async def upload_diff(self, values, dry_run=False, **kwargs):
+        """現在値と異なるパラメータだけをアップロードする"""
+        diff = self.diff(values)
+        if dry_run or not diff["changed"]:
+            return {**diff, "results": {}}
+        results = await self.set_params({n: c["new"] for n, c in diff["changed"].items()}, **kwargs)
+        return {**diff, "results": results}
@@ -0,0 +1,228 @@
+"""バックエンド単体テスト用の簡易機体 (SITL なしでミッション / パラメータ転送を試す)
+
+HEARTBEAT と基本的なテレメトリを送り、mission / parameter protocol、SET_MESSAGE_INTERVAL、
+RC_CHANNELS_OVERRIDE (RC_CHANNELS に反映)、TIMESYNC / PING に応答する。
+--loss / --latency / --jitter で LTE 回線のようなパケットロスと遅延 (ゆらぎによる順序入れ替わり) を再現できる。
+
+    python sim_vehicle.py --loss 0.1 --latency 0.08 --jitter 0.02
+    # 別ターミナルで backend を起動し、/api/mission/* や /api/params/* を叩く
+"""
+import argparse
+import heapq
+import os
+import random
+import threading
+import time
+
+# 実機 (ArduPilot) と同じく MAVLink2 で話す (mission_type などの拡張フィールドが必要)
+os.environ.setdefault("MAVLINK20", "1")
+from pymavlink import mavutil  # noqa: E402
+
+import params  # noqa: E402
+
+
+class SimVehicle:
+    def __init__(self, connection, loss=0.0, latency=0.0, param_file=None, jitter=0.0):
+        self.conn = mavutil.mavlink_connection(connection, source_system=1, source_component=1)
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.params = {}
+        if param_file and os.path.exists(param_file):
+            with open(param_file, "r") as f:
+                self.params = params.parse_param_file(f.read())
+        self.param_names = list(self.params)
+        self.missions = {}     # mission_type -> items
+        self.upload = None     # 受信中のミッション {"type", "count", "items", "last"}
+        self.gcs = (255, 190)  # 応答の宛先 (直近に受信した GCS の sysid, compid)
+        # テレメトリ: msg_id -> 送信間隔 (s)。既定は ArduPilot の SRx_ 既定値程度
+        self.intervals = {
+            mavutil.mavlink.MAVLINK_MSG_ID_ATTITUDE: 0.25,
+            mavutil.mavlink.MAVLINK_MSG_ID_GLOBAL_POSITION_INT: 0.25,
+            mavutil.mavlink.MAVLINK_MSG_ID_SYS_STATUS: 0.5,
+            mavutil.mavlink.MAVLINK_MSG_ID_VFR_HUD: 0.25,
+            mavutil.mavlink.MAVLINK_MSG_ID_RC_CHANNELS: 0.25,
+            mavutil.mavlink.MAVLINK_MSG_ID_SYSTEM_TIME: 1.0,
+        }
+        self.rc = [1500] * 8   # RC_CHANNELS_OVERRIDE で上書きされたチャンネル値
+        self._next_telemetry = {}
+        self._outbox = []      # (送信時刻, 連番, bytes)
+        self._outbox_seq = 0
+        self._outbox_lock = threading.Condition()
+        threading.Thread(target=self._sender, daemon=True).start()
+
+    # --- 送信 (ロスと遅延を付加) ---
+
+    def send(self, msg):
+        if random.random() < self.loss:
+            return
+        data = msg.pack(self.conn.mav)
+        self.conn.mav.seq = (self.conn.mav.seq + 1) % 256
+        with self._outbox_lock:
+            self._outbox_seq += 1
+            delay = self.latency + random.uniform(0.0, self.jitter)
+            heapq.heappush(self._outbox, (time.monotonic() + delay, self._outbox_seq, data))
+            self._outbox_lock.notify()
+
+    def _sender(self):
+        while True:
+            with self._outbox_lock:
+                while not self._outbox:
+                    self._outbox_lock.wait()
+                due, _, data = self._outbox[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._outbox_lock.wait(delay)
+                    continue
+                heapq.heappop(self._outbox)
+            self.conn.write(data)
+
+    # --- 受信処理 ---
+
+    def handle(self, msg):
+        m = self.conn.mav
+        msg_type = msg.get_type()
+        mission_type = getattr(msg, "mission_type", 0)
+        if msg_type != "BAD_DATA":
+            self.gcs = (msg.get_srcSystem(), msg.get_srcComponent())
+
+        if msg_type == "PARAM_REQUEST_LIST":
+            for i in range(len(self.param_names)):
+                self.send_param(i)
+        elif msg_type == "PARAM_REQUEST_READ":
+            if 0 <= msg.param_index < len(self.param_names):
+                self.send_param(msg.param_index)
+            elif msg.param_id in self.params:
+                self.send_param(self.param_names.index(msg.param_id))
+        elif msg_type == "PARAM_SET":
+            if msg.param_id in self.params:
+                self.params[msg.param_id] = msg.param_value
+                self.send_param(self.param_names.index(msg.param_id))
+        elif msg_type == "RC_CHANNELS_OVERRIDE":
+            for i in range(8):
+                value = getattr(msg, f"chan{i + 1}_raw")
+                # 0: 上書き解除, 65535: 変更なし
+                if value == 0:
+                    self.rc[i] = 1500
+                elif value != 65535:
+                    self.rc[i] = value
+        elif msg_type == "TIMESYNC" and msg.tc1 == 0:
+            # ArduPilot と同じく tc1 に自分の時刻を入れ、ts1 はそのまま返す
+            self.send(m.timesync_encode(time.monotonic_ns(), msg.ts1))
+        elif msg_type == "PING" and msg.target_system == 0:
+            self.send(m.ping_encode(msg.time_usec, msg.seq, msg.get_srcSystem(), msg.get_srcComponent()))
+        elif msg_type == "COMMAND_LONG" and msg.command == mavutil.mavlink.MAV_CMD_SET_MESSAGE_INTERVAL:
+            msg_id, interval = int(msg.param1), msg.param2
+            if msg_id in self.intervals:
+                self.intervals[msg_id] = None if interval < 0 else interval / 1e6
+                result = mavutil.mavlink.MAV_RESULT_ACCEPTED
+            else:
+                result = mavutil.mavlink.MAV_RESULT_DENIED
+            self.send(m.command_ack_encode(msg.command, result, 0, 0, *self.gcs))
+        elif msg_type == "COMMAND_LONG" and msg.command == mavutil.mavlink.MAV_CMD_REQUEST_MESSAGE:
+            if int(msg.param1) == mavutil.mavlink.MAVLINK_MSG_ID_AUTOPILOT_VERSION:
+                self.send(m.autopilot_version_encode(0, (4 << 24) | (5 << 16) | (7 << 8), 0, 0, 0,
+                                                     b"\0" * 8, b"\0" * 8, b"\0" * 8, 0, 0, 0))
+
+        # ミッション (ダウンロード側: GCS から要求された item を返す)
+        elif msg_type == "MISSION_REQUEST_LIST":
+            if self.upload is not None:
+                self.send(m.mission_ack_encode(*self.gcs, mavutil.mavlink.MAV_MISSION_DENIED, mission_type))
+                return
+            self.send(m.mission_count_encode(*self.gcs, len(self.missions.get(mission_type, [])), mission_type))
+        elif msg_type in ("MISSION_REQUEST_INT", "MISSION_REQUEST") and self.upload is None:
+            items = self.missions.get(mission_type, [])
+            if 0 <= msg.seq < len(items):
+                self.send(m.mission_item_int_encode(*self.gcs, *items[msg.seq], mission_type))
+        elif msg_type == "MISSION_CLEAR_ALL":
+            self.missions[mission_type] = []
+            self.send(m.mission_ack_encode(*self.gcs, mavutil.mavlink.MAV_MISSION_ACCEPTED, mission_type))
+
+        # ミッション (アップロード側: 機体が1件ずつ要求する)
+        elif msg_type == "MISSION_COUNT":
+            self.upload = {"type": mission_type, "count": msg.count, "items": [], "last": time.monotonic()}
+            self.request_next()
+        elif msg_type == "MISSION_ITEM_INT" and self.upload is not None:
+            upload = self.upload
+            if msg.seq != len(upload["items"]):
+                # ArduPilot と同じく、要求中でない item は INVALID_SEQUENCE で無視する
+                self.send(m.mission_ack_encode(*self.gcs, mavutil.mavlink.MAV_MISSION_INVALID_SEQUENCE,
+                                               upload["type"]))
+                return
+            upload["items"].append((msg.seq, msg.frame, msg.command, msg.current, msg.autocontinue,
+                                    msg.param1, msg.param2, msg.param3, msg.param4, msg.x, msg.y, msg.z))
+            self.request_next()
+
+    def send_telemetry(self, now):
+        m = self.conn.mav
+        for msg_id, interval in self.intervals.items():
+            if interval is None or now < self._next_telemetry.get(msg_id, 0.0):
+                continue
+            self._next_telemetry[msg_id] = now + interval
+            boot_ms = int(now * 1000) & 0xFFFFFFFF
+            if msg_id == mavutil.mavlink.MAVLINK_MSG_ID_ATTITUDE:
+                self.send(m.attitude_encode(boot_ms, 0, 0, 0, 0, 0, 0))
+            elif msg_id == mavutil.mavlink.MAVLINK_MSG_ID_GLOBAL_POSITION_INT:
+                self.send(m.global_position_int_encode(boot_ms, 356800000, 1397600000, 0, 0, 0, 0, 0, 0))
+            elif msg_id == mavutil.mavlink.MAVLINK_MSG_ID_SYS_STATUS:
+                self.send(m.sys_status_encode(0, 0, 0, 0, 12000, -1, -1, 0, 0, 0, 0, 0, 0))
+            elif msg_id == mavutil.mavlink.MAVLINK_MSG_ID_VFR_HUD:
+                self.send(m.vfr_hud_encode(0, 0, 0, 0, 0, 0))
+            elif msg_id == mavutil.mavlink.MAVLINK_MSG_ID_RC_CHANNELS:
+                self.send(m.rc_channels_encode(boot_ms, 8, *self.rc, *([65535] * 10), 255))
+            elif msg_id == mavutil.mavlink.MAVLINK_MSG_ID_SYSTEM_TIME:
+                self.send(m.system_time_encode(int(time.time() * 1e6), boot_ms))
+
+    def send_param(self, index):
+        name = self.param_names[index]
+        self.send(self.conn.mav.param_value_encode(name.encode(), self.params[name],
+                                                   mavutil.mavlink.MAV_PARAM_TYPE_REAL32,
+                                                   len(self.param_names), index))
+
+    def request_next(self):
+        upload = self.upload
+        upload["last"] = time.monotonic()
+        if len(upload["items"]) >= upload["count"]:
+            self.missions[upload["type"]] = upload["items"]
+            self.send(self.conn.mav.mission_ack_encode(*self.gcs, mavutil.mavlink.MAV_MISSION_ACCEPTED,
+                                                       upload["type"]))
+            print(f"[sim_vehicle] Mission type {upload['type']} received: {upload['count']} items")
+            self.upload = None
+            return
+        self.send(self.conn.mav.mission_request_int_encode(*self.gcs, len(upload["items"]), upload["type"]))
+
+    def run(self):
+        next_heartbeat = 0.0
+        while True:
+            now = time.monotonic()
+            if now >= next_heartbeat:
+                next_heartbeat = now + 1.0
+                self.send(self.conn.mav.heartbeat_encode(
+                    mavutil.mavlink.MAV_TYPE_GROUND_ROVER, mavutil.mavlink.MAV_AUTOPILOT_ARDUPILOTMEGA, 0, 0,
+                    mavutil.mavlink.MAV_STATE_STANDBY))
+            self.send_telemetry(now)
+            # ArduPilot と同様、要求した item が来なければ再要求する
+            if self.upload is not None and now - self.upload["last"] > 0.5:
+                self.request_next()
+
+            msg = self.conn.recv_match(blocking=True, timeout=0.005)
+            if msg is None or msg.get_type() == "BAD_DATA":
+                continue
+            if random.random() < self.loss:
+                continue
+            self.handle(msg)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Minimal MAVLink vehicle stand-in for backend testing")
+    parser.add_argument("--connection", default="udpout:127.0.0.1:14552", help="MAVLink connection string")
+    parser.add_argument("--loss", type=float, default=0.0, help="packet loss probability per direction")
+    parser.add_argument("--latency", type=float, default=0.0, help="one-way latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="extra random latency (0..JITTER s) per packet, reorders packets")
+    parser.add_argument("--params", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mav.parm"),
+                        help="parameter file served by the vehicle")
+    args = parser.parse_args()
+
+    print(f"[sim_vehicle] {args.connection} loss={args.loss} latency={args.latency}s jitter={args.jitter}s")
+    SimVehicle(args.connection, args.loss, args.latency, args.params, args.jitter).run()
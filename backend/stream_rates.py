@@ -0,0 +1,259 @@
+"""テレメトリ送信レートの調停 (MAV_CMD_SET_MESSAGE_INTERVAL)
+
+接続中のクライアントやバックエンド内部の処理がそれぞれ必要なメッセージとレートを登録し、
+その和集合 (メッセージごとの最大値) を機体に設定する。誰も必要としないメッセージは IDLE_RATES まで
+下げるので、ブラウザ未接続時の LTE 通信量を抑えられる。
+
+- 設定変更はまとめて (debounce) 送り、COMMAND_ACK が来なければ再送する。
+  ACK にはメッセージ ID が入っていないので、SET_MESSAGE_INTERVAL は 1 件ずつ ACK を待って送る
+- SET_MESSAGE_INTERVAL 非対応の機体には REQUEST_DATA_STREAM (ストリーム単位) で代用する
+- 実測レートを数え、要求から大きく外れたまま (機体の再起動など) なら設定し直す
+"""
+import asyncio
+import logging
+import math
+import time
+
+from mavlink_dialect import mavlink
+
+# バックエンドが管理するメッセージと、誰も接続していないときのレート (Hz)
+IDLE_RATES = {
+    "HEARTBEAT": None,          # 常に 1Hz (設定しない)
+    "GLOBAL_POSITION_INT": 1.0,  # ジオフェンス監視用
+    "SYS_STATUS": 0.5,
+    "ATTITUDE": 0.2,
+    "VFR_HUD": 0.2,
+    "RC_CHANNELS": 0.2,
+    "DISTANCE_SENSOR": 0.2,
+}
+
+# ブラウザ 1 クライアントあたりの既定レート (Hz)
+CLIENT_RATES = {
+    "ATTITUDE": 10.0,
+    "GLOBAL_POSITION_INT": 5.0,
+    "VFR_HUD": 4.0,
+    "SYS_STATUS": 1.0,
+    "RC_CHANNELS": 4.0,
+    "DISTANCE_SENSOR": 10.0,
+}
+
+MAX_RATE = 50.0
+
+# REQUEST_DATA_STREAM で代用するときのメッセージ -> ストリーム対応 (ArduPilot)
+DATA_STREAMS = {
+    "SYS_STATUS": mavlink.MAV_DATA_STREAM_EXTENDED_STATUS,
+    "GLOBAL_POSITION_INT": mavlink.MAV_DATA_STREAM_POSITION,
+    "RC_CHANNELS": mavlink.MAV_DATA_STREAM_RC_CHANNELS,
+    "ATTITUDE": mavlink.MAV_DATA_STREAM_EXTRA1,
+    "VFR_HUD": mavlink.MAV_DATA_STREAM_EXTRA2,
+    "DISTANCE_SENSOR": mavlink.MAV_DATA_STREAM_EXTRA3,
+}
+
+log = logging.getLogger("stream_rates")
+
+
+def message_id(name):
+    return getattr(mavlink, "MAVLINK_MSG_ID_" + name, None)
+
+
+class StreamRateManager:
+    def __init__(self, debounce=0.2, ack_timeout=1.0, retries=3, verify_window=5.0):
+        self.mav = None
+        self.debounce = debounce
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.verify_window = verify_window
+        self.subscriptions = {}   # subscriber -> {name: hz}
+        self.applied = {}         # name -> hz (機体に設定済み)
+        self.rejected = set()     # 機体が受け付けなかったメッセージ
+        self.use_data_stream = False
+        self._queue = {}          # msg_id -> (name, hz, 試行回数) 送信待ち
+        self._inflight = None     # (msg_id, name, hz, 送信時刻, 試行回数) ACK 待ちの 1 件
+        self._counts = {}         # name -> 直近ウィンドウの受信数
+        self._window_start = time.monotonic()
+        self.measured = {}        # name -> Hz (実測)
+        self._apply_handle = None
+        self._reapplied = {}      # name -> 実測ずれによる連続再設定回数
+        self._task = None
+
+    def attach(self, mav):
+        self.mav = mav
+        self.applied = {}
+        self.use_data_stream = False
+        self._queue = {}
+        self._inflight = None
+        self.schedule_apply()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    # --- 購読 ---
+
+    def subscribe(self, subscriber, rates):
+        """subscriber の必要レートを登録 (置き換え) する。未知のメッセージ名や数値でないレートは ValueError"""
+        if not isinstance(rates, dict):
+            raise ValueError("rates must be an object of {message: Hz}")
+        cleaned = {}
+        for name, hz in rates.items():
+            if message_id(name) is None:
+                raise ValueError(f"unknown message: {name}")
+            if isinstance(hz, bool) or not isinstance(hz, (int, float)) or not math.isfinite(hz):
+                raise ValueError(f"invalid rate for {name}: {hz!r}")
+            cleaned[name] = max(0.0, min(MAX_RATE, float(hz)))
+        self.subscriptions[subscriber] = cleaned
+        self._reapplied = {}
+        self.schedule_apply()
+
+    def unsubscribe(self, subscriber):
+        if self.subscriptions.pop(subscriber, None) is not None:
+            self._reapplied = {}
+            self.schedule_apply()
+
+    def wanted(self):
+        """全購読の和集合 (メッセージごとの最大レート)。IDLE_RATES を下限とする"""
+        rates = {name: hz for name, hz in IDLE_RATES.items() if hz is not None}
+        for sub in self.subscriptions.values():
+            for name, hz in sub.items():
+                rates[name] = max(rates.get(name, 0.0), hz)
+        return rates
+
+    def schedule_apply(self):
+        # クライアントの接続/切断が続いても 1 回にまとめる
+        if self.mav is None:
+            return
+        if self._apply_handle is not None:
+            self._apply_handle.cancel()
+        loop = asyncio.get_running_loop()
+        self._apply_handle = loop.call_later(self.debounce, self.apply)
+
+    # --- 機体への設定 ---
+
+    def apply(self):
+        self._apply_handle = None
+        wanted = self.wanted()
+        if self.use_data_stream:
+            self._apply_data_streams(wanted)
+            return
+        for name, hz in wanted.items():
+            if self.applied.get(name) != hz:
+                self._queue[message_id(name)] = (name, hz, 1)
+        self._send_next()
+
+    def _send_next(self):
+        """ACK 待ちがなければ、送信待ちの先頭を送る"""
+        if self._inflight is not None or not self._queue or self.mav is None:
+            return
+        msg_id = next(iter(self._queue))
+        name, hz, attempt = self._queue.pop(msg_id)
+        self._set_interval(msg_id, name, hz, attempt)
+
+    def _set_interval(self, msg_id, name, hz, attempt):
+        mav = self.mav
+        # interval: us, -1 で停止
+        interval = int(1e6 / hz) if hz > 0 else -1
+        mav.mav.command_long_send(
+            mav.target_system, mav.target_component,
+            mavlink.MAV_CMD_SET_MESSAGE_INTERVAL, 0,
+            msg_id, interval, 0, 0, 0, 0, 0,
+        )
+        self._inflight = (msg_id, name, hz, time.monotonic(), attempt)
+
+    def _apply_data_streams(self, wanted):
+        # ストリーム単位でしか指定できないので、含まれるメッセージの最大レートを使う
+        streams = {}
+        for name, hz in wanted.items():
+            stream = DATA_STREAMS.get(name)
+            if stream is not None:
+                streams[stream] = max(streams.get(stream, 0.0), hz)
+        mav = self.mav
+        for stream, hz in streams.items():
+            mav.mav.request_data_stream_send(mav.target_system, mav.target_component,
+                                             stream, max(1, int(round(hz))) if hz > 0 else 0, 1 if hz > 0 else 0)
+        self.applied = dict(wanted)
+        log.info("REQUEST_DATA_STREAM applied: %s", streams)
+
+    # --- MAVLink 受信 ---
+
+    def handle_message(self, msg):
+        msg_type = msg.get_type()
+        if msg_type in self.applied:
+            self._counts[msg_type] = self._counts.get(msg_type, 0) + 1
+        if msg_type != "COMMAND_ACK" or msg.command != mavlink.MAV_CMD_SET_MESSAGE_INTERVAL:
+            return
+        # 同じリンクの他の GCS 宛ての ACK は無視する (0 は target を埋めない古い機体)。
+        # バックエンドの component は他の GCS と別 (main.py の SOURCE_COMPONENT) なので、ここで見分けられる
+        src = self.mav.mav
+        if msg.target_system not in (0, src.srcSystem) or msg.target_component not in (0, src.srcComponent):
+            return
+        # 要求は 1 件ずつ送っているので、ACK は ACK 待ちの要求に対するもの
+        if self._inflight is None:
+            return
+        _, name, hz, _, _ = self._inflight
+        self._inflight = None
+        if msg.result == mavlink.MAV_RESULT_ACCEPTED:
+            self.applied[name] = hz
+            self.rejected.discard(name)
+            # 変更前のレートが混ざらないよう、実測はここから数え直す
+            self._counts = {}
+            self._window_start = time.monotonic()
+        elif msg.result == mavlink.MAV_RESULT_UNSUPPORTED:
+            log.warning("SET_MESSAGE_INTERVAL unsupported, falling back to REQUEST_DATA_STREAM")
+            self.use_data_stream = True
+            self._queue.clear()
+            self.schedule_apply()
+            return
+        else:
+            log.warning("%s %sHz rejected (result=%s)", name, hz, msg.result)
+            # 同じ要求を繰り返さず、実測の確認対象からも外す
+            self.applied[name] = hz
+            self.rejected.add(name)
+        self._send_next()
+
+    # --- 再送 / 実測による確認 ---
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(0.25)
+            if self.mav is None:
+                continue
+            now = time.monotonic()
+            if self._inflight is not None and now - self._inflight[3] >= self.ack_timeout:
+                msg_id, name, hz, _, attempt = self._inflight
+                self._inflight = None
+                if attempt < self.retries:
+                    self._set_interval(msg_id, name, hz, attempt + 1)
+                else:
+                    log.warning("No ACK for %s %sHz after %d attempts", name, hz, attempt)
+            self._send_next()
+
+            elapsed = now - self._window_start
+            if elapsed < self.verify_window:
+                continue
+            self.measured = {name: count / elapsed for name, count in self._counts.items()}
+            self._counts = {name: 0 for name in self._counts}
+            self._window_start = now
+
+            # 要求と実測が大きく違う (機体の再起動で設定が消えた等) ものは設定し直す。
+            # 他の GCS が同じリンクでレートを変えている場合に張り合わないよう、連続 3 回までにする
+            if self._inflight is not None or self._queue:
+                continue
+            for name, hz in self.applied.items():
+                if name in self.rejected:
+                    continue
+                got = self.measured.get(name, 0.0)
+                # ストリーム単位の設定では他のメッセージに引っ張られて多くなり得るので下限だけ見る
+                too_high = got > 2.0 * hz and not self.use_data_stream
+                if hz >= 1.0 and (got < 0.5 * hz or too_high):
+                    self._reapplied[name] = self._reapplied.get(name, 0) + 1
+                    if self._reapplied[name] > 3:
+                        continue
+                    log.info("%s: requested %sHz, measured %.1fHz; re-applying", name, hz, got)
+                    del self.applied[name]
+                    self.schedule_apply()
+                    break
+                self._reapplied.pop(name, None)
+
+    def status(self):
+        return {"wanted": self.wanted(), "applied": self.applied, "rejected": sorted(self.rejected),
+                "measured": {k: round(v, 2) for k, v in self.measured.items()},
+                "subscribers": len(self.subscriptions),
+                "method": "REQUEST_DATA_STREAM" if self.use_data_stream else "SET_MESSAGE_INTERVAL"}
@@ -0,0 +1,229 @@
+"""地図タイルのキャッシュ付きプロキシ (/api/tiles/{source}/{z}/{x}/{y})
+
+フロントエンドの Leaflet は上流 (OSM / Esri) から直接タイルを取らず、バックエンド経由で取得する。
+
+- タイルは <root>/<source>/<z>/<x>/<y> に保存し、サイズの合計が上限を超えたら最後に使われた時刻が古いものから消す。
+  使われた順序はメモリ上で持ち、削除時と PERSIST_INTERVAL ごとにファイルの更新時刻へ書き戻す (再起動後の順序用)
+- 同じタイルへの同時リクエストは上流への 1 回の取得にまとめる
+- TILE_OFFLINE=1 ならキャッシュにあるものだけを返し、上流へは取りに行かない (現場で LTE を使わない)
+- ミッション前に tile_seed.py で範囲とズームを指定してキャッシュを埋めておける
+"""
+import asyncio
+import collections
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+log = logging.getLogger("tile_cache")
+
+# フロントエンドの TileLayer と同じ上流 (maxNativeZoom=19 より上は Leaflet が拡大表示する)
+SOURCES = {
+    "osm": {"url": "https://tile.openstreetmap.org/{z}/{x}/{y}.png", "type": "image/png"},
+    "esri": {"url": "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+             "type": "image/jpeg"},
+}
+MAX_ZOOM = 19
+USER_AGENT = "rover-gcs tile cache (https://github.com/zorosdrone/rover-gcs)"
+FETCH_TIMEOUT = 10.0
+PERSIST_INTERVAL = 60.0  # 使われた順序をファイルの更新時刻へ書き戻す間隔 (s)
+
+
+class TileNotFound(Exception):
+    """上流にない / オフラインでキャッシュにないタイル"""
+
+
+class TileCache:
+    def __init__(self, root, max_bytes, offline=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.offline = offline
+        # (source, z, x, y) -> サイズ。先頭が最も長く使われていないタイル
+        self._index = collections.OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._inflight = {}   # (source, z, x, y) -> 取得中の Future (イベントループ側のみで使う)
+        self._touched = {}    # (source, z, x, y) -> 最終アクセス時刻 (まだ更新時刻へ書き戻していないもの)
+        self._persisted_at = time.monotonic()
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "fetched": 0, "upstream_errors": 0, "evicted": 0}
+
+    @staticmethod
+    def validate(source, z, x, y):
+        if source not in SOURCES:
+            raise TileNotFound(f"unknown tile source {source}")
+        if not (0 <= z <= MAX_ZOOM and 0 <= x < (1 << z) and 0 <= y < (1 << z)):
+            raise TileNotFound(f"tile {z}/{x}/{y} out of range")
+
+    def path(self, key):
+        source, z, x, y = key
+        return os.path.join(self.root, source, str(z), str(x), str(y))
+
+    def load_index(self):
+        """ディスク上のタイルを最終アクセス (更新) 時刻順に索引へ読み込む (初回のみ)"""
+        with self._lock:
+            if self._loaded:
+                return
+            entries = []
+            for source in SOURCES:
+                base = os.path.join(self.root, source)
+                for dirpath, _, filenames in os.walk(base):
+                    for name in filenames:
+                        if name.endswith(".tmp"):
+                            continue
+                        try:
+                            rel = os.path.relpath(os.path.join(dirpath, name), base).split(os.sep)
+                            key = (source, int(rel[0]), int(rel[1]), int(rel[2]))
+                            st = os.stat(os.path.join(dirpath, name))
+                        except (ValueError, IndexError, OSError):
+                            continue
+                        entries.append((st.st_mtime, key, st.st_size))
+            for _, key, size in sorted(entries):
+                self._index[key] = size
+                self._total += size
+            self._loaded = True
+            self._evict()
+            self._touched.clear()
+        log.info("Tile cache: %d tiles, %.1f MB in %s", len(self._index), self._total / 1e6, self.root)
+
+    def _evict(self):
+        """上限を超えた分を古い順に消し、消した数を返す (_lock を取った状態で呼ぶ)"""
+        evicted = 0
+        while self._total > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total -= size
+            self._touched.pop(key, None)
+            evicted += 1
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+        self.stats["evicted"] += evicted
+        return evicted
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def persist_order(self):
+        """メモリ上の使われた順序を、最終アクセス時刻としてファイルの更新時刻に書き戻す"""
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            self._persisted_at = time.monotonic()
+        for key, used_at in touched.items():
+            try:
+                os.utime(self.path(key), (used_at, used_at))
+            except OSError:
+                pass
+
+    def read(self, key):
+        """キャッシュにあればバイト列、なければ None。別プロセス (tile_seed.py) が書いたタイルも拾う"""
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                if key in self._index:
+                    self._total -= self._index.pop(key)
+            return None
+        # ヒットのたびにファイルの更新時刻を書くと 1 タイルごとにメタデータの書き込みが増えるので、
+        # 順序はメモリ上で更新し、書き戻しはまとめて行う
+        with self._lock:
+            evicted = 0
+            if key not in self._index:
+                self._index[key] = len(data)
+                self._total += len(data)
+                evicted = self._evict()
+            else:
+                self._index.move_to_end(key)
+            if key in self._index:
+                self._touched[key] = time.time()
+            persist = evicted or time.monotonic() - self._persisted_at >= PERSIST_INTERVAL
+        if persist:
+            self.persist_order()
+        return data
+
+    def store(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            if key in self._index:
+                self._total -= self._index.pop(key)
+            self._index[key] = len(data)
+            self._total += len(data)
+            self._touched.pop(key, None)  # 書いたばかりなので更新時刻は新しい
+            evicted = self._evict()
+        if evicted:
+            self.persist_order()
+
+    def fetch(self, key):
+        """上流から取得してキャッシュに保存する (ブロッキング)"""
+        source, z, x, y = key
+        url = SOURCES[source]["url"].format(z=z, x=x, y=y)
+        request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+        try:
+            with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+                data = response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise TileNotFound(f"{source} {z}/{x}/{y} not found upstream")
+            self._count("upstream_errors")
+            raise
+        except OSError:
+            self._count("upstream_errors")
+            raise
+        self.store(key, data)
+        self._count("fetched")
+        return data
+
+    def get_sync(self, key):
+        """キャッシュ -> 上流の順にタイルを返す (tile_seed.py などスレッドから使う)"""
+        if not self._loaded:
+            self.load_index()
+        data = self.read(key)
+        if data is not None:
+            self._count("hits")
+            return data
+        if self.offline:
+            raise TileNotFound("offline and not cached")
+        self._count("misses")
+        return self.fetch(key)
+
+    async def get(self, source, z, x, y):
+        """タイルのバイト列を返す。同じタイルを取得中なら、その結果を待つ"""
+        self.validate(source, z, x, y)
+        key = (source, z, x, y)
+        future = self._inflight.get(key)
+        if future is not None:
+            self._count("coalesced")
+            return await asyncio.shield(future)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, self.get_sync, key)
+        self._inflight[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._inflight.pop(key, None)
+            else:
+                future.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+    def status(self):
+        with self._lock:
+            tiles, total, stats = len(self._index), self._total, dict(self.stats)
+        return {"root": self.root, "offline": self.offline, "tiles": tiles, "bytes": total,
+                "max_bytes": self.max_bytes, **stats}
+
+
+def from_env(default_root):
+    """TILE_CACHE_DIR / TILE_CACHE_MB (既定 1024) / TILE_OFFLINE から TileCache を作る"""
+    root = os.environ.get("TILE_CACHE_DIR", default_root)
+    max_bytes = int(float(os.environ.get("TILE_CACHE_MB", "1024")) * 1024 * 1024)
+    offline = os.environ.get("TILE_OFFLINE", "") not in ("", "0")
+    return TileCache(root, max_bytes, offline)
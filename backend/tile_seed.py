@@ -0,0 +1,111 @@
+"""地図タイルのキャッシュを事前に埋める (ミッション前、回線のよい場所で実行する)
+
+緯度経度の範囲とズームの範囲を指定し、バックエンドと同じキャッシュ (TILE_CACHE_DIR、既定 backend/tile_cache)
+に保存する。キャッシュ済みのタイルは取得しない。バックエンドが動いていても実行できる。
+
+    python tile_seed.py --bbox 35.866,140.261,35.869,140.266 --zoom 15-19
+    python tile_seed.py --bbox ... --zoom 12-19 --source esri --source osm --dry-run
+
+OSM のタイルサーバーは大量の一括取得を禁止しているため (https://operations.osmfoundation.org/policies/tiles/)、
+--max-tiles で 1 回の取得数を制限している。広い範囲は esri で取得する。
+"""
+import argparse
+import concurrent.futures
+import math
+import os
+import sys
+import time
+
+import tile_cache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def tile_xy(lat, lon, z):
+    """緯度経度 -> その点を含むタイル番号 (Web メルカトル)"""
+    n = 1 << z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_in_bbox(south, west, north, east, zooms):
+    for z in zooms:
+        x0, y0 = tile_xy(north, west, z)
+        x1, y1 = tile_xy(south, east, z)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield z, x, y
+
+
+def parse_zoom(text):
+    lo, _, hi = text.partition("-")
+    lo, hi = int(lo), int(hi or lo)
+    if not 0 <= lo <= hi <= tile_cache.MAX_ZOOM:
+        raise argparse.ArgumentTypeError(f"zoom must be within 0-{tile_cache.MAX_ZOOM}")
+    return range(lo, hi + 1)
+
+
+def parse_bbox(text):
+    try:
+        lat1, lon1, lat2, lon2 = (float(v) for v in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected LAT1,LON1,LAT2,LON2")
+    return min(lat1, lat2), min(lon1, lon2), max(lat1, lat2), max(lon1, lon2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-seed the backend map tile cache for an area")
+    parser.add_argument("--bbox", type=parse_bbox, required=True, help="LAT1,LON1,LAT2,LON2 (any two corners)")
+    parser.add_argument("--zoom", type=parse_zoom, default=parse_zoom("15-19"), help="zoom range, e.g. 15-19")
+    parser.add_argument("--source", action="append", choices=sorted(tile_cache.SOURCES),
+                        help="tile source (repeatable, default: esri)")
+    parser.add_argument("--workers", type=int, default=4, help="parallel downloads")
+    parser.add_argument("--max-tiles", type=int, default=5000, help="refuse to seed more tiles than this per source")
+    parser.add_argument("--dry-run", action="store_true", help="only count the tiles")
+    args = parser.parse_args()
+
+    cache = tile_cache.from_env(os.path.join(BASE_DIR, "tile_cache"))
+    cache.offline = False
+    sources = args.source or ["esri"]
+    tiles = list(tiles_in_bbox(*args.bbox, args.zoom))
+    print(f"{len(tiles)} tiles per source (zoom {args.zoom.start}-{args.zoom.stop - 1}) into {cache.root}")
+    if args.dry_run:
+        return
+    if len(tiles) > args.max_tiles:
+        sys.exit(f"{len(tiles)} tiles exceeds --max-tiles {args.max_tiles}; narrow the area or zoom range")
+
+    cache.load_index()
+    size_before = cache.status()["bytes"]
+    for source in sources:
+        started = time.monotonic()
+        cached = fetched = failed = 0
+        with concurrent.futures.ThreadPoolExecutor(args.workers) as pool:
+            futures = {}
+            for z, x, y in tiles:
+                key = (source, z, x, y)
+                if os.path.exists(cache.path(key)):
+                    cached += 1
+                    continue
+                futures[pool.submit(cache.fetch, key)] = key
+            for i, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                try:
+                    future.result()
+                    fetched += 1
+                except (tile_cache.TileNotFound, OSError) as e:
+                    failed += 1
+                    print(f"  {futures[future]}: {e}")
+                if i % 100 == 0:
+                    print(f"  {source}: {i}/{len(futures)}")
+        print(f"{source}: {fetched} fetched, {cached} already cached, {failed} failed "
+              f"in {time.monotonic() - started:.1f} s")
+    status = cache.status()
+    print(f"cache: {status['tiles']} tiles, {status['bytes'] / 1e6:.1f} MB "
+          f"(+{(status['bytes'] - size_before) / 1e6:.1f} MB, limit {status['max_bytes'] / 1e6:.0f} MB)")
+    if status["evicted"]:
+        print(f"warning: {status['evicted']} tiles were evicted, raise TILE_CACHE_MB to keep the whole area")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+import csv
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+os.environ.setdefault("MAVLINK20", "1")
+from pymavlink import mavutil  # noqa: E402
+
+# MAVLink2 drops trailing zero bytes of the payload, so ENCAPSULATED_DATA carries 2 + N bytes on the wire.
+MAX_LOAD_SIZE = 253
+
+
+@dataclass
+class Probe:
+    seq: int
+    phase: str
+    sent: float
+    key: int = 0  # TIMESYNC ts1 / PING seq the answer carries
+    rtt: Optional[float] = None
+    reordered: bool = False
+    duplicates: int = 0
+
+
+@dataclass
+class Window:
+    """Probes sent within one report interval."""
+
+    start: float
+    phase: str
+    probes: List[Probe] = field(default_factory=list)
+    down_jitter: List[float] = field(default_factory=list)
+    tx_bytes: int = 0
+    rx_bytes: int = 0
+
+
+def parse_args() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Measure MAVLink link RTT, jitter, loss and reordering (e.g. over the Tailscale/VPS path)."
+    )
+    parser.add_argument(
+        "--endpoint",
+        default="udpin:0.0.0.0:14550",
+        help="MAVLink endpoint of the link under test. Default: udpin:0.0.0.0:14550",
+    )
+    parser.add_argument("--source-system", type=int, default=10, help="Source system id. Default: 10")
+    parser.add_argument("--source-component", type=int, default=90, help="Source component id. Default: 90")
+    parser.add_argument(
+        "--method",
+        choices=("timesync", "ping"),
+        default="timesync",
+        help="Probe message. ArduPilot answers TIMESYNC; PING is answered by PX4 and most routers. Default: timesync",
+    )
+    parser.add_argument("--rate", type=float, default=10.0, help="Probes per second. Default: 10")
+    parser.add_argument(
+        "--phases",
+        default="idle:30,load:30,idle:30",
+        help="Comma separated NAME:SECONDS. 'load' phases add uplink filler traffic. Default: idle:30,load:30,idle:30",
+    )
+    parser.add_argument("--load-rate", type=float, default=50.0, help="Filler messages per second in load phases")
+    parser.add_argument(
+        "--load-size",
+        type=int,
+        default=200,
+        help=f"Filler payload bytes (ENCAPSULATED_DATA, 1-{MAX_LOAD_SIZE}). Default: 200",
+    )
+    parser.add_argument("--interval", type=float, default=1.0, help="Report interval in seconds. Default: 1")
+    parser.add_argument("--timeout", type=float, default=2.0, help="Seconds before a probe counts as lost")
+    parser.add_argument("--csv", help="Write one row per interval to this CSV file")
+    parser.add_argument("--json", help="Write per interval rows and per phase summaries to this JSON file")
+    return parser
+
+
+def parse_phases(text: str) -> List[tuple]:
+    phases = []
+    for item in text.split(","):
+        name, _, seconds = item.strip().partition(":")
+        if name not in ("idle", "load") or not seconds:
+            raise ValueError(f"bad phase {item!r}, expected idle:SECONDS or load:SECONDS")
+        phases.append((name, float(seconds)))
+    return phases
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def ms(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value * 1000, 2)
+
+
+def summarize(probes: List[Probe], down_jitter: List[float], seconds: float, tx_bytes: int, rx_bytes: int) -> dict:
+    """Loss, RTT percentiles and jitter over a set of probes (all times in ms)."""
+    rtts = [p.rtt for p in probes if p.rtt is not None]
+    # RTT jitter: mean absolute difference between consecutive answered probes (RFC 3550 style IPDV)
+    answered = [p.rtt for p in sorted(probes, key=lambda p: p.seq) if p.rtt is not None]
+    ipdv = [abs(b - a) for a, b in zip(answered, answered[1:])]
+    lost = sum(1 for p in probes if p.rtt is None)
+    return {
+        "sent": len(probes),
+        "received": len(rtts),
+        "lost": lost,
+        "loss_pct": round(100.0 * lost / len(probes), 2) if probes else None,
+        "reordered": sum(1 for p in probes if p.reordered),
+        "duplicates": sum(p.duplicates for p in probes),
+        "rtt_min_ms": ms(min(rtts)) if rtts else None,
+        "rtt_p50_ms": ms(percentile(rtts, 0.5)),
+        "rtt_p90_ms": ms(percentile(rtts, 0.9)),
+        "rtt_p99_ms": ms(percentile(rtts, 0.99)),
+        "rtt_max_ms": ms(max(rtts)) if rtts else None,
+        "jitter_ms": ms(statistics.mean(ipdv)) if ipdv else None,
+        # one way (vehicle -> probe) delay variation from SYSTEM_TIME.time_boot_ms
+        "down_jitter_ms": ms(statistics.mean(down_jitter)) if down_jitter else None,
+        "tx_kbps": round(tx_bytes * 8 / seconds / 1000, 2) if seconds > 0 else None,
+        "rx_kbps": round(rx_bytes * 8 / seconds / 1000, 2) if seconds > 0 else None,
+    }
+
+
+class LinkProbe:
+    def __init__(self, args):
+        self.args = args
+        self.master = mavutil.mavlink_connection(
+            args.endpoint,
+            source_system=args.source_system,
+            source_component=args.source_component,
+        )
+        self.probes: Dict[int, Probe] = {}
+        self.pending: Dict[int, int] = {}  # TIMESYNC ts1 / PING seq -> probe seq
+        self.windows: List[Window] = []
+        self.rows: List[dict] = []
+        self.highest_answered = -1
+        self.last_transit: Optional[float] = None
+        self.origin = 0.0
+        self.load_data = [random.randint(1, 255) for _ in range(max(1, min(args.load_size, MAX_LOAD_SIZE)))]
+        self.load_data += [0] * (MAX_LOAD_SIZE - len(self.load_data))
+        self.csv_writer = None
+
+    def connect(self) -> None:
+        print(f"Waiting for heartbeat on {self.args.endpoint}")
+        # udpin peers only learn our address from what we send
+        for _ in range(30):
+            self.master.mav.heartbeat_send(mavutil.mavlink.MAV_TYPE_GCS, mavutil.mavlink.MAV_AUTOPILOT_INVALID,
+                                           0, 0, 0)
+            if self.master.wait_heartbeat(timeout=1) is not None:
+                break
+        else:
+            sys.exit("no heartbeat")
+        print(f"connected to system {self.master.target_system}, method={self.args.method}")
+
+    def send_probe(self, seq: int, phase: str, now: float) -> None:
+        probe = Probe(seq, phase, now, key=time.monotonic_ns() if self.args.method == "timesync" else seq)
+        self.probes[seq] = probe
+        self.pending[probe.key] = seq
+        self.windows[-1].probes.append(probe)
+        if self.args.method == "timesync":
+            self.master.mav.timesync_send(0, probe.key)
+        else:
+            self.master.mav.ping_send(int(time.time() * 1e6), seq, 0, 0)
+
+    def handle(self, msg, now: float) -> None:
+        msg_type = msg.get_type()
+        key = None
+        if msg_type == "TIMESYNC" and msg.tc1 != 0:
+            key = msg.ts1
+        elif msg_type == "PING" and msg.target_system == self.args.source_system:
+            key = msg.seq
+        elif msg_type == "SYSTEM_TIME":
+            transit = now - msg.time_boot_ms / 1000.0
+            if self.last_transit is not None and self.windows:
+                self.windows[-1].down_jitter.append(abs(transit - self.last_transit))
+            self.last_transit = transit
+            return
+        if key is None or key not in self.pending:
+            return
+        probe = self.probes[self.pending[key]]
+        if probe.rtt is not None:
+            probe.duplicates += 1
+            return
+        probe.rtt = now - probe.sent
+        if probe.seq < self.highest_answered:
+            probe.reordered = True
+        self.highest_answered = max(self.highest_answered, probe.seq)
+
+    def close_windows(self, now: float, final: bool = False) -> None:
+        """Report the intervals whose probes have all been answered or timed out."""
+        while self.windows:
+            window = self.windows[0]
+            end = window.start + self.args.interval
+            if not final and (len(self.windows) == 1 or now < end + self.args.timeout):
+                break
+            self.windows.pop(0)
+            row = {"t": round(window.start - self.origin, 2), "phase": window.phase,
+                   **summarize(window.probes, window.down_jitter, self.args.interval, window.tx_bytes,
+                               window.rx_bytes)}
+            self.rows.append(row)
+            # answers arriving after this are counted as lost
+            for probe in window.probes:
+                self.pending.pop(probe.key, None)
+            if self.csv_writer is not None:
+                self.csv_writer.writerow(row)
+            print(f"{row['t']:7.1f}s {row['phase']:4} sent {row['sent']:3} lost {row['lost']:3} "
+                  f"reord {row['reordered']:2}  rtt p50 {row['rtt_p50_ms']} p99 {row['rtt_p99_ms']} "
+                  f"jitter {row['jitter_ms']} ms  tx {row['tx_kbps']} kbps")
+
+    def run(self) -> dict:
+        phases = parse_phases(self.args.phases)
+        csv_file = None
+        if self.args.csv:
+            csv_file = open(self.args.csv, "w", newline="")
+            fields = ["t", "phase"] + list(summarize([], [], 1, 0, 0).keys())
+            self.csv_writer = csv.DictWriter(csv_file, fieldnames=fields)
+            self.csv_writer.writeheader()
+
+        mav = self.master.mav
+        seq = 0
+        load_seq = 0
+        self.origin = now = time.monotonic()
+        phase_start = now
+        tx_mark, rx_mark = mav.total_bytes_sent, mav.total_bytes_received
+        try:
+            for phase, seconds in phases:
+                phase_end = phase_start + seconds
+                next_probe = next_load = phase_start
+                while now < phase_end:
+                    if not self.windows or now >= self.windows[-1].start + self.args.interval:
+                        if self.windows:
+                            self.windows[-1].tx_bytes = mav.total_bytes_sent - tx_mark
+                            self.windows[-1].rx_bytes = mav.total_bytes_received - rx_mark
+                            tx_mark, rx_mark = mav.total_bytes_sent, mav.total_bytes_received
+                        start = self.windows[-1].start + self.args.interval if self.windows else now
+                        self.windows.append(Window(start, phase))
+                    if now >= next_probe:
+                        self.send_probe(seq, phase, now)
+                        seq += 1
+                        next_probe += 1.0 / self.args.rate
+                    if phase == "load" and now >= next_load:
+                        mav.encapsulated_data_send(load_seq & 0xFFFF, self.load_data)
+                        load_seq += 1
+                        next_load += 1.0 / self.args.load_rate
+                    msg = self.master.recv_match(blocking=True, timeout=0.001)
+                    while msg is not None:
+                        self.handle(msg, time.monotonic())
+                        msg = self.master.recv_match(blocking=False)
+                    now = time.monotonic()
+                    self.close_windows(now)
+                phase_start = phase_end
+
+            # wait for the answers to the last probes
+            deadline = time.monotonic() + self.args.timeout
+            while time.monotonic() < deadline:
+                msg = self.master.recv_match(blocking=True, timeout=0.01)
+                if msg is not None:
+                    self.handle(msg, time.monotonic())
+            if self.windows:
+                self.windows[-1].tx_bytes = mav.total_bytes_sent - tx_mark
+                self.windows[-1].rx_bytes = mav.total_bytes_received - rx_mark
+            self.close_windows(time.monotonic(), final=True)
+        finally:
+            if csv_file is not None:
+                csv_file.close()
+
+        summary = {}
+        for name in dict.fromkeys(p for p, _ in phases):
+            probes = [p for p in self.probes.values() if p.phase == name]
+            rows = [r for r in self.rows if r["phase"] == name]
+            seconds = sum(s for p, s in phases if p == name)
+            summary[name] = summarize(probes, [], seconds, 0, 0)
+            jitter = [r["down_jitter_ms"] for r in rows if r["down_jitter_ms"] is not None]
+            summary[name]["down_jitter_ms"] = round(statistics.mean(jitter), 2) if jitter else None
+            for key in ("tx_kbps", "rx_kbps"):
+                values = [r[key] for r in rows if r[key] is not None]
+                summary[name][key] = round(statistics.mean(values), 2) if values else None
+        return summary
+
+
+def main() -> None:
+    parser = parse_args()
+    args = parser.parse_args()
+    if args.rate <= 0 or args.load_rate <= 0 or args.interval <= 0:
+        parser.error("--rate, --load-rate and --interval must be positive")
+    try:
+        parse_phases(args.phases)
+    except ValueError as e:
+        parser.error(str(e))
+
+    probe = LinkProbe(args)
+    probe.connect()
+    summary = probe.run()
+
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        config = {k: v for k, v in vars(args).items() if k not in ("csv", "json")}
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "phases": summary, "intervals": probe.rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import 'leaflet/dist/leaflet.css'
 import L from 'leaflet'
 import axios from 'axios'
 import './App.css'
+import OccupancyLayer from './OccupancyLayer'
 import { Joystick } from 'react-joystick-component';
 
 // 矢印アイコン生成関数
@@ -53,6 +54,10 @@ const getApiBaseUrl = () => {
     : `${window.location.protocol}//${window.location.host}`;
 };
 
+// 地図タイルの URL (バックエンドのキャッシュ経由)。<img> はヘッダを付けられないのでトークンはクエリで渡す
+const getTileUrl = (source) =>
+  `${getApiBaseUrl()}/api/tiles/${source}/{z}/{x}/{y}?token=${encodeURIComponent(localStorage.getItem("authToken") || "")}`;
+
 // バックエンドへ移動指令を送る関数
 const sendGoTo = async (lat, lon, speed) => {
   const baseUrl = getApiBaseUrl();
@@ -64,7 +69,9 @@ const sendGoTo = async (lat, lon, speed) => {
     if (speed) {
       payload.speed = speed;
     }
-    const response = await axios.post(`${baseUrl}/api/command/goto`, payload);
+    const response = await axios.post(`${baseUrl}/api/command/goto`, payload, {
+      headers: { Authorization: `Bearer ${localStorage.getItem("authToken")}` }
+    });
     console.log("GoTo sent:", response.data);
   } catch (error) {
     console.error("GoTo error:", error);
@@ -161,8 +168,8 @@ function ClassicMode({ onSwitchMode, transmitInterval, setTransmitInterval }) {
   }, [setTransmitInterval]);
 
   useEffect(() => {
-    const auth = localStorage.getItem("isAuthenticated");
-    if (auth === "true") {
+    // トークンの有効性は WebSocket 接続時にバックエンドが確認する
+    if (localStorage.getItem("authToken")) {
       setIsAuthenticated(true);
     }
   }, []);
@@ -179,7 +186,7 @@ function ClassicMode({ onSwitchMode, transmitInterval, setTransmitInterval }) {
       
       if (response.data.status === "ok") {
         setIsAuthenticated(true);
-        localStorage.setItem("isAuthenticated", "true");
+        localStorage.setItem("authToken", response.data.token);
         setLoginError("");
       } else {
         setLoginError("Invalid password");
@@ -197,7 +204,7 @@ function ClassicMode({ onSwitchMode, transmitInterval, setTransmitInterval }) {
     setIsAuthenticated(false);
     setPasswordInput(""); // Clear password on logout
     setIsLoggingIn(false); // Reset loading state
-    localStorage.removeItem("isAuthenticated");
+    localStorage.removeItem("authToken");
   };
 
   const [status, setStatus] = useState("Disconnected")
@@ -211,6 +218,9 @@ function ClassicMode({ onSwitchMode, transmitInterval, setTransmitInterval }) {
   const [controlMode, setControlMode] = useState('slider') // 'slider' or 'joystick'
   const manualControlRef = useRef({ throttle: 1500, steer: 1500 }) // 最新の値を保持するためのRef
   const wsRef = useRef(null)
+  // 操縦遅延の計測用 (MANUAL_CONTROL に seq/t を付け、CONTROL_ACK で往復時間を測って次の送信で報告する)
+  const controlSeqRef = useRef(0)
+  const controlRttRef = useRef(null)
 
   useEffect(() => {
     if (!isAuthenticated) return;
@@ -225,7 +235,9 @@ function ClassicMode({ onSwitchMode, transmitInterval, setTransmitInterval }) {
 
     console.log('Connecting to:', wsUrl)
 
-    const ws = new WebSocket(wsUrl)
+    // ブラウザの WebSocket はヘッダを付けられないので、トークンはクエリで渡す
+    const token = localStorage.getItem("authToken") || ""
+    const ws = new WebSocket(`${wsUrl}?token=${encodeURIComponent(token)}`)
     wsRef.current = ws
 
     ws.onopen = () => {
@@ -234,6 +246,11 @@ function ClassicMode({ onSwitchMode, transmitInterval, setTransmitInterval }) {
 
     ws.onmessage = (event) => {
       const message = JSON.parse(event.data)
+
+      if (message.type === 'CONTROL_ACK') {
+        controlRttRef.current = performance.now() - message.data.t
+        return
+      }
       
       // 受信したデータを画面表示用に保存
       setTelemetry(prev => {
@@ -272,8 +289,13 @@ function ClassicMode({ onSwitchMode, transmitInterval, setTransmitInterval }) {
       })
     }
 
-    ws.onclose = () => {
+    ws.onclose = (event) => {
       setStatus("Disconnected")
+      // 1008: トークンが無効 / 期限切れ -> ログイン画面に戻す
+      if (event.code === 1008) {
+        handleLogout()
+        setLoginError("Session expired. Please log in again.")
+      }
     }
 
     return () => {
@@ -414,7 +436,13 @@ function ClassicMode({ onSwitchMode, transmitInterval, setTransmitInterval }) {
     const payload = {
       type: 'MANUAL_CONTROL',
       throttle,
-      steer
+      steer,
+      seq: controlSeqRef.current++,
+      t: performance.now()
+    }
+    if (controlRttRef.current !== null) {
+      payload.rtt = controlRttRef.current
+      controlRttRef.current = null
     }
     ws.send(JSON.stringify(payload))
   }
@@ -787,7 +815,7 @@ function ClassicMode({ onSwitchMode, transmitInterval, setTransmitInterval }) {
                   <LayersControl position="topright">
                     <LayersControl.BaseLayer name="Standard (OSM)">
                       <TileLayer
-                        url="https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png"
+                        url={getTileUrl("osm")}
                         attribution='&copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
                         maxNativeZoom={19}
                         maxZoom={22}
@@ -795,12 +823,20 @@ function ClassicMode({ onSwitchMode, transmitInterval, setTransmitInterval }) {
                     </LayersControl.BaseLayer>
                     <LayersControl.BaseLayer checked name="Satellite (Esri)">
                       <TileLayer
-                        url="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"
+                        url={getTileUrl("esri")}
                         attribution='Tiles &copy; Esri &mdash; Source: Esri, i-cubed, USDA, USGS, AEX, GeoEye, Getmapping, Aerogrid, IGN, IGP, UPR-EGP, and the GIS User Community'
                         maxNativeZoom={19}
                         maxZoom={22}
                       />
                     </LayersControl.BaseLayer>
+                    <LayersControl.Overlay name="Occupancy (Webots)">
+                      <OccupancyLayer
+                        baseUrl={getApiBaseUrl()}
+                        vehiclePosition={telemetry.GLOBAL_POSITION_INT
+                          ? [telemetry.GLOBAL_POSITION_INT.lat / 10000000, telemetry.GLOBAL_POSITION_INT.lon / 10000000]
+                          : null}
+                      />
+                    </LayersControl.Overlay>
                   </LayersControl>
 
                   <Polyline positions={path} color="blue" />
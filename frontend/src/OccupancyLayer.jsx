@@ -0,0 +1,84 @@
+import { useEffect, useRef, useState } from 'react'
+import { ImageOverlay, LayerGroup } from 'react-leaflet'
+
+// Webots の占有格子地図 (ardupilot_vehicle_controller.py --occupancy-port) を
+// バックエンドの /api/occupancy 経由で地図に重ねる。表示中だけ、変わったタイルだけを取得する
+const METERS_PER_DEG_LAT = 111320;
+const POLL_MS = 1000;
+const RETRY_MS = 10000;
+
+// home から北 / 東へ (m) ずらした緯度経度
+const offsetLatLon = (home, north, east) => [
+  home[0] + north / METERS_PER_DEG_LAT,
+  home[1] + east / (METERS_PER_DEG_LAT * Math.cos(home[0] * Math.PI / 180)),
+];
+
+export default function OccupancyLayer({ baseUrl, vehiclePosition }) {
+  const [active, setActive] = useState(false);
+  const [tiles, setTiles] = useState({}); // "i,j" -> { i, j, version, bounds }
+  const [home, setHome] = useState(null);
+  const versionRef = useRef(0);
+  const positionRef = useRef(vehiclePosition);
+  positionRef.current = vehiclePosition;
+
+  useEffect(() => {
+    if (!active) return;
+    let cancelled = false;
+    let timer = null;
+    const poll = async () => {
+      let delay = POLL_MS;
+      try {
+        const res = await fetch(`${baseUrl}/api/occupancy/meta?since=${versionRef.current}`, {
+          headers: { Authorization: `Bearer ${localStorage.getItem("authToken")}` }
+        });
+        if (!res.ok) throw new Error(`occupancy meta: ${res.status}`);
+        const meta = await res.json();
+        if (meta.version < versionRef.current) {
+          // コントローラが再起動した: 最初から取り直す
+          versionRef.current = 0;
+          setTiles({});
+          delay = 0;
+        } else {
+          versionRef.current = meta.version;
+          if (meta.tiles.length > 0) {
+            setTiles(prev => {
+              const next = { ...prev };
+              for (const t of meta.tiles) next[`${t.i},${t.j}`] = t;
+              return next;
+            });
+          }
+        }
+        // 地図の原点 (SITL の home)。コントローラが知らなければ、機体の現在位置から一度だけ求める
+        if (meta.home) {
+          setHome(h => h ?? meta.home);
+        } else if (positionRef.current) {
+          const [lat, lon] = positionRef.current;
+          const [north, east] = meta.vehicle;
+          setHome(h => h ?? offsetLatLon([lat, lon], -north, -east));
+        }
+      } catch (e) {
+        delay = RETRY_MS;
+      }
+      if (!cancelled) timer = setTimeout(poll, delay);
+    };
+    poll();
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [active, baseUrl]);
+
+  const token = encodeURIComponent(localStorage.getItem("authToken") || "");
+  return (
+    <LayerGroup eventHandlers={{ add: () => setActive(true), remove: () => setActive(false) }}>
+      {home && Object.values(tiles).map(t => (
+        <ImageOverlay
+          key={`${t.i},${t.j}`}
+          url={`${baseUrl}/api/occupancy/tiles/${t.i}/${t.j}.png?v=${t.version}&token=${token}`}
+          bounds={[offsetLatLon(home, ...t.bounds[0]), offsetLatLon(home, ...t.bounds[1])]}
+          className="occupancy-tile"
+        />
+      ))}
+    </LayerGroup>
+  );
+}
@@ -1,66 +1,250 @@
-"""MAVProxy module: forward Webots DISTANCE_SENSOR into the SITL master link.
+"""MAVProxy module: forward Webots sensor messages into the SITL master link.
 
 Why:
 - MAVProxy "link add" can *receive* MAVLink from an extra socket, but it does not
   automatically forward those packets to the master (SITL).
 - ArduPilot's RangeFinder MAVLink backend expects DISTANCE_SENSOR to arrive on
   its MAVLink input; this module re-sends received DISTANCE_SENSOR via the master.
+- Likewise the MAVLink proximity backend (PRX1_TYPE=2) expects OBSTACLE_DISTANCE.
+
+Modes:
+- passthrough (default): frames are split by their MAVLink header only and the
+  original bytes of allowed message types are written to the master as is.
+  No field decoding, so high rate ODOMETRY/VISION_POSITION_ESTIMATE cost almost nothing.
+- resend: frames are decoded and re-serialized with MAVProxy's own MAVLink instance
+  (the original behaviour, DISTANCE_SENSOR goes out with MAVProxy's sysid/compid).
+
+Load control:
+- idle_task drains at most `budget` messages / microseconds per call so a burst from
+  the simulator can't starve the rest of MAVProxy; the remainder waits in the socket.
+- `webotsrf status` shows per-type rates, forward latency and drop counters. Latency is
+  measured against the packet's own timestamp (time_boot_ms/time_usec). The Webots and
+  MAVProxy clocks are not synchronised, so it is reported relative to the smallest
+  delay seen (i.e. queueing delay and jitter, not absolute one-way latency).
 
 Usage (example):
   PYTHONPATH=/path/to/rover-gcs/mavproxy_modules mavproxy.py --load-module webotsrf ...
+  webotsrf types add ODOMETRY VISION_POSITION_ESTIMATE
 
 Then make Webots send to: udpout:<WSL_IP>:14551
 """
 
 from __future__ import annotations
 
+import socket
+import struct
 import time
 
 from MAVProxy.modules.lib import mp_module
 from pymavlink import mavutil
 
+DEFAULT_TYPES = ("DISTANCE_SENSOR", "OBSTACLE_DISTANCE")
+
+MAVLINK_V1_STX = 0xFE
+MAVLINK_V2_STX = 0xFD
+MAVLINK_IFLAG_SIGNED = 0x01
+
+# where each message keeps its timestamp: (payload offset, struct format, units per ms)
+# fields are ordered by size in the wire format, so the 64/32-bit timestamps come first
+TIMESTAMP_FIELDS = {
+    "DISTANCE_SENSOR": (0, "<I", 1),
+    "OBSTACLE_DISTANCE": (0, "<Q", 1000),
+    "ODOMETRY": (0, "<Q", 1000),
+    "VISION_POSITION_ESTIMATE": (0, "<Q", 1000),
+    "VISION_SPEED_ESTIMATE": (0, "<Q", 1000),
+    "LANDING_TARGET": (0, "<Q", 1000),
+}
+
+RATE_WINDOW_S = 1.0
+
+
+def msg_id_for(name: str) -> int | None:
+    """MAVLink message id for a message name (None if the dialect doesn't know it)."""
+    return getattr(mavutil.mavlink, f"MAVLINK_MSG_ID_{name.upper()}", None)
+
+
+def iter_frames(buf: bytes):
+    """Yield (msgid, start, end) for each MAVLink v1/v2 frame in a datagram.
+
+    Only the header is read. Bytes that don't start a frame are skipped and counted
+    by yielding (None, start, end); CRCs are left to ArduPilot, which checks them anyway.
+    """
+    i = 0
+    n = len(buf)
+    while i < n:
+        stx = buf[i]
+        if stx == MAVLINK_V2_STX and i + 10 <= n:
+            flen = 12 + buf[i + 1] + (13 if buf[i + 2] & MAVLINK_IFLAG_SIGNED else 0)
+            msgid = buf[i + 7] | (buf[i + 8] << 8) | (buf[i + 9] << 16)
+        elif stx == MAVLINK_V1_STX and i + 6 <= n:
+            flen = 8 + buf[i + 1]
+            msgid = buf[i + 5]
+        else:
+            # resync on the next start byte
+            j = i + 1
+            while j < n and buf[j] not in (MAVLINK_V1_STX, MAVLINK_V2_STX):
+                j += 1
+            yield None, i, j
+            i = j
+            continue
+
+        if i + flen > n:
+            yield None, i, n
+            return
+        yield msgid, i, i + flen
+        i += flen
+
+
+class TypeStats:
+    """Rate meter and forward latency tracker for one message type."""
+
+    __slots__ = ("count", "rate_hz", "_window_start", "_window_count",
+                 "min_delay_ms", "latency_ms", "max_latency_ms")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.rate_hz = 0.0
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self.min_delay_ms: float | None = None
+        self.latency_ms = 0.0
+        self.max_latency_ms = 0.0
+
+    def add(self, now: float) -> None:
+        self.count += 1
+        self._window_count += 1
+        elapsed = now - self._window_start
+        if elapsed >= RATE_WINDOW_S:
+            self.rate_hz = self._window_count / elapsed
+            self._window_start = now
+            self._window_count = 0
+
+    def add_delay(self, delay_ms: float) -> None:
+        # delay includes the unknown clock offset; the smallest delay seen is our zero
+        if self.min_delay_ms is None or delay_ms < self.min_delay_ms:
+            self.min_delay_ms = delay_ms
+        latency = delay_ms - self.min_delay_ms
+        self.latency_ms += (latency - self.latency_ms) * 0.05
+        self.max_latency_ms = max(self.max_latency_ms, latency)
+
+    def current_rate(self, now: float) -> float:
+        # a type that stopped arriving should not keep showing its old rate
+        if now - self._window_start > 2 * RATE_WINDOW_S:
+            return 0.0
+        return self.rate_hz
+
 
 class WebotsRF(mp_module.MPModule):
     def __init__(self, mpstate):
-        super().__init__(mpstate, "webotsrf", "Forward Webots rangefinder to master")
+        super().__init__(mpstate, "webotsrf", "Forward Webots sensor messages to master")
         self.port: int = 14551
-        self._link = None
+        self.mode: str = "passthrough"
+        self._sock: socket.socket | None = None
+        self._parser = mavutil.mavlink.MAVLink(None)
+        self._types: dict[int, str] = {}
         self._forwarded: int = 0
+        self._filtered: int = 0
+        self._bad: int = 0
         self._last_msg_wall_ms: int | None = None
+        self.budget_msgs: int = 200
+        self.budget_us: int = 2000
+        self._budget_hits: int = 0
+        self._write_errors: int = 0
+        self._seq_lost: int = 0
+        self._last_seq: dict[tuple[int, int], int] = {}
+        self._stats: dict[str, TypeStats] = {}
+
+        for name in DEFAULT_TYPES:
+            self._add_type(name)
 
         self.add_command(
             "webotsrf",
             self.cmd_webotsrf,
-            "webots rangefinder forwarder",
-            ["status", "port"],
+            "webots sensor forwarder",
+            ["status", "port", "mode <passthrough|resend>", "types <list|add|remove|set>",
+             "budget <msgs> <usec>", "reset"],
         )
 
         self._open()
 
     def _open(self) -> None:
-        if self._link is not None:
+        if self._sock is not None:
             try:
-                self._link.close()
+                self._sock.close()
             except Exception:
                 pass
-            self._link = None
+            self._sock = None
 
-        # udpin: bind and receive MAVLink from Webots
-        self._link = mavutil.mavlink_connection(f"udpin:0.0.0.0:{self.port}")
+        # bind and receive MAVLink from Webots
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("0.0.0.0", self.port))
+        self._sock.setblocking(False)
+        self._reset_stats()
+        self.console.writeln(
+            f"[webotsrf] Listening on UDP :{self.port} (mode={self.mode}, types={self._type_names()})"
+        )
+
+    def _reset_stats(self) -> None:
         self._forwarded = 0
+        self._filtered = 0
+        self._bad = 0
+        self._budget_hits = 0
+        self._write_errors = 0
+        self._seq_lost = 0
+        self._last_seq = {}
+        self._stats = {}
         self._last_msg_wall_ms = None
-        self.console.writeln(f"[webotsrf] Listening on UDP :{self.port} (expecting DISTANCE_SENSOR)")
+
+    def _type_names(self) -> str:
+        return ",".join(sorted(self._types.values()))
+
+    def _add_type(self, name: str) -> bool:
+        msgid = msg_id_for(name)
+        if msgid is None:
+            return False
+        self._types[msgid] = name.upper()
+        return True
 
     def cmd_webotsrf(self, args) -> None:
+        usage = "usage: webotsrf <status|port|mode|types|budget|reset>"
         if not args:
-            self.console.writeln("usage: webotsrf <status|port>")
+            self.console.writeln(usage)
             return
 
         if args[0] == "status":
             last = "never" if self._last_msg_wall_ms is None else f"{(time.time()*1000 - self._last_msg_wall_ms):.0f}ms ago"
             self.console.writeln(
-                f"[webotsrf] port={self.port} forwarded={self._forwarded} last={last}"
+                f"[webotsrf] port={self.port} mode={self.mode} forwarded={self._forwarded} "
+                f"filtered={self._filtered} bad={self._bad} lost={self._seq_lost} "
+                f"write_errors={self._write_errors} budget_hits={self._budget_hits} "
+                f"budget={self.budget_msgs}msgs/{self.budget_us}us last={last}"
             )
+            now = time.monotonic()
+            for name, st in sorted(self._stats.items()):
+                latency = "n/a" if st.min_delay_ms is None else \
+                    f"{st.latency_ms:.1f}ms (max {st.max_latency_ms:.1f}ms)"
+                self.console.writeln(
+                    f"[webotsrf]   {name:<26} {st.current_rate(now):7.1f}Hz count={st.count} latency={latency}"
+                )
+            return
+
+        if args[0] == "reset":
+            self._reset_stats()
+            self.console.writeln("[webotsrf] statistics reset")
+            return
+
+        if args[0] == "budget":
+            if len(args) != 3:
+                self.console.writeln("usage: webotsrf budget <max_msgs_per_idle> <max_usec_per_idle>")
+                return
+            try:
+                self.budget_msgs = max(1, int(args[1]))
+                self.budget_us = max(1, int(args[2]))
+            except Exception:
+                self.console.writeln("[webotsrf] invalid budget")
+                return
+            self.console.writeln(f"[webotsrf] budget={self.budget_msgs}msgs/{self.budget_us}us")
             return
 
         if args[0] == "port":
@@ -75,54 +259,182 @@ class WebotsRF(mp_module.MPModule):
             self._open()
             return
 
-        self.console.writeln("usage: webotsrf <status|port>")
+        if args[0] == "mode":
+            if len(args) != 2 or args[1] not in ("passthrough", "resend"):
+                self.console.writeln("usage: webotsrf mode <passthrough|resend>")
+                return
+            self.mode = args[1]
+            self.console.writeln(f"[webotsrf] mode={self.mode}")
+            return
+
+        if args[0] == "types":
+            self._cmd_types(args[1:])
+            return
+
+        self.console.writeln(usage)
+
+    def _cmd_types(self, args) -> None:
+        if not args or args[0] == "list":
+            self.console.writeln(f"[webotsrf] types={self._type_names()}")
+            return
+
+        names = [n for a in args[1:] for n in a.split(",") if n]
+        if args[0] == "set":
+            self._types = {}
+        if args[0] in ("add", "set"):
+            for name in names:
+                if not self._add_type(name):
+                    self.console.writeln(f"[webotsrf] unknown message type {name}")
+        elif args[0] == "remove":
+            for name in names:
+                self._types.pop(msg_id_for(name), None)
+        else:
+            self.console.writeln("usage: webotsrf types <list|add|remove|set> [TYPE ...]")
+            return
+        self.console.writeln(f"[webotsrf] types={self._type_names()}")
 
     def idle_task(self) -> None:
-        if self._link is None:
+        if self._sock is None:
             return
 
-        # Drain available messages quickly
+        # Drain available datagrams, but only up to the budget; the rest waits in the
+        # socket buffer until the next idle call
+        start = time.perf_counter()
+        deadline = start + self.budget_us / 1e6
+        handled = 0
         while True:
-            msg = self._link.recv_msg()
-            if msg is None:
+            if handled >= self.budget_msgs or time.perf_counter() >= deadline:
+                self._budget_hits += 1
+                break
+            try:
+                data = self._sock.recv(65535)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
                 break
 
-            if msg.get_type() == "BAD_DATA":
-                continue
+            self._last_msg_wall_ms = int(time.time() * 1000)
+            if self.mode == "passthrough":
+                handled += self._forward_raw(data)
+            else:
+                handled += self._forward_decoded(data)
+
+    def _record(self, name: str, timestamp_ms: float | None) -> None:
+        """Update the rate meter and latency of a forwarded message."""
+        st = self._stats.get(name)
+        if st is None:
+            st = self._stats[name] = TypeStats()
+        st.add(time.monotonic())
+        if timestamp_ms:
+            st.add_delay(time.time() * 1000 - timestamp_ms)
+
+    def _check_seq(self, sysid: int, compid: int, seq: int) -> None:
+        """Count frames lost between Webots and us from gaps in the MAVLink sequence."""
+        key = (sysid, compid)
+        last = self._last_seq.get(key)
+        if last is not None:
+            gap = (seq - last - 1) & 0xFF
+            if gap < 128:  # larger gaps are restarts/reordering rather than loss
+                self._seq_lost += gap
+        self._last_seq[key] = seq
 
-            if msg.get_type() != "DISTANCE_SENSOR":
+    @staticmethod
+    def _raw_timestamp_ms(name: str, frame: bytes) -> float | None:
+        field = TIMESTAMP_FIELDS.get(name)
+        if field is None:
+            return None
+        offset, fmt, per_ms = field
+        header = 10 if frame[0] == MAVLINK_V2_STX else 6
+        size = struct.calcsize(fmt)
+        # MAVLink 2 truncates trailing zero bytes of the payload
+        raw = bytes(frame[header + offset:header + offset + size]).ljust(size, b"\0")
+        return struct.unpack(fmt, raw)[0] / per_ms
+
+    def _forward_raw(self, data: bytes) -> int:
+        """Write allowed frames to the master without decoding them. Returns frames seen."""
+        types = self._types
+        seen = 0
+        for msgid, start, end in iter_frames(data):
+            seen += 1
+            if msgid is None:
+                self._bad += 1
+                continue
+            if data[start] == MAVLINK_V2_STX:
+                self._check_seq(data[start + 5], data[start + 6], data[start + 4])
+            else:
+                self._check_seq(data[start + 3], data[start + 4], data[start + 2])
+            name = types.get(msgid)
+            if name is None:
+                self._filtered += 1
                 continue
+            frame = data if end - start == len(data) else data[start:end]
+            try:
+                self.master.write(frame)
+                self._forwarded += 1
+            except Exception:
+                # Avoid spamming; MAVProxy will keep running.
+                self._write_errors += 1
+                continue
+            self._record(name, self._raw_timestamp_ms(name, frame))
+        return seen
 
-            # Record receipt for status
-            self._last_msg_wall_ms = int(time.time() * 1000)
+    def _forward_decoded(self, data: bytes) -> int:
+        """Decode and re-serialize allowed messages through MAVProxy's MAVLink instance. Returns messages seen."""
+        try:
+            msgs = self._parser.parse_buffer(data) or []
+        except Exception:
+            self._bad += 1
+            return 1
+
+        for msg in msgs:
+            if msg.get_type() == "BAD_DATA":
+                self._bad += 1
+                continue
+            self._check_seq(msg.get_srcSystem(), msg.get_srcComponent(), msg.get_seq())
+            if msg.get_msgId() not in self._types:
+                self._filtered += 1
+                continue
 
             # Re-send via master so ArduPilot actually receives it.
             # Use MAVProxy's master MAVLink instance to serialize.
             try:
-                # Some dialects may not include all fields; use getattr with defaults.
-                time_boot_ms = int(getattr(msg, "time_boot_ms", self._last_msg_wall_ms))
-                min_distance = int(getattr(msg, "min_distance", 0))
-                max_distance = int(getattr(msg, "max_distance", 0))
-                current_distance = int(getattr(msg, "current_distance", 0))
-                sensor_type = int(getattr(msg, "type", mavutil.mavlink.MAV_DISTANCE_SENSOR_LASER))
-                sensor_id = int(getattr(msg, "id", 0))
-                orientation = int(getattr(msg, "orientation", 0))
-                covariance = int(getattr(msg, "covariance", 0))
-
-                self.master.mav.distance_sensor_send(
-                    time_boot_ms,
-                    min_distance,
-                    max_distance,
-                    current_distance,
-                    sensor_type,
-                    sensor_id,
-                    orientation,
-                    covariance,
-                )
+                if msg.get_type() == "DISTANCE_SENSOR":
+                    # Some dialects may not include all fields; use getattr with defaults.
+                    time_boot_ms = int(getattr(msg, "time_boot_ms", self._last_msg_wall_ms))
+                    min_distance = int(getattr(msg, "min_distance", 0))
+                    max_distance = int(getattr(msg, "max_distance", 0))
+                    current_distance = int(getattr(msg, "current_distance", 0))
+                    sensor_type = int(getattr(msg, "type", mavutil.mavlink.MAV_DISTANCE_SENSOR_LASER))
+                    sensor_id = int(getattr(msg, "id", 0))
+                    orientation = int(getattr(msg, "orientation", 0))
+                    covariance = int(getattr(msg, "covariance", 0))
+
+                    self.master.mav.distance_sensor_send(
+                        time_boot_ms,
+                        min_distance,
+                        max_distance,
+                        current_distance,
+                        sensor_type,
+                        sensor_id,
+                        orientation,
+                        covariance,
+                    )
+                else:
+                    self.master.mav.send(msg)
                 self._forwarded += 1
             except Exception:
                 # Avoid spamming; MAVProxy will keep running.
-                pass
+                self._write_errors += 1
+                continue
+
+            if hasattr(msg, "time_boot_ms"):
+                timestamp_ms = msg.time_boot_ms
+            elif hasattr(msg, "time_usec") or hasattr(msg, "usec"):
+                timestamp_ms = getattr(msg, "time_usec", getattr(msg, "usec", 0)) / 1000
+            else:
+                timestamp_ms = None
+            self._record(msg.get_type(), timestamp_ms)
+        return len(msgs)
 
 
 def init(mpstate):
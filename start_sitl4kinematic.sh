@@ -0,0 +1,73 @@
+#!/bin/bash
+
+# Webots を使わずに複数台の Rover SITL を回すための起動スクリプト
+# webots/Webots_Python/scripts/kinematic_rover_sim.py (運動学モデル) が
+# Webots コントローラと同じ UDP プロトコル (9002+10*i / 9003+10*i) で応答するので、
+# Webots の代わりにそのまま使える。Webots の描画が無いぶん --speedup で実時間より速く回せる。
+#
+# 使い方: ./start_sitl4kinematic.sh [台数] [speedup]
+#   例) ./start_sitl4kinematic.sh 4 10
+#
+# インスタンス i のポート:
+#   SITL        tcp:127.0.0.1:5760+10*i
+#   MAVProxy    --out udp:127.0.0.1:14552+10*i (バックエンドなど)
+#   webotsrf    UDP 14551+10*i (シミュレータからの DISTANCE_SENSOR)
+
+COUNT=${1:-1}
+SPEEDUP=${2:-10}
+
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+DEFAULTS_FILE="$SCRIPT_DIR/mav.parm"
+SIM_SCRIPT="$SCRIPT_DIR/webots/Webots_Python/scripts/kinematic_rover_sim.py"
+
+echo "=================================================="
+echo "🚀 Starting ArduPilot SITL x $COUNT (Kinematic Mode, speedup $SPEEDUP)"
+echo "=================================================="
+
+# 1. 運動学シミュレータ (全台を 1 プロセスで計算)
+python3 "$SIM_SCRIPT" --vehicles "$COUNT" &
+PIDS="$!"
+
+# ArduPilotのディレクトリへ移動 (インスタンスごとに eeprom.bin を分ける)
+cd ~/GitHub/ardupilot/Rover
+
+# 2. SITL (ardurover) をインスタンスごとに起動
+for ((i = 0; i < COUNT; i++)); do
+    mkdir -p "kinematic_$i"
+    (cd "kinematic_$i" && ../../build/sitl/bin/ardurover \
+        --model webots-python \
+        --defaults "$DEFAULTS_FILE" \
+        -I "$i" \
+        --speedup "$SPEEDUP" \
+        --sim-address 127.0.0.1 \
+        --sim-port-out $((9002 + 10 * i)) \
+        --sim-port-in $((9003 + 10 * i)) \
+        > /dev/null 2>&1) &
+    PIDS="$PIDS $!"
+done
+echo "SITL started (PIDs $PIDS)"
+
+# SITLの起動待ち
+sleep 3
+
+# 3. MAVProxy をインスタンスごとに起動 (最後の 1 台以外はバックグラウンド)
+# webotsrf の待ち受けポートはインスタンスごとにずらす
+export PYTHONPATH="$SCRIPT_DIR/mavproxy_modules:$PYTHONPATH"
+for ((i = 0; i < COUNT; i++)); do
+    ARGS=(--master tcp:127.0.0.1:$((5760 + 10 * i))
+          --out udp:127.0.0.1:$((14552 + 10 * i))
+          --load-module webotsrf
+          --cmd "webotsrf port $((14551 + 10 * i))"
+          --state-basedir "/tmp/mavproxy_kinematic_$i")
+    mkdir -p "/tmp/mavproxy_kinematic_$i"
+    if ((i < COUNT - 1)); then
+        mavproxy.py "${ARGS[@]}" --daemon > /dev/null 2>&1 &
+        PIDS="$PIDS $!"
+    else
+        mavproxy.py "${ARGS[@]}"
+    fi
+done
+
+# MAVProxy終了時にSITLとシミュレータも終了させる
+echo "Stopping SITL..."
+kill $PIDS
@@ -12,6 +12,15 @@ import argparse
 from webots_vehicle import WebotsArduVehicle
 
 
+def str_to_bool(value: str) -> bool:
+    """argparse type for "true"/"false"/"1"/"0" (type=bool would treat "false" as True)"""
+    if value.strip().lower() in ("1", "true", "yes", "on"):
+        return True
+    if value.strip().lower() in ("0", "false", "no", "off"):
+        return False
+    raise argparse.ArgumentTypeError(f"expected a boolean, got '{value}'")
+
+
 def get_args():
     parser = argparse.ArgumentParser()
 
@@ -24,13 +33,17 @@ def get_args():
                         default=None,
                         help="Comma spaced list of motors to reverse (starting from 1, in ardupilot order)")
     parser.add_argument("--bidirectional-motors",
-                        type=bool,
+                        type=str_to_bool,
                         default=False,
                         help="If the motors are bidirectional (as is the case for Rovers usually)")
     parser.add_argument("--uses-propellers",
-                        type=bool,
+                        type=str_to_bool,
                         default=True,
                         help="Whether the vehicle uses propellers. This is important as we need to linearize thrust if so")
+    parser.add_argument("--mixer",
+                        type=str,
+                        default="skid",
+                        help="Servo to motor mixer: skid, direct, ackermann or a JSON file (see motor_mixer.py)")
     parser.add_argument("--motor-cap",
                         type=float,
                         default=float('inf'),
@@ -80,11 +93,54 @@ def get_args():
                         default=None,
                         help="Port to stream grayscale rangefinder images to. "
                              "If no port is supplied the rangefinder will not be streamed.")
+    parser.add_argument("--rangefinder-format",
+                        type=str,
+                        choices=["uint8", "uint16", "float32"],
+                        default="uint8",
+                        help="Streamed rangefinder pixel format: normalized uint8/uint16 or float32 metric depth "
+                             "(extended stream and shm only, legacy stream clients always get uint8)")
+    parser.add_argument("--obstacle-distance-rate",
+                        type=float,
+                        default=0,
+                        help="Rate (Hz) to send the rangefinder image to ArduPilot as OBSTACLE_DISTANCE "
+                             "for proximity avoidance (PRX1_TYPE=2). 0 disables it")
+    parser.add_argument("--occupancy-port",
+                        type=int,
+                        default=None,
+                        help="Build an occupancy grid from the rangefinder and vehicle pose and serve it as map tiles "
+                             "over HTTP on this port (on --stream-address). If no port is supplied there is no map")
+    parser.add_argument("--occupancy-resolution",
+                        type=float,
+                        default=0.2,
+                        help="Occupancy grid cell size in metres")
+    parser.add_argument("--occupancy-size",
+                        type=float,
+                        default=400.0,
+                        help="Side of the square mapped around the SITL home in metres")
+    parser.add_argument("--occupancy-home",
+                        type=str,
+                        default=None,
+                        help="\"LAT,LON\" of the SITL home so the GCS can place the map "
+                             "(default: the GCS anchors it on the vehicle position)")
 
     parser.add_argument("--sonar",
                         type=str,
                         default=None,
                         help="Webots DistanceSensor name for front sonar (optional)")
+    parser.add_argument("--distance-rate",
+                        type=float,
+                        default=10,
+                        help="Rate (Hz) to send the sonar to ArduPilot as DISTANCE_SENSOR")
+    parser.add_argument("--image-transport",
+                        type=str,
+                        choices=["tcp", "shm"],
+                        default="tcp",
+                        help="Stream camera/rangefinder images over TCP, or through a shared memory ring buffer "
+                             "for local consumers (the stream ports then carry UDP new frame notifications)")
+    parser.add_argument("--stream-address",
+                        type=str,
+                        default="127.0.0.1",
+                        help="Address the TCP image streams listen on (\"0.0.0.0\" to allow remote consumers)")
 
     parser.add_argument("--instance", "-i",
                         type=int,
@@ -94,6 +150,23 @@ def get_args():
                         type=str,
                         default="127.0.0.1",
                         help="IP address of the SITL (useful with WSL2 eg \"172.24.220.98\")")
+    parser.add_argument("--trace",
+                        type=str,
+                        default=None,
+                        help="Record phase timings and write them as Chrome trace JSON to this file when Webots "
+                             "closes (open in ui.perfetto.dev or chrome://tracing)")
+    parser.add_argument("--trace-size",
+                        type=int,
+                        default=1 << 16,
+                        help="Phase samples kept in the trace ring buffer (the latest ones are written)")
+    parser.add_argument("--preview-fps",
+                        type=float,
+                        default=10,
+                        help="Max rate of the camera preview window (only redrawn on new frames). 0 runs headless")
+    parser.add_argument("--preview-downscale",
+                        type=int,
+                        default=2,
+                        help="Show every n-th camera pixel in the preview window")
 
     return parser.parse_args()
 
@@ -108,6 +181,10 @@ if __name__ == "__main__":
     else:
         reversed_motors = []
 
+    occupancy_home = None
+    if args.occupancy_home:
+        occupancy_home = tuple(float(x) for x in args.occupancy_home.split(","))
+
     vehicle = WebotsArduVehicle(motor_names=motors,
                                 reversed_motors=reversed_motors,
                                 accel_name=args.accel,
@@ -120,16 +197,35 @@ if __name__ == "__main__":
                                 rangefinder_name=args.rangefinder,
                                 rangefinder_fps=args.rangefinder_fps,
                                 rangefinder_stream_port=args.rangefinder_port,
+                                rangefinder_depth_format=args.rangefinder_format,
+                                obstacle_distance_rate=args.obstacle_distance_rate,
+                                occupancy_port=args.occupancy_port,
+                                occupancy_resolution=args.occupancy_resolution,
+                                occupancy_size=args.occupancy_size,
+                                occupancy_home=occupancy_home,
                                 sonar_name=args.sonar,
+                                distance_rate=args.distance_rate,
+                                image_transport=args.image_transport,
+                                stream_address=args.stream_address,
                                 instance=args.instance,
                                 motor_velocity_cap=args.motor_cap,
                                 bidirectional_motors=args.bidirectional_motors,
                                 uses_propellers=args.uses_propellers,
-                                sitl_address=args.sitl_address)
+                                mixer=args.mixer,
+                                sitl_address=args.sitl_address,
+                                trace_path=args.trace,
+                                trace_capacity=args.trace_size,
+                                preview_fps=args.preview_fps,
+                                preview_downscale=args.preview_downscale)
 
     # User code (ex: connect via drone kit and take off)
     # ...
 
-    while vehicle.webots_connected():
-        vehicle.update_gui()
-        time.sleep(0.01)
+    # headless: nothing to do on the main thread but wait for Webots to close
+    poll_period = 0.01 if vehicle.preview_enabled() else 0.1
+    try:
+        while vehicle.webots_connected():
+            vehicle.update_gui()
+            time.sleep(poll_period)
+    finally:
+        vehicle.dump_trace()
@@ -0,0 +1,260 @@
+'''
+Memory-mapped frame ring buffer shared between WebotsArduVehicle and local vision consumers
+
+The writer owns a file (in /dev/shm where available) split into a fixed header and
+N frame slots. Each slot carries a sequence number and sim timestamp in front of the
+pixel data, so a reader can map the newest frame as a NumPy array without copying
+and later check that the writer has not reused the slot in the meantime.
+An optional UDP datagram on localhost notifies readers of every new frame.
+
+AP_FLAKE8_CLEAN
+'''
+
+import os
+import mmap
+import time
+import select
+import socket
+import struct
+import tempfile
+import numpy as np
+from typing import Optional, Tuple
+
+RING_MAGIC = b'WBFR'
+RING_VERSION = 1
+
+# magic, version, slots, width, height, channels, dtype str, slot stride, write seq
+_header_format = '<4sHHIII4sQQ'
+_header_size = 64
+_write_seq_offset = struct.calcsize('<4sHHIII4sQ')
+
+# seq, sim timestamp
+_slot_header_format = '<Qd'
+_slot_header_size = 64  # keep pixel data cache line aligned
+
+_notify_format = '<Q'
+
+
+def frame_ring_path(name: str) -> str:
+    """Get the path of the backing file for a ring buffer name
+
+    Args:
+        name (str): ring name (ex "webots_camera_I0")
+
+    Returns:
+        str: /dev/shm/<name> on Linux, <tempdir>/<name> elsewhere
+    """
+    shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(shm_dir, name)
+
+
+class FrameRingWriter():
+    """Producer side of the frame ring buffer"""
+
+    def __init__(self,
+                 path: str,
+                 shape: Tuple[int, ...],
+                 dtype=np.uint8,
+                 slots: int = 4,
+                 notify_port: int = None):
+        """FrameRingWriter constructor
+
+        Args:
+            path (str): backing file path, see frame_ring_path()
+            shape (tuple): frame shape, (height, width) or (height, width, channels)
+            dtype (optional): frame dtype. Defaults to np.uint8.
+            slots (int, optional): number of frame slots. Readers have slots-1 frame periods
+                                   to finish with a frame before it is overwritten. Defaults to 4.
+            notify_port (int, optional): localhost UDP port to notify readers of new frames. Defaults to None.
+        """
+        height, width = shape[:2]
+        channels = shape[2] if len(shape) > 2 else 1
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+
+        frame_size = height * width * channels * self.dtype.itemsize
+        self._slot_stride = _slot_header_size + (frame_size + 63) // 64 * 64
+        size = _header_size + self._slot_stride * slots
+
+        self.path = path
+        self._file = open(path, "w+b")
+        self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+
+        struct.pack_into(_header_format, self._mmap, 0,
+                         RING_MAGIC, RING_VERSION, slots,
+                         width, height, channels,
+                         self.dtype.str.encode(), self._slot_stride, 0)
+
+        # writable views over each slot, created once
+        self._frames = [np.ndarray(self.shape, self.dtype, buffer=self._mmap,
+                                   offset=self._slot_offset(i) + _slot_header_size)
+                        for i in range(slots)]
+        self._seq = 0
+
+        self._notify_sock = None
+        self._notify_addr = None
+        if notify_port is not None:
+            self._notify_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._notify_sock.setblocking(False)
+            self._notify_addr = ("127.0.0.1", notify_port)
+
+    def _slot_offset(self, index: int) -> int:
+        return _header_size + index * self._slot_stride
+
+    def next_frame(self) -> np.ndarray:
+        """Get a writable view of the slot the next frame goes into
+
+        Fill it in place and call publish() to avoid an extra copy.
+        The slot is marked invalid until publish() is called.
+        """
+        index = self._seq % self.slots
+        struct.pack_into(_slot_header_format, self._mmap, self._slot_offset(index), 0, 0.0)
+        return self._frames[index]
+
+    def publish(self, timestamp: float):
+        """Publish the frame written into next_frame()
+
+        Args:
+            timestamp (float): sim time of the frame in seconds
+        """
+        index = self._seq % self.slots
+        self._seq += 1
+        struct.pack_into(_slot_header_format, self._mmap, self._slot_offset(index), self._seq, timestamp)
+        struct.pack_into('<Q', self._mmap, _write_seq_offset, self._seq)
+
+        if self._notify_sock is not None:
+            try:
+                self._notify_sock.sendto(struct.pack(_notify_format, self._seq), self._notify_addr)
+            except OSError:
+                # nobody listening (or buffer full), readers can still poll
+                pass
+
+    def write(self, img: np.ndarray, timestamp: float):
+        """Copy a frame into the ring and publish it
+
+        Args:
+            img (np.ndarray): frame matching the ring shape
+            timestamp (float): sim time of the frame in seconds
+        """
+        np.copyto(self.next_frame(), img.reshape(self.shape), casting='unsafe')
+        self.publish(timestamp)
+
+    def close(self):
+        """Release the mapping and remove the backing file"""
+        self._frames = []
+        if self._notify_sock is not None:
+            self._notify_sock.close()
+        self._mmap.close()
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class FrameRingReader():
+    """Consumer side of the frame ring buffer"""
+
+    def __init__(self, path: str, notify_port: int = None):
+        """FrameRingReader constructor
+
+        Args:
+            path (str): backing file path, see frame_ring_path()
+            notify_port (int, optional): localhost UDP port the writer notifies on.
+                                         If None, wait() polls the write sequence. Defaults to None.
+        """
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.slots,
+         width, height, channels,
+         dtype, self._slot_stride, _) = struct.unpack_from(_header_format, self._mmap, 0)
+        if magic != RING_MAGIC or version != RING_VERSION:
+            raise ValueError(f"{path} is not a frame ring (magic={magic}, version={version})")
+
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.dtype = np.dtype(dtype.rstrip(b'\0').decode())
+        self.shape = (height, width) if channels == 1 else (height, width, channels)
+
+        # read-only views over each slot, created once
+        self._frames = [np.ndarray(self.shape, self.dtype, buffer=self._mmap,
+                                   offset=self._slot_offset(i) + _slot_header_size)
+                        for i in range(self.slots)]
+        self._last_seq = 0
+
+        self._notify_sock = None
+        if notify_port is not None:
+            self._notify_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._notify_sock.bind(("127.0.0.1", notify_port))
+            self._notify_sock.setblocking(False)
+
+    def _slot_offset(self, index: int) -> int:
+        return _header_size + index * self._slot_stride
+
+    def write_seq(self) -> int:
+        """Get the sequence number of the newest published frame (0 if none yet)"""
+        return struct.unpack_from('<Q', self._mmap, _write_seq_offset)[0]
+
+    def wait(self, timeout: float = None) -> bool:
+        """Wait until a frame newer than the last one returned by latest() is available
+
+        Args:
+            timeout (float, optional): seconds to wait, None waits forever. Defaults to None.
+
+        Returns:
+            bool: True if a new frame is available
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.write_seq() <= self._last_seq:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            if self._notify_sock is not None:
+                if select.select([self._notify_sock], [], [], remaining)[0]:
+                    self._drain_notifications()
+            else:
+                time.sleep(0.001 if remaining is None else min(0.001, remaining))
+        return True
+
+    def _drain_notifications(self):
+        try:
+            while True:
+                self._notify_sock.recv(64)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def latest(self) -> Optional[Tuple[int, float, np.ndarray]]:
+        """Get the newest frame without copying
+
+        Returns:
+            tuple: (seq, sim timestamp, read-only frame view) or None if no frame has been published.
+                   The view is only valid while is_valid(seq) is True, copy it to keep it longer.
+        """
+        seq = self.write_seq()
+        if seq == 0:
+            return None
+        index = (seq - 1) % self.slots
+        slot_seq, timestamp = struct.unpack_from(_slot_header_format, self._mmap, self._slot_offset(index))
+        if slot_seq != seq:
+            # the writer lapped us between reading the header and the slot, try again
+            return self.latest()
+        self._last_seq = seq
+        return seq, timestamp, self._frames[index]
+
+    def is_valid(self, seq: int) -> bool:
+        """Check that the frame with sequence number seq has not been overwritten yet"""
+        index = (seq - 1) % self.slots
+        return struct.unpack_from('<Q', self._mmap, self._slot_offset(index))[0] == seq
+
+    def close(self):
+        """Release the mapping"""
+        self._frames = []
+        if self._notify_sock is not None:
+            self._notify_sock.close()
+        self._mmap.close()
+        self._file.close()
@@ -0,0 +1,296 @@
+'''
+Extended camera/rangefinder TCP stream protocol used by WebotsArduVehicle
+
+Legacy clients connect and just read `=HH` (width, height) + raw grayscale frames.
+Clients that want more send a hello right after connecting:
+
+    hello  = <4sBBBB  magic "WBIM", version, format, channels, quality
+
+and every frame is then preceded by an extended header:
+
+    header = <4sBBBBBxHHIdI  magic "WBIM", version, format, channels, dtype, flags,
+                             width, height, seq, sim timestamp, payload length
+
+The header carries the format actually used, so a server that cannot honour a
+request (ex. no OpenCV for JPEG) falls back to FORMAT_RAW and the client still decodes.
+
+AP_FLAKE8_CLEAN
+'''
+
+import zlib
+import queue
+import socket
+import select
+import struct
+import numpy as np
+from threading import Thread, Event
+from typing import Optional, Tuple
+from phase_trace import NULL_TRACER
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+STREAM_MAGIC = b'WBIM'
+STREAM_VERSION = 1
+
+FORMAT_RAW = 0
+FORMAT_JPEG = 1
+FORMAT_PNG = 2
+FORMAT_DELTA = 3  # zlib compressed XOR against the previous frame
+FORMAT_NAMES = {"raw": FORMAT_RAW, "jpeg": FORMAT_JPEG, "png": FORMAT_PNG, "delta": FORMAT_DELTA}
+
+DTYPE_UINT8 = 0
+DTYPE_UINT16 = 1
+DTYPE_FLOAT32 = 2
+DTYPES = {DTYPE_UINT8: np.dtype(np.uint8), DTYPE_UINT16: np.dtype('<u2'), DTYPE_FLOAT32: np.dtype('<f4')}
+
+FLAG_KEYFRAME = 0x01
+
+hello_format = '<4sBBBB'
+hello_size = struct.calcsize(hello_format)
+header_format = '<4sBBBBBxHHIdI'
+header_size = struct.calcsize(header_format)
+legacy_header_format = '=HH'
+legacy_header_size = struct.calcsize(legacy_header_format)
+
+
+def dtype_code(dtype) -> int:
+    """Get the header dtype code for a NumPy dtype"""
+    dtype = np.dtype(dtype)
+    for code, dt in DTYPES.items():
+        if dt.kind == dtype.kind and dt.itemsize == dtype.itemsize:
+            return code
+    raise ValueError(f"Unsupported stream dtype {dtype}")
+
+
+def read_hello(conn: socket.socket, timeout: float = 0.5) -> Optional[Tuple[int, int, int]]:
+    """Wait briefly for a client hello after accepting a connection
+
+    Args:
+        conn (socket.socket): accepted client connection
+        timeout (float, optional): seconds to wait before assuming a legacy client. Defaults to 0.5.
+
+    Returns:
+        tuple: (format, channels, quality) or None for legacy clients
+    """
+    if not select.select([conn], [], [], timeout)[0]:
+        return None
+    data = conn.recv(hello_size, socket.MSG_PEEK)
+    if len(data) < len(STREAM_MAGIC) or not data.startswith(STREAM_MAGIC):
+        return None
+    hello = recv_exact(conn, hello_size)
+    _, _, fmt, channels, quality = struct.unpack(hello_format, hello)
+    return fmt, channels, quality
+
+
+def recv_exact(conn: socket.socket, size: int) -> bytes:
+    """Receive exactly size bytes (raises ConnectionResetError on EOF)"""
+    buf = bytearray(size)
+    recv_into_exact(conn, memoryview(buf))
+    return bytes(buf)
+
+
+def recv_into_exact(conn: socket.socket, view: memoryview):
+    """Fill a preallocated buffer from the socket without intermediate copies"""
+    pos = 0
+    while pos < len(view):
+        n = conn.recv_into(view[pos:])
+        if n == 0:
+            raise ConnectionResetError("image stream closed")
+        pos += n
+
+
+class FrameEncoder():
+    """Encode frames for the extended stream"""
+
+    def __init__(self, fmt: int = FORMAT_RAW, quality: int = 80, keyframe_interval: int = 30):
+        """FrameEncoder constructor
+
+        Args:
+            fmt (int, optional): one of the FORMAT_* constants. Defaults to FORMAT_RAW.
+            quality (int, optional): JPEG quality (0-100) or PNG compression (0-9). Defaults to 80.
+            keyframe_interval (int, optional): frames between full frames in FORMAT_DELTA. Defaults to 30.
+        """
+        if fmt in (FORMAT_JPEG, FORMAT_PNG) and cv2 is None:
+            print("Warning: OpenCV not available, image stream falls back to raw frames")
+            fmt = FORMAT_RAW
+        self.format = fmt
+        self.quality = quality
+        self.keyframe_interval = keyframe_interval
+        self._prev = None
+        self._since_keyframe = 0
+
+    def encode(self, img: np.ndarray) -> Tuple[int, int, bytes]:
+        """Encode a frame
+
+        Args:
+            img (np.ndarray): (height, width) or (height, width, 3) RGB frame
+
+        Returns:
+            tuple: (format, flags, payload)
+        """
+        if self.format == FORMAT_JPEG and img.dtype == np.uint8:
+            bgr = img[:, :, ::-1] if img.ndim == 3 else img
+            ok, buf = cv2.imencode(".jpg", bgr, [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)])
+            if ok:
+                return FORMAT_JPEG, FLAG_KEYFRAME, buf.tobytes()
+        elif self.format == FORMAT_PNG and img.dtype in (np.uint8, np.uint16):
+            bgr = img[:, :, ::-1] if img.ndim == 3 else img
+            ok, buf = cv2.imencode(".png", bgr, [cv2.IMWRITE_PNG_COMPRESSION, min(int(self.quality), 9)])
+            if ok:
+                return FORMAT_PNG, FLAG_KEYFRAME, buf.tobytes()
+        elif self.format == FORMAT_DELTA:
+            return self._encode_delta(img)
+        return FORMAT_RAW, FLAG_KEYFRAME, img.tobytes()
+
+    def _encode_delta(self, img: np.ndarray) -> Tuple[int, int, bytes]:
+        raw = np.ascontiguousarray(img).view(np.uint8)
+        keyframe = (self._prev is None or self._prev.shape != raw.shape
+                    or self._since_keyframe >= self.keyframe_interval)
+        if keyframe:
+            self._prev = raw.copy()
+            self._since_keyframe = 0
+            return FORMAT_DELTA, FLAG_KEYFRAME, zlib.compress(raw, 1)
+        # unchanged pixels XOR to zero and compress to almost nothing
+        np.bitwise_xor(raw, self._prev, out=self._prev)
+        payload = zlib.compress(self._prev, 1)
+        np.copyto(self._prev, raw)
+        self._since_keyframe += 1
+        return FORMAT_DELTA, 0, payload
+
+
+class FrameSender():
+    """Encode and send frames on a worker thread, always sending the newest frame"""
+
+    def __init__(self, conn: socket.socket, encoder: FrameEncoder, trace=NULL_TRACER):
+        """FrameSender constructor
+
+        Args:
+            conn (socket.socket): connected client
+            encoder (FrameEncoder): encoder for the negotiated format
+            trace (PhaseTracer, optional): records image.encode / image.send phases. Defaults to NULL_TRACER.
+        """
+        self._conn = conn
+        self._encoder = encoder
+        self._trace = trace
+        self._frames = queue.Queue(maxsize=1)
+        self._stopped = Event()
+        self.dropped = 0
+        self._thread = Thread(daemon=True, name="frame_sender", target=self._run)
+        self._thread.start()
+
+    def alive(self) -> bool:
+        """Check that the client is still connected"""
+        return not self._stopped.is_set()
+
+    def submit(self, seq: int, timestamp: float, img: np.ndarray):
+        """Queue a frame, replacing any frame the encoder has not picked up yet
+
+        The array must not be modified afterwards (pass a copy of reused buffers).
+        """
+        try:
+            self._frames.put_nowait((seq, timestamp, img))
+        except queue.Full:
+            try:
+                self._frames.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            self._frames.put_nowait((seq, timestamp, img))
+
+    def close(self):
+        """Stop the worker thread"""
+        self._stopped.set()
+        try:
+            self._frames.put_nowait(None)
+        except queue.Full:
+            pass
+        self._thread.join(timeout=1.0)
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set():
+                item = self._frames.get()
+                if item is None:
+                    break
+                seq, timestamp, img = item
+                t0 = self._trace.start()
+                fmt, flags, payload = self._encoder.encode(img)
+                self._trace.stop("image.encode", t0)
+                channels = img.shape[2] if img.ndim == 3 else 1
+                header = struct.pack(header_format, STREAM_MAGIC, STREAM_VERSION,
+                                     fmt, channels, dtype_code(img.dtype), flags,
+                                     img.shape[1], img.shape[0], seq & 0xFFFFFFFF,
+                                     timestamp, len(payload))
+                t0 = self._trace.start()
+                self._conn.sendall(header + payload)
+                self._trace.stop("image.send", t0)
+        except (ConnectionResetError, BrokenPipeError, OSError):
+            pass
+        finally:
+            self._stopped.set()
+
+
+class ImageStreamClient():
+    """Client for the extended stream, see the module docstring for the protocol"""
+
+    def __init__(self,
+                 address: str = "127.0.0.1",
+                 port: int = 5599,
+                 fmt: int = FORMAT_RAW,
+                 channels: int = 1,
+                 quality: int = 80):
+        """ImageStreamClient constructor
+
+        Args:
+            address (str, optional): WebotsArduVehicle address. Defaults to "127.0.0.1".
+            port (int, optional): camera/rangefinder stream port. Defaults to 5599.
+            fmt (int, optional): requested FORMAT_* constant. Defaults to FORMAT_RAW.
+            channels (int, optional): 1 for grayscale, 3 for RGB (camera only). Defaults to 1.
+            quality (int, optional): JPEG quality or PNG compression level. Defaults to 80.
+        """
+        self._sock = socket.create_connection((address, port))
+        self._sock.sendall(struct.pack(hello_format, STREAM_MAGIC, STREAM_VERSION, fmt, channels, quality))
+        self._header = bytearray(header_size)
+        self._payload = bytearray(0)
+        self._prev = None
+
+    def recv(self) -> Tuple[dict, np.ndarray]:
+        """Receive and decode the next frame
+
+        Returns:
+            tuple: (header fields dict, frame array). Raw/delta colour frames are RGB,
+                   JPEG/PNG frames are decoded with OpenCV and therefore BGR.
+                   Raw/delta frames reuse the receive buffers and are only valid until the next recv().
+        """
+        recv_into_exact(self._sock, memoryview(self._header))
+        (magic, version, fmt, channels, dtype, flags,
+         width, height, seq, timestamp, length) = struct.unpack(header_format, self._header)
+        if magic != STREAM_MAGIC:
+            raise ValueError("image stream out of sync")
+
+        if len(self._payload) < length:
+            self._payload = bytearray(length)
+        payload = memoryview(self._payload)[:length]
+        recv_into_exact(self._sock, payload)
+
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        if fmt in (FORMAT_JPEG, FORMAT_PNG):
+            img = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_UNCHANGED)
+        elif fmt == FORMAT_DELTA:
+            raw = np.frombuffer(zlib.decompress(payload), np.uint8)
+            if flags & FLAG_KEYFRAME or self._prev is None or self._prev.size != raw.size:
+                self._prev = raw.copy()
+            else:
+                np.bitwise_xor(self._prev, raw, out=self._prev)
+            img = self._prev.view(DTYPES[dtype]).reshape(shape)
+        else:
+            img = np.frombuffer(payload, DTYPES[dtype]).reshape(shape)
+
+        info = {"format": fmt, "channels": channels, "seq": seq, "timestamp": timestamp,
+                "keyframe": bool(flags & FLAG_KEYFRAME), "size": length}
+        return info, img
+
+    def close(self):
+        self._sock.close()
@@ -0,0 +1,130 @@
+'''
+Table-driven motor mixer for WebotsArduVehicle
+
+ArduPilot SITL sends up to 16 servo outputs (0.0-1.0, -1 when not set). The mixer
+turns them into motor commands with a single matrix-vector product:
+
+    inputs  = selected servo channels, optionally centred to -1.0..1.0
+    outputs = clip(matrix @ inputs)          (one row per motor)
+    motor   = outputs * scale                 (per motor limit and sign, cached)
+
+Mixers are built from a preset name ("skid", "direct", "ackermann") or a JSON file:
+
+    {
+        "channels": [1, 3],                 servo channels used as inputs (1-indexed)
+        "centered": true,                   map 0..1 to -1..1 (bidirectional inputs)
+        "matrix": [[1, 1], [1, 1], [-1, 1], [-1, 1]],
+        "propellers": false,                linearize thrust (sqrt) as for MOT_THST_EXPO=0
+        "outputs": ["velocity", ...],       per motor "velocity" or "position"
+        "scale": [1.0, ...]                 velocity: fraction of the motor limit,
+                                            position: radians at full deflection
+    }
+
+AP_FLAKE8_CLEAN
+'''
+
+import json
+import operator
+import os
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+PRESETS = ("skid", "direct", "ackermann")
+
+
+def preset_config(name: str, motor_count: int, bidirectional: bool = False, uses_propellers: bool = True) -> dict:
+    """Build the config of a preset mixer for motor_count motors
+
+    Args:
+        name (str): "skid" (RC1 steering, RC3 throttle, first half of the motors on the left),
+                    "direct" (SERVOn drives motor n, as ArduPilot's own Webots example),
+                    or "ackermann" (motors: [left drive, right drive, left steering, right steering])
+        motor_count (int): number of motors
+        bidirectional (bool, optional): "direct" only, inputs are centred. Defaults to False.
+        uses_propellers (bool, optional): "direct" only, linearize thrust. Defaults to True.
+    """
+    if name == "skid":
+        left = motor_count - motor_count // 2
+        matrix = [[1, 1]] * left + [[-1, 1]] * (motor_count - left)
+        return {"channels": [1, 3], "centered": True, "matrix": matrix, "propellers": False}
+    if name == "direct":
+        return {"channels": list(range(1, motor_count + 1)), "centered": bidirectional,
+                "matrix": np.eye(motor_count).tolist(), "propellers": uses_propellers}
+    if name == "ackermann":
+        if motor_count != 4:
+            raise ValueError("ackermann mixer expects 4 motors: left drive, right drive, left steer, right steer")
+        return {"channels": [1, 3], "centered": True, "propellers": False,
+                "matrix": [[0, 1], [0, 1], [1, 0], [1, 0]],
+                "outputs": ["velocity", "velocity", "position", "position"],
+                "scale": [1.0, 1.0, 0.5, 0.5]}
+    raise ValueError(f"Unknown mixer preset '{name}' (expected one of {PRESETS} or a JSON file)")
+
+
+def load_config(spec: str, motor_count: int, **kwargs) -> dict:
+    """Load a mixer config from a preset name or a JSON file path"""
+    if spec in PRESETS:
+        return preset_config(spec, motor_count, **kwargs)
+    if not os.path.exists(spec):
+        raise ValueError(f"Mixer '{spec}' is neither a preset {PRESETS} nor an existing file")
+    with open(spec, "r") as f:
+        return json.load(f)
+
+
+class MotorMixer():
+    """Servo outputs -> motor commands as one matrix-vector product"""
+
+    def __init__(self,
+                 config: dict,
+                 motor_limits: Sequence[float],
+                 reversed_motors: Optional[List[int]] = None):
+        """MotorMixer constructor
+
+        Args:
+            config (dict): mixer config (see module docstring)
+            motor_limits (Sequence[float]): max velocity per motor (rad/s), already capped
+            reversed_motors (list[int], optional): motors to reverse (indexed from 1). Defaults to None.
+        """
+        motor_count = len(motor_limits)
+        self.matrix = np.asarray(config["matrix"], dtype=np.float64)
+        self.channels = np.asarray(config["channels"], dtype=np.intp) - 1
+        # picking the channels from the tuple before converting is cheaper than converting all 16
+        picker = operator.itemgetter(*self.channels.tolist())
+        self._pick = picker if len(self.channels) > 1 else (lambda command: (picker(command),))
+        if self.matrix.shape != (motor_count, len(self.channels)):
+            raise ValueError(f"Mixer matrix is {self.matrix.shape}, expected ({motor_count}, {len(self.channels)}) "
+                             f"for {motor_count} motors and channels {config['channels']}")
+        self.centered = bool(config.get("centered", False))
+        self.propellers = bool(config.get("propellers", False))
+
+        outputs = config.get("outputs", ["velocity"] * motor_count)
+        self.is_position = np.array([o == "position" for o in outputs])
+        scale = np.asarray(config.get("scale", [1.0] * motor_count), dtype=np.float64)
+        # velocity outputs scale to the motor limit, position outputs are in radians
+        scale = np.where(self.is_position, scale, scale * np.asarray(motor_limits, dtype=np.float64))
+        for m in reversed_motors or []:
+            scale[m - 1] *= -1
+        self.scale = scale
+        # unidirectional motors can't spin backwards
+        self.low = -1.0 if self.centered else 0.0
+        # input when a channel has no output yet (-1): centre / zero
+        self._neutral = 0.5 if self.centered else 0.0
+
+    def mix(self, command: Sequence[float]) -> np.ndarray:
+        """Compute the motor commands (rad/s for velocity outputs, rad for position outputs)
+
+        Args:
+            command (Sequence[float]): servo outputs from SITL (0.0-1.0, -1 if not set)
+        """
+        raw = np.array(self._pick(command), dtype=np.float64)
+        raw[raw == -1] = self._neutral
+        if self.centered:
+            raw = raw * 2 - 1
+        out = self.matrix @ raw
+        # np.clip has a large fixed overhead for arrays this small
+        np.minimum(out, 1.0, out=out)
+        np.maximum(out, self.low, out=out)
+        if self.propellers:
+            out = np.sign(out) * np.sqrt(np.abs(out))
+        out *= self.scale
+        return out
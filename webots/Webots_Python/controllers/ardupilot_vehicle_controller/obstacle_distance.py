@@ -0,0 +1,103 @@
+'''
+Reduce rangefinder depth frames to MAVLink OBSTACLE_DISTANCE sectors
+
+ArduPilot's MAVLink proximity backend (PRX1_TYPE = 2) takes OBSTACLE_DISTANCE:
+72 distances in cm covering the horizon in `increment` degree steps clockwise from
+`angle_offset`. The reducer takes the closest return of each image column in a band
+of rows around the horizon, then the closest column of each sector. The column to
+sector mapping only depends on the sensor so it is computed once.
+
+AP_FLAKE8_CLEAN
+'''
+
+import math
+import numpy as np
+from typing import Tuple
+
+OBSTACLE_SECTORS = 72
+UNKNOWN_DISTANCE = 65535  # UINT16_MAX: no data for this sector
+
+
+class ObstacleSectorReducer():
+    """Vectorized depth image -> OBSTACLE_DISTANCE distances[72] reduction"""
+
+    def __init__(self,
+                 width: int,
+                 height: int,
+                 fov: float,
+                 min_range: float,
+                 max_range: float,
+                 increment: float = 360 / OBSTACLE_SECTORS,
+                 row_band: Tuple[float, float] = (1/3, 2/3),
+                 planar_depth: bool = True):
+        """ObstacleSectorReducer constructor
+
+        Args:
+            width (int): depth image width in pixels
+            height (int): depth image height in pixels
+            fov (float): horizontal field of view in radians
+            min_range (float): sensor minimum range in metres
+            max_range (float): sensor maximum range in metres
+            increment (float, optional): sector width in degrees. Defaults to 5 (72 sectors cover 360 degrees).
+            row_band (tuple, optional): fraction of image rows (top, bottom) searched for obstacles.
+                                        Keeps the ground and sky out of the reduction. Defaults to the middle third.
+            planar_depth (bool, optional): pixels hold depth along the optical axis (as Webots does) rather than
+                                           ray length, so columns are scaled by 1/cos(angle). Defaults to True.
+        """
+        self.increment = float(increment)
+        self.angle_offset = -math.degrees(fov) / 2
+        self.min_cm = max(0, int(min_range * 100))
+        self.max_cm = max(self.min_cm + 1, int(max_range * 100))
+        self._max_range = float(max_range)
+        self._rows = slice(int(height * row_band[0]), max(int(height * row_band[0]) + 1, int(height * row_band[1])))
+
+        # angle of each column centre (pinhole model), positive to the right like MAV_FRAME_BODY_FRD yaw
+        focal = (width / 2) / math.tan(fov / 2)
+        angles = np.arctan((np.arange(width) + 0.5 - width / 2) / focal)
+        self._column_scale = (1 / np.cos(angles) if planar_depth else np.ones(width)).astype(np.float32)
+
+        # columns are sorted by angle, so every sector is a contiguous run of columns
+        used_sectors = min(OBSTACLE_SECTORS, math.ceil(math.degrees(fov) / self.increment))
+        sectors = np.floor((np.degrees(angles) - self.angle_offset) / self.increment).astype(np.intp)
+        np.clip(sectors, 0, used_sectors - 1, out=sectors)
+        self._sectors, self._starts = np.unique(sectors, return_index=True)
+
+        self._columns = np.empty(width, np.float32)
+        self._sector_min = np.empty(len(self._starts), np.float32)
+        self._distances = np.full(OBSTACLE_SECTORS, UNKNOWN_DISTANCE, np.uint16)
+
+    def reduce(self, depth: np.ndarray) -> np.ndarray:
+        """Reduce a depth frame to OBSTACLE_DISTANCE distances
+
+        Args:
+            depth (np.ndarray): raw (height, width) float32 depth in metres, inf/NaN for no return
+
+        Returns:
+            np.ndarray: uint16[72] distances in cm. max_cm + 1 means no obstacle, UNKNOWN_DISTANCE
+                        marks sectors outside the field of view. Reused between calls.
+        """
+        # closest return per column, then per sector. fmin ignores NaN in both steps, so a column
+        # without any return does not hide a close return of its neighbours in the same sector
+        np.fmin.reduce(depth[self._rows], axis=0, out=self._columns)
+        np.multiply(self._columns, self._column_scale, out=self._columns)
+        np.fmin.reduceat(self._columns, self._starts, out=self._sector_min)
+
+        # to cm; sectors without any return and anything beyond max range report "no obstacle"
+        cm = self._sector_min * 100
+        np.nan_to_num(cm, copy=False, nan=self.max_cm + 1, posinf=self.max_cm + 1)
+        np.clip(cm, self.min_cm, self.max_cm + 1, out=cm)
+        self._distances[self._sectors] = cm
+        return self._distances
+
+
+if __name__ == "__main__":
+    # self check: a no-return (NaN) column next to a close return must not clear the sector
+    reducer = ObstacleSectorReducer(64, 8, math.radians(90), 0.1, 10.0)
+    frame = np.full((8, 64), np.inf, np.float32)
+    frame[:, 0] = np.nan
+    frame[:, 1] = 0.5
+    sector = int(reducer.reduce(frame)[0])
+    assert sector < 100, sector
+    frame[:] = np.nan
+    assert reducer.reduce(frame)[0] == reducer.max_cm + 1
+    print(f"ok: sector 0 = {sector} cm with a NaN column next to a 0.5 m return")
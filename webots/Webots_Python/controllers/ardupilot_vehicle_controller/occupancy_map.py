@@ -0,0 +1,330 @@
+'''
+Incremental 2D occupancy grid mapping from rangefinder depth frames and vehicle pose
+
+Each depth frame is reduced to a planar scan (closest return of every image column
+in a band of rows around the horizon, like obstacle_distance.py) and integrated into
+a log-odds grid at the vehicle pose (GPS position, IMU yaw):
+
+- cells along each beam up to the return are free, the cell of the return is occupied
+- beams are sampled with NumPy for the whole scan at once and every touched cell is
+  updated once per scan, so cells close to the vehicle are not counted many times
+- only tiles that contain a changed cell get a new version, so map consumers
+  (OccupancyTileServer, the GCS) only fetch and encode what changed
+
+The grid is in the world frame of the FDM sent to the SITL (x north, y west, origin at
+the SITL home). Tiles are served over HTTP as small RGBA PNGs, north up.
+
+AP_FLAKE8_CLEAN
+'''
+
+import json
+import math
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+class DepthScan():
+    """Vectorized depth image -> planar scan (beam angles and ranges)"""
+
+    def __init__(self,
+                 width: int,
+                 height: int,
+                 fov: float,
+                 max_range: float,
+                 beams: int = 0,
+                 row_band: Tuple[float, float] = (1/3, 2/3),
+                 planar_depth: bool = True):
+        """DepthScan constructor
+
+        Args:
+            width (int): depth image width in pixels
+            height (int): depth image height in pixels
+            fov (float): horizontal field of view in radians
+            max_range (float): sensor maximum range in metres, returns at or beyond it are "no obstacle"
+            beams (int, optional): beams per scan, taken from evenly spaced columns. Defaults to 0 (every column).
+            row_band (tuple, optional): fraction of image rows (top, bottom) searched for obstacles.
+                                        Defaults to the middle third.
+            planar_depth (bool, optional): pixels hold depth along the optical axis (as Webots does) rather than
+                                           ray length. Defaults to True.
+        """
+        self.max_range = float(max_range)
+        self._rows = slice(int(height * row_band[0]), max(int(height * row_band[0]) + 1, int(height * row_band[1])))
+
+        # angle of each column centre (pinhole model), positive to the right
+        focal = (width / 2) / math.tan(fov / 2)
+        angles = np.arctan((np.arange(width) + 0.5 - width / 2) / focal)
+        self._scale = (1 / np.cos(angles) if planar_depth else np.ones(width)).astype(np.float32)
+        self._columns_used = np.arange(width)
+        if 0 < beams < width:
+            self._columns_used = np.linspace(0, width - 1, beams).round().astype(np.intp)
+        self.angles = angles[self._columns_used].astype(np.float32)
+        self._columns = np.empty(width, np.float32)
+
+    def ranges(self, depth: np.ndarray) -> np.ndarray:
+        """Closest return of each beam in metres, inf where there is none within max range
+
+        Args:
+            depth (np.ndarray): raw (height, width) float32 depth in metres, inf/NaN for no return
+        """
+        np.fmin.reduce(depth[self._rows], axis=0, out=self._columns)
+        np.multiply(self._columns, self._scale, out=self._columns)
+        ranges = self._columns[self._columns_used]
+        ranges[~(ranges < self.max_range)] = np.inf  # NaN and beyond max range
+        return ranges
+
+
+class OccupancyGrid():
+    """Square log-odds occupancy grid centred on the world origin, split into versioned tiles"""
+
+    def __init__(self,
+                 size: float = 400.0,
+                 resolution: float = 0.2,
+                 tile_size: int = 128,
+                 hit: float = 0.85,
+                 miss: float = -0.4,
+                 limit: float = 4.0):
+        """OccupancyGrid constructor
+
+        Args:
+            size (float, optional): side of the mapped square in metres, rounded up to whole tiles. Defaults to 400.
+            resolution (float, optional): cell size in metres. Defaults to 0.2.
+            tile_size (int, optional): tile side in cells. Defaults to 128.
+            hit (float, optional): log-odds added to the cell of a return. Defaults to 0.85 (p=0.7).
+            miss (float, optional): log-odds added to cells a beam passes through. Defaults to -0.4 (p=0.4).
+            limit (float, optional): log-odds are clamped to +-limit so cells can still change. Defaults to 4.
+        """
+        self.resolution = float(resolution)
+        self.tile_size = int(tile_size)
+        tiles = max(1, math.ceil(size / resolution / tile_size))
+        self.cells = tiles * self.tile_size
+        self.hit = float(hit)
+        self.miss = float(miss)
+        self.limit = float(limit)
+        # axis 0: x (north), axis 1: y (west); world (0, 0) is the centre cell
+        self.log_odds = np.zeros((self.cells, self.cells), np.float32)
+        self.tile_versions = np.zeros((tiles, tiles), np.int64)
+        self.version = 0
+        self.pose = (0.0, 0.0, 0.0)
+        self.lock = threading.Lock()
+        self._half = self.cells // 2
+
+    def update(self, x: float, y: float, yaw: float, angles: np.ndarray, ranges: np.ndarray, max_range: float):
+        """Integrate one planar scan taken at the given pose
+
+        Args:
+            x (float): sensor x (north) in metres
+            y (float): sensor y (west) in metres
+            yaw (float): sensor heading in radians, counter-clockwise from x
+            angles (np.ndarray): beam angles in radians, positive to the right (clockwise)
+            ranges (np.ndarray): beam ranges in metres, inf for no return (the beam is free up to max_range)
+            max_range (float): sensor maximum range in metres
+        """
+        res = self.resolution
+        heading = yaw - angles
+        cos, sin = np.cos(heading), np.sin(heading)
+        hit = np.isfinite(ranges)
+        free_len = np.where(hit, ranges, max_range)
+
+        # free space: sample every beam at half a cell up to (not including) its return
+        steps = np.arange(0.0, max_range, res / 2, dtype=np.float32)
+        along = steps[np.newaxis, :] < (free_len[:, np.newaxis] - res / 2)
+        px = x + steps[np.newaxis, :] * cos[:, np.newaxis]
+        py = y + steps[np.newaxis, :] * sin[:, np.newaxis]
+        free = self._linear(px[along], py[along])
+        occupied = self._linear(x + ranges[hit] * cos[hit], y + ranges[hit] * sin[hit])
+
+        # each touched cell is updated once per scan, a return wins over a pass-through
+        occupied = np.unique(occupied[occupied >= 0])
+        free = np.unique(free[free >= 0])
+        free = free[~np.isin(free, occupied, assume_unique=True)]
+
+        flat = self.log_odds.reshape(-1)
+        with self.lock:
+            self.version += 1
+            self.pose = (x, y, yaw)
+            changed = []
+            for cells, delta in ((free, self.miss), (occupied, self.hit)):
+                if len(cells) == 0:
+                    continue
+                old = flat[cells]
+                new = np.clip(old + delta, -self.limit, self.limit)
+                moved = new != old
+                flat[cells[moved]] = new[moved]
+                changed.append(cells[moved])
+            if changed:
+                cells = np.concatenate(changed)
+                ts = self.tile_size
+                self.tile_versions[(cells // self.cells) // ts, (cells % self.cells) // ts] = self.version
+
+    def _linear(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """World positions -> linear cell indices, -1 outside the grid"""
+        ix = np.floor(x / self.resolution).astype(np.intp) + self._half
+        iy = np.floor(y / self.resolution).astype(np.intp) + self._half
+        inside = (ix >= 0) & (ix < self.cells) & (iy >= 0) & (iy < self.cells)
+        return np.where(inside, ix * self.cells + iy, -1)
+
+    def tile_bounds(self, i: int, j: int) -> list:
+        """[[south, west], [north, east]] of a tile in metres north / east of the world origin"""
+        ts, res = self.tile_size, self.resolution
+        south = (i * ts - self._half) * res
+        west = (self._half - (j + 1) * ts) * res
+        return [[south, west], [south + ts * res, west + ts * res]]
+
+    def changed_tiles(self, since: int = 0) -> list:
+        """(i, j, version) of the tiles changed after the given grid version"""
+        with self.lock:
+            ii, jj = np.nonzero(self.tile_versions > since)
+            return [(int(i), int(j), int(self.tile_versions[i, j])) for i, j in zip(ii, jj)]
+
+    def tile_image(self, i: int, j: int) -> Tuple[np.ndarray, int]:
+        """Copy of a tile's log-odds as an image (north up, east right) and its version"""
+        ts = self.tile_size
+        with self.lock:
+            tile = self.log_odds[i * ts:(i + 1) * ts, j * ts:(j + 1) * ts][::-1, ::-1].copy()
+            return tile, int(self.tile_versions[i, j])
+
+
+def _colour_table(limit: float) -> np.ndarray:
+    """RGBA colour of each quantized log-odds level: unknown transparent, free light, occupied dark"""
+    log_odds = np.linspace(-limit, limit, 256)
+    p = 1 / (1 + np.exp(-log_odds))
+    table = np.zeros((256, 4), np.uint8)
+    table[:, :3] = np.round(255 * (1 - p))[:, np.newaxis]
+    table[:, 3] = np.round(np.abs(p - 0.5) * 2 * 220)
+    table[np.abs(log_odds) < 2 * limit / 255, 3] = 0  # the level(s) around 0 are unknown
+    return table
+
+
+def encode_png(rgba: np.ndarray, level: int = 6) -> bytes:
+    """Encode a (height, width, 4) uint8 image as PNG (no filtering, zlib only)"""
+    height, width = rgba.shape[:2]
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    # every row starts with filter type 0
+    rows = np.zeros((height, width * 4 + 1), np.uint8)
+    rows[:, 1:] = rgba.reshape(height, width * 4)
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows.tobytes(), level))
+            + chunk(b"IEND", b""))
+
+
+class OccupancyTileServer():
+    """Serve an OccupancyGrid over HTTP
+
+    GET /meta?since=V   grid geometry, pose and the tiles changed after grid version V
+    GET /tiles/I/J.png  tile image, encoded once per tile version
+    """
+
+    _tile_path = re.compile(r"^/tiles/(\d+)/(\d+)\.png$")
+
+    def __init__(self, grid: OccupancyGrid, address: str, port: int, home: Optional[Tuple[float, float]] = None):
+        """OccupancyTileServer constructor
+
+        Args:
+            grid (OccupancyGrid): the grid to serve
+            address (str): address to listen on
+            port (int): HTTP port
+            home (tuple, optional): (lat, lon) of the world origin (SITL home) so the GCS can place the map.
+                                    Defaults to None (the GCS anchors the map on the vehicle position).
+        """
+        self.grid = grid
+        self.home = home
+        self.stats = {"scans": 0, "update_ms": 0.0}
+        self._png_cache = {}
+        self._colours = _colour_table(grid.limit)
+        self._levels = 255 / (2 * grid.limit)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path, _, query = self.path.partition("?")
+                if path == "/meta":
+                    since = int(query[6:]) if query.startswith("since=") and query[6:].isdigit() else 0
+                    self._reply(200, "application/json", json.dumps(server.meta(since)).encode())
+                    return
+                match = server._tile_path.match(path)
+                tiles = server.grid.tile_versions.shape[0]
+                if match is None or not all(int(v) < tiles for v in match.groups()):
+                    self._reply(404, "text/plain", b"not found")
+                    return
+                self._reply(200, "image/png", server.tile_png(int(match.group(1)), int(match.group(2))))
+
+            def _reply(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((address, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(daemon=True, name="occupancy_http", target=self._httpd.serve_forever)
+        self._thread.start()
+
+    def meta(self, since: int = 0) -> dict:
+        grid = self.grid
+        x, y, yaw = grid.pose
+        return {
+            "version": grid.version,
+            "resolution": grid.resolution,
+            "tile_size": grid.tile_size,
+            "home": self.home,
+            # vehicle position in metres north / east of the world origin and heading (degrees clockwise from north)
+            "vehicle": [x, -y, (-math.degrees(yaw)) % 360],
+            "tiles": [{"i": i, "j": j, "version": v, "bounds": grid.tile_bounds(i, j)}
+                      for i, j, v in grid.changed_tiles(since)],
+            **self.stats,
+        }
+
+    def tile_png(self, i: int, j: int) -> bytes:
+        tile, version = self.grid.tile_image(i, j)
+        cached = self._png_cache.get((i, j))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        levels = np.clip((tile + self.grid.limit) * self._levels + 0.5, 0, 255).astype(np.uint8)
+        png = encode_png(self._colours[levels])
+        self._png_cache[(i, j)] = (version, png)
+        return png
+
+    def record(self, seconds: float):
+        """Account one scan update (exponential average of the update time)"""
+        self.stats["scans"] += 1
+        self.stats["update_ms"] = round(0.9 * self.stats["update_ms"] + 0.1 * seconds * 1000, 3)
+
+    def close(self):
+        self._httpd.shutdown()
+
+
+def benchmark(scans: int = 200, width: int = 320, height: int = 60, max_range: float = 20.0, **grid_args) -> dict:
+    """Time update() on synthetic scans driving around a room (no Webots needed)"""
+    grid = OccupancyGrid(**grid_args)
+    scan = DepthScan(width, height, math.radians(90), max_range)
+    rng = np.random.default_rng(0)
+    depth = np.empty((height, width), np.float32)
+    times = []
+    for k in range(scans):
+        depth[:] = rng.uniform(2.0, max_range * 1.2, width).astype(np.float32)
+        x, y, yaw = 50 * math.cos(k / 50), 50 * math.sin(k / 50), k / 50 + math.pi / 2
+        t0 = time.perf_counter()
+        grid.update(x, y, yaw, scan.angles, scan.ranges(depth), max_range)
+        times.append(time.perf_counter() - t0)
+    times = np.asarray(times) * 1000
+    return {"scans": scans, "beams": len(scan.angles), "cells": grid.cells,
+            "mean_ms": round(float(times.mean()), 3), "p99_ms": round(float(np.percentile(times, 99)), 3)}
+
+
+if __name__ == "__main__":
+    print(benchmark())
@@ -0,0 +1,138 @@
+'''
+Opt-in phase timing for WebotsArduVehicle
+
+The SITL loop, image streaming threads, sensor publisher and GUI all share the GIL.
+PhaseTracer timestamps each phase so we can see which one eats the step budget:
+
+    t0 = trace.start()
+    self.robot.step(self._timestep)
+    trace.stop("robot.step", t0)
+
+Samples go into a fixed size ring buffer shared by all threads. Slots are claimed
+with next() on an itertools.count, which is atomic in CPython, so writers never
+take a lock; the oldest samples are overwritten once the buffer is full.
+
+dump() writes the buffer as Chrome trace JSON (chrome://tracing, ui.perfetto.dev)
+and summary() gives per phase percentiles. When tracing is disabled the vehicle
+uses NULL_TRACER, whose start/stop do nothing.
+
+AP_FLAKE8_CLEAN
+'''
+
+import json
+import threading
+import time
+from itertools import count
+from typing import Optional
+
+import numpy as np
+
+
+class NullTracer():
+    """Tracer that records nothing (tracing disabled)"""
+
+    enabled = False
+
+    def start(self) -> int:
+        return 0
+
+    def stop(self, name: str, t0: int):
+        pass
+
+    def summary(self) -> dict:
+        return {}
+
+    def dump(self, path: Optional[str] = None):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class PhaseTracer():
+    """Record (phase, thread, start, end) samples in a lock-free ring buffer"""
+
+    enabled = True
+
+    def __init__(self, capacity: int = 1 << 16, path: Optional[str] = None, pid: int = 0):
+        """PhaseTracer constructor
+
+        Args:
+            capacity (int, optional): samples kept, rounded up to a power of two. Defaults to 65536.
+            path (str, optional): default output path of dump(). Defaults to None.
+            pid (int, optional): process id shown in the trace (the vehicle instance). Defaults to 0.
+        """
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self._mask = size - 1
+        self._buf = [None] * size
+        self._next = count()
+        self._origin = time.perf_counter_ns()
+        self._thread_names = {}
+        self.path = path
+        self.pid = pid
+
+    start = staticmethod(time.perf_counter_ns)
+
+    def stop(self, name: str, t0: int):
+        """Record the phase name that started at t0 (from start()) and ends now"""
+        t1 = time.perf_counter_ns()
+        tid = threading.get_ident()
+        if tid not in self._thread_names:
+            # remember the name, the thread may be gone by the time the trace is written
+            self._thread_names[tid] = threading.current_thread().name
+        self._buf[next(self._next) & self._mask] = (name, tid, t0, t1)
+
+    def samples(self) -> list:
+        """Snapshot of the recorded samples, oldest first"""
+        buf = list(self._buf)
+        return sorted((s for s in buf if s is not None), key=lambda s: s[2])
+
+    def summary(self) -> dict:
+        """Per phase count, total and duration percentiles (ms) over the samples in the buffer"""
+        samples = self.samples()
+        if not samples:
+            return {}
+        window_ms = (max(s[3] for s in samples) - samples[0][2]) / 1e6
+        phases = {}
+        for name, _, t0, t1 in samples:
+            phases.setdefault(name, []).append(t1 - t0)
+        result = {}
+        for name, durations in sorted(phases.items()):
+            d = np.asarray(durations, dtype=np.float64) / 1e6
+            p50, p90, p99 = np.percentile(d, (50, 90, 99))
+            result[name] = {
+                "count": len(d),
+                "total_ms": round(float(d.sum()), 3),
+                # share of the traced window spent in this phase (over all threads)
+                "share": round(float(d.sum()) / window_ms, 4) if window_ms > 0 else 0.0,
+                "mean_ms": round(float(d.mean()), 4),
+                "p50_ms": round(float(p50), 4),
+                "p90_ms": round(float(p90), 4),
+                "p99_ms": round(float(p99), 4),
+                "max_ms": round(float(d.max()), 4),
+            }
+        return result
+
+    def dump(self, path: Optional[str] = None):
+        """Write the samples as Chrome trace JSON (with the summary under "phaseSummary")
+
+        Args:
+            path (str, optional): output file. Defaults to the path given to the constructor.
+        """
+        path = path or self.path
+        if path is None:
+            return
+        samples = self.samples()
+        names = self._thread_names
+        events = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": f"webots I{self.pid}"}}]
+        for tid in sorted({s[1] for s in samples}):
+            events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+                           "args": {"name": names.get(tid, f"thread-{tid}")}})
+        for name, tid, t0, t1 in samples:
+            events.append({"name": name, "cat": name.split(".", 1)[0], "ph": "X", "pid": self.pid, "tid": tid,
+                           "ts": (t0 - self._origin) / 1e3, "dur": (t1 - t0) / 1e3})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "phaseSummary": self.summary()}, f)
+        print(f"Phase trace with {len(samples)} samples written to {path} (I{self.pid})")
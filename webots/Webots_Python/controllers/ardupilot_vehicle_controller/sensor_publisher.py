@@ -0,0 +1,94 @@
+'''
+Rate-scheduled MAVLink sensor publisher for WebotsArduVehicle
+
+Each output (DISTANCE_SENSOR, OBSTACLE_DISTANCE, ...) is a task with its own rate.
+The lockstep SITL loop only calls tick(sim_time) after every physics step, which
+checks the due times and, for due tasks, takes a cheap sample (optional) and hands
+it to a worker thread that does the packing and sending.
+
+AP_FLAKE8_CLEAN
+'''
+
+import queue
+from threading import Thread
+from typing import Any, Callable, Optional
+
+
+class _Task():
+    __slots__ = ("name", "period", "send", "sample", "next_due", "sent", "dropped", "errors")
+
+    def __init__(self, name: str, rate_hz: float, send: Callable[[Any], None], sample: Optional[Callable[[], Any]]):
+        self.name = name
+        self.period = 1.0 / rate_hz
+        self.send = send
+        self.sample = sample
+        self.next_due = None
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+
+
+class SensorPublisher():
+    """Schedule sensor sends on sim time and run them on a worker thread"""
+
+    def __init__(self, queue_size: int = 16):
+        """SensorPublisher constructor
+
+        Args:
+            queue_size (int, optional): pending sends before new ones are dropped. Defaults to 16.
+        """
+        self._tasks = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+
+    def add(self, name: str, rate_hz: float, send: Callable[[Any], None], sample: Callable[[], Any] = None):
+        """Add a sensor output
+
+        Args:
+            name (str): name for stats
+            rate_hz (float): send rate in sim time. Tasks with rate <= 0 are ignored.
+            send (Callable): called on the worker thread with the sample (or None)
+            sample (Callable, optional): called on the physics thread when due, keep it cheap. Defaults to None.
+        """
+        if rate_hz <= 0:
+            return
+        self._tasks.append(_Task(name, rate_hz, send, sample))
+        if self._thread is None:
+            self._thread = Thread(daemon=True, name="sensor_publisher", target=self._run)
+            self._thread.start()
+
+    def has_tasks(self) -> bool:
+        return bool(self._tasks)
+
+    def tick(self, sim_time: float):
+        """Queue every task that is due at sim_time (call from the physics thread after each step)"""
+        for task in self._tasks:
+            if task.next_due is not None and sim_time < task.next_due:
+                continue
+            # stay on the rate grid, but don't try to catch up after a pause
+            if task.next_due is None or sim_time - task.next_due > task.period:
+                task.next_due = sim_time + task.period
+            else:
+                task.next_due += task.period
+
+            value = task.sample() if task.sample is not None else None
+            try:
+                self._queue.put_nowait((task, value))
+            except queue.Full:
+                task.dropped += 1
+
+    def stats(self) -> dict:
+        """Get sent/dropped/error counts per task"""
+        return {t.name: {"sent": t.sent, "dropped": t.dropped, "errors": t.errors} for t in self._tasks}
+
+    def _run(self):
+        while True:
+            task, value = self._queue.get()
+            try:
+                task.send(value)
+                task.sent += 1
+            except Exception as e:
+                # report the first few failures only, the physics loop must keep going
+                task.errors += 1
+                if task.errors <= 3:
+                    print(f"[SensorPublisher] {task.name} send failed: {e}")
@@ -5,6 +5,7 @@ AP_FLAKE8_CLEAN
 '''
 
 # Imports
+import math
 import os
 os.environ['MAVLINK20'] = '1'  # 必ず import mavutil より前に書く
 from pymavlink import mavutil
@@ -20,6 +21,14 @@ except ImportError:
 import numpy as np
 from threading import Thread
 from typing import List, Union
+from frame_ring import FrameRingWriter, frame_ring_path
+import image_stream
+from depth_processing import DepthProcessor, DEPTH_FORMATS
+from obstacle_distance import ObstacleSectorReducer
+from occupancy_map import DepthScan, OccupancyGrid, OccupancyTileServer
+from sensor_publisher import SensorPublisher
+from motor_mixer import MotorMixer, load_config
+from phase_trace import PhaseTracer, NULL_TRACER
 # try:
 #     from pymavlink import mavutil
 # except ImportError:
@@ -68,13 +77,27 @@ class WebotsArduVehicle():
                  rangefinder_name: str = None,
                  rangefinder_fps: int = 10,
                  rangefinder_stream_port: int = None,
+                 rangefinder_depth_format: str = "uint8",
+                 obstacle_distance_rate: float = 0,
+                 occupancy_port: int = None,
+                 occupancy_resolution: float = 0.2,
+                 occupancy_size: float = 400.0,
+                 occupancy_home: tuple = None,
                  sonar_name: str = None,
+                 distance_rate: float = 10,
+                 image_transport: str = "tcp",
+                 stream_address: str = "127.0.0.1",
                  instance: int = 0,
                  motor_velocity_cap: float = float('inf'),
                  reversed_motors: List[int] = None,
                  bidirectional_motors: bool = False,
                  uses_propellers: bool = True,
-                 sitl_address: str = "127.0.0.1"):
+                 mixer: str = "skid",
+                 sitl_address: str = "127.0.0.1",
+                 trace_path: str = None,
+                 trace_capacity: int = 1 << 16,
+                 preview_fps: float = 10,
+                 preview_downscale: int = 2):
         """WebotsArduVehicle constructor
 
         Args:
@@ -91,6 +114,29 @@ class WebotsArduVehicle():
             rangefinder_fps (int, optional): RangeFinder FPS. Lower FPS runs better in sim. Defaults to 10.
             rangefinder_stream_port (int, optional): Port to stream rangefinder images to.
                                                      If no port is supplied the camera will not be streamed. Defaults to None.
+            rangefinder_depth_format (str, optional): Pixel format of streamed rangefinder images: normalized "uint8" or
+                                                      "uint16", or "float32" metric depth in metres. Legacy TCP clients
+                                                      always get "uint8". Defaults to "uint8".
+            obstacle_distance_rate (float, optional): Rate (Hz) to send the rangefinder image to ArduPilot as
+                                                      OBSTACLE_DISTANCE sectors for proximity avoidance.
+                                                      0 disables it. Defaults to 0.
+            occupancy_port (int, optional): Build a 2D occupancy grid from the rangefinder and the vehicle pose and
+                                            serve it as map tiles over HTTP on this port (see occupancy_map.py).
+                                            Defaults to None (disabled).
+            occupancy_resolution (float, optional): Occupancy grid cell size in metres. Defaults to 0.2.
+            occupancy_size (float, optional): Side of the square mapped around the SITL home in metres.
+                                              Defaults to 400.
+            occupancy_home (tuple, optional): (lat, lon) of the SITL home, sent to the GCS to place the map.
+                                              Defaults to None (the GCS anchors it on the vehicle position).
+            sonar_name (str, optional): Webots DistanceSensor name. Defaults to None.
+            distance_rate (float, optional): Rate (Hz, sim time) to send the sonar to ArduPilot as DISTANCE_SENSOR.
+                                             Defaults to 10.
+            image_transport (str, optional): How camera/rangefinder frames are streamed, "tcp" or "shm".
+                                             With "shm" frames are written to a shared memory ring buffer
+                                             (see frame_ring.py) and the stream port is used for UDP
+                                             new frame notifications instead. Defaults to "tcp".
+            stream_address (str, optional): Address the TCP image streams listen on. Use "0.0.0.0" to serve
+                                            consumers on other machines. Defaults to "127.0.0.1".
             instance (int, optional): Vehicle instance number to match the SITL. This allows multiple vehicles. Defaults to 0.
             motor_velocity_cap (float, optional): Motor velocity cap. This is useful for the crazyflie
                                                   which default has way too much power. Defaults to float('inf').
@@ -98,8 +144,18 @@ class WebotsArduVehicle():
             bidirectional_motors (bool, optional): Enable bidirectional motors. Defaults to False.
             uses_propellers (bool, optional): Whether the vehicle uses propellers.
                                               This is important as we need to linearize thrust if so. Defaults to True.
+            mixer (str, optional): Servo to motor mixer, a preset ("skid", "direct", "ackermann") or a JSON file
+                                   (see motor_mixer.py). bidirectional_motors and uses_propellers apply to
+                                   "direct". Defaults to "skid".
             sitl_address (str, optional): IP address of the SITL (useful with WSL2 eg \"172.24.220.98\").
                                           Defaults to "127.0.0.1".
+            trace_path (str, optional): Record phase timings (robot.step, FDM, mixing, image capture/send,
+                                        MAVLink sends, ...) and write them as Chrome trace JSON to this file
+                                        on dump_trace() (see phase_trace.py). Defaults to None (disabled).
+            trace_capacity (int, optional): Phase samples kept in the trace ring buffer. Defaults to 65536.
+            preview_fps (float, optional): Max rate (Hz, wall time) of the camera preview window and sonar
+                                           console output in update_gui(). 0 runs headless. Defaults to 10.
+            preview_downscale (int, optional): Show every n-th camera pixel in the preview. Defaults to 2.
         """
         # init class variables
         self.motor_velocity_cap = motor_velocity_cap
@@ -108,6 +164,12 @@ class WebotsArduVehicle():
         self._bidirectional_motors = bidirectional_motors
         self._uses_propellers = uses_propellers
         self._webots_connected = True
+        self._stream_address = stream_address
+        self._trace = PhaseTracer(trace_capacity, trace_path, instance) if trace_path else NULL_TRACER
+
+        if image_transport not in ("tcp", "shm"):
+            raise ValueError(f"Unknown image transport '{image_transport}'")
+        image_stream_target = self._handle_image_stream if image_transport == "tcp" else self._handle_image_shm
 
         # setup Webots robot instance
         self.robot = Robot()
@@ -127,6 +189,7 @@ class WebotsArduVehicle():
         self.gps.enable(self._timestep)
 
         # init camera
+        self.camera = None
         if camera_name is not None:
             self.camera = self.robot.getDevice(camera_name)
             if self.camera is not None:
@@ -137,23 +200,48 @@ class WebotsArduVehicle():
 
             # start camera streaming thread if requested
             if camera_stream_port is not None:
-                self._camera_thread = Thread(daemon=True,
-                                             target=self._handle_image_stream,
+                self._camera_thread = Thread(daemon=True, name="camera_stream",
+                                             target=image_stream_target,
                                              args=[self.camera, camera_stream_port])
                 self._camera_thread.start()
 
         # init rangefinder
+        if rangefinder_depth_format not in DEPTH_FORMATS:
+            raise ValueError(f"Unknown rangefinder depth format '{rangefinder_depth_format}'")
+        self._rangefinder_depth_format = rangefinder_depth_format
+        self._rangefinder_depth = None
         if rangefinder_name is not None:
             self.rangefinder = self.robot.getDevice(rangefinder_name)
             self.rangefinder.enable(1000//rangefinder_fps) # takes frame period in ms
 
+            # these are fixed for the device, so only query them once
+            self._rangefinder_width = self.rangefinder.getWidth()
+            self._rangefinder_height = self.rangefinder.getHeight()
+            self._rangefinder_min_range = self.rangefinder.getMinRange()
+            self._rangefinder_max_range = self.rangefinder.getMaxRange()
+            self._rangefinder_fov = self.rangefinder.getFov()
+
             # start rangefinder streaming thread if requested
             if rangefinder_stream_port is not None:
-                self._rangefinder_thread = Thread(daemon=True,
-                                                  target=self._handle_image_stream,
+                self._rangefinder_thread = Thread(daemon=True, name="rangefinder_stream",
+                                                  target=image_stream_target,
                                                   args=[self.rangefinder, rangefinder_stream_port])
                 self._rangefinder_thread.start()
 
+        # reduce rangefinder frames to OBSTACLE_DISTANCE sectors if requested
+        self._obstacle_reducer = None
+        if rangefinder_name is not None and obstacle_distance_rate > 0:
+            self._obstacle_reducer = ObstacleSectorReducer(self._rangefinder_width, self._rangefinder_height,
+                                                           self._rangefinder_fov,
+                                                           self._rangefinder_min_range, self._rangefinder_max_range)
+
+        # map the rangefinder into an occupancy grid if requested
+        if rangefinder_name is not None and occupancy_port is not None:
+            self._occupancy_thread = Thread(daemon=True, name="occupancy_map", target=self._handle_occupancy_map,
+                                            args=[occupancy_port, occupancy_size, occupancy_resolution,
+                                                  occupancy_home])
+            self._occupancy_thread.start()
+
         # init sonar (DistanceSensor) if requested
         self.sonar = None
         if sonar_name is not None:
@@ -167,25 +255,55 @@ class WebotsArduVehicle():
             except Exception:
                 self.sonar = None
 
+        # resolve the sonar range once, DistanceSensor API differs between Webots versions
+        self._sonar_min_cm, self._sonar_max_cm = self._resolve_sonar_range_cm(self.sonar)
+
         # init MAVLink connection for distance sensor reporting (optional)
         self.mav_link = None
         self._mavlink_target_addr = None  # SITL(WSL)のIPアドレスを自動検知して保持する
 
-        # init step counter for throttling MAVLink sends (10 steps = ~50Hz at 500Hz sim)
-        self._step_counter = 0
-        self._last_distance_send_ms = None
-        
+        # MAVLink sensor outputs, each at its own rate and sent off the physics thread
+        self._sensor_publisher = SensorPublisher()
+        if self.sonar is not None:
+            self._sensor_publisher.add("DISTANCE_SENSOR", distance_rate,
+                                       send=self.send_mavlink_distance, sample=self.sonar.getValue)
+        if self._obstacle_reducer is not None:
+            self._sensor_publisher.add("OBSTACLE_DISTANCE", obstacle_distance_rate,
+                                       send=lambda _: self.send_mavlink_obstacle_distance())
+
         # init boot time for MAVLink timestamp
         self._start_time = time.monotonic()
 
+        # GUI preview (update_gui), headless without OpenCV or with preview_fps 0
+        self._preview_period = 1.0 / preview_fps if preview_fps > 0 and cv2 is not None else None
+        if preview_fps > 0 and cv2 is None:
+            print("Warning: OpenCV not available, camera preview disabled")
+        self._preview_downscale = max(1, int(preview_downscale))
+        self._preview_next = 0.0
+        self._preview_frame = None
+        self._preview_window = False
+        self._last_print_time = 0.0
+
         # init motors (and setup velocity control)
         self._motors = [self.robot.getDevice(n) for n in motor_names]
-        for m in self._motors:
-            m.setPosition(float('inf'))
-            m.setVelocity(0)
+        # motor limits are read once here, the mixer keeps them as a scale vector
+        motor_limits = [min(m.getMaxVelocity(), self.motor_velocity_cap) for m in self._motors]
+        self._mixer = MotorMixer(load_config(mixer, len(self._motors),
+                                             bidirectional=bidirectional_motors,
+                                             uses_propellers=uses_propellers),
+                                 motor_limits, reversed_motors)
+        self._motor_output = np.full(len(self._motors), np.nan)
+        for m, is_position, limit in zip(self._motors, self._mixer.is_position, motor_limits):
+            if is_position:
+                # position controlled (eg steering hinge): move at full speed to each target
+                m.setVelocity(limit)
+                m.setPosition(0)
+            else:
+                m.setPosition(float('inf'))
+                m.setVelocity(0)
 
         # start ArduPilot SITL communication thread
-        self._sitl_thread = Thread(daemon=True, target=self._handle_sitl, args=[sitl_address, 9002+10*instance])
+        self._sitl_thread = Thread(daemon=True, name="sitl", target=self._handle_sitl, args=[sitl_address, 9002+10*instance])
         self._sitl_thread.start()
 
     def get_time_boot_ms(self):
@@ -218,6 +336,7 @@ class WebotsArduVehicle():
         print(f"Connected to ardupilot SITL (I{self._instance})")
 
         # main loop handling communications
+        trace = self._trace
         while True:
             # check if the socket is ready to send/receive
             readable, writable, _ = select.select([s], [s], [], 0)
@@ -225,12 +344,16 @@ class WebotsArduVehicle():
             # send data to SITL port (one lower than its output port as seen in SITL_cmdline.cpp)
             if writable:
                 fdm_struct = self._get_fdm_struct()
+                t0 = trace.start()
                 s.sendto(fdm_struct, (sitl_address, port+1))
+                trace.stop("fdm.send", t0)
 
             # receive data from SITL port
             if readable:
+                t0 = trace.start()
                 data, addr = s.recvfrom(512)
-                
+                trace.stop("servo.recv", t0)
+
                 # 自動IP検知: 最初に来たパケットの送信元(WSL側)に対してMAVLinkを送るようにする
                 if self.mav_link is None and mavutil:
                     try:
@@ -251,21 +374,17 @@ class WebotsArduVehicle():
                 self._handle_controls(command)
 
                 # wait until the next Webots time step as no new sensor data will be available until then
+                t0 = trace.start()
                 step_success = self.robot.step(self._timestep)
+                trace.stop("robot.step", t0)
                 if step_success == -1: # webots closed
                     break
                 
-                # send rangefinder center distance to ArduPilot via MAVLink (if available)
-                self._step_counter += 1
-                try:
-                    if hasattr(self, 'send_mavlink_distance'):
-                        now_ms = self.get_time_boot_ms()
-                        if self._last_distance_send_ms is None or (now_ms - self._last_distance_send_ms) >= 100:
-                            self.send_mavlink_distance()
-                            self._last_distance_send_ms = now_ms
-                except Exception:
-                    # avoid spamming errors from MAVLink send
-                    pass
+                # queue due MAVLink sensor sends (sent once the SITL address is known)
+                if self.mav_link is not None and self._sensor_publisher.has_tasks():
+                    t0 = trace.start()
+                    self._sensor_publisher.tick(self.robot.getTime())
+                    trace.stop("sensor.tick", t0)
 
         # if we leave the main loop then Webots must have closed
         s.close()
@@ -279,11 +398,14 @@ class WebotsArduVehicle():
             bytes: bytes representing the struct to send to SITL
         """
         # get data from Webots
+        t0 = self._trace.start()
         i = self.imu.getRollPitchYaw()
         g = self.gyro.getValues()
         a = self.accel.getValues()
         gps_pos = self.gps.getValues()
         gps_vel = self.gps.getSpeedVector()
+        t1 = self._trace.start()
+        self._trace.stop("sensors.read", t0)
 
         # pack the struct, converting ENU to NED (ish)
         # https://discuss.ardupilot.org/t/copter-x-y-z-which-is-which/6823/3
@@ -295,65 +417,39 @@ class WebotsArduVehicle():
         #     double velocity_xyz[3];
         #     double position_xyz[3];
         # };
-        return struct.pack(self.fdm_struct_format,
-                           self.robot.getTime(),
-                           g[0], -g[1], -g[2],
-                           a[0], -a[1], -a[2],
-                           i[0], -i[1], -i[2],
-                           gps_vel[0], -gps_vel[1], -gps_vel[2],
-                           gps_pos[0], -gps_pos[1], -gps_pos[2])
+        fdm = struct.pack(self.fdm_struct_format,
+                          self.robot.getTime(),
+                          g[0], -g[1], -g[2],
+                          a[0], -a[1], -a[2],
+                          i[0], -i[1], -i[2],
+                          gps_vel[0], -gps_vel[1], -gps_vel[2],
+                          gps_pos[0], -gps_pos[1], -gps_pos[2])
+        self._trace.stop("fdm.pack", t1)
+        return fdm
 
     def _handle_controls(self, command: tuple):
         """
-        RC1(ステアリング)とRC3(スロットル)を受け取り、
-        Webots側でスキッドステア用にミキシングするハンドル操作モード
+        ArduPilot のサーボ出力 (0.0〜1.0) をミキサー (motor_mixer.py) でモーター指令に変換する。
+        既定の "skid" は RC1(ステアリング) と RC3(スロットル) を左右のタイヤにミキシングする
+        (左 = スロットル + ステア, 右 = スロットル - ステア)
         """
-        
-        # --- 1. 信号の取得 (ArduPilotからの出力 0.0〜1.0) ---
-        # command[0] = Servo 1 (Steering)
-        # command[2] = Servo 3 (Throttle)
-        
-        # 信号が来ていない(-1)場合は 0.5(中央/停止) とする
-        raw_steering = command[0] if command[0] != -1 else 0.5
-        raw_throttle = command[2] if command[2] != -1 else 0.5
-
-        # --- 2. -1.0 〜 +1.0 の範囲に正規化 ---
-        # ステアリング: 左=-1.0, 右=+1.0
-        steer_val = raw_steering * 2 - 1
-        
-        # スロットル: 後進=-1.0, 前進=+1.0
-        throttle_val = raw_throttle * 2 - 1
-
-        # --- 3. ミキシング計算 (Arcade Drive方式) ---
-        # 左タイヤ = 前進成分 + 旋回成分
-        # 右タイヤ = 前進成分 - 旋回成分
-        # ※直進したいのに曲がってしまう場合は + と - を逆にしてください
-        left_motor_speed = throttle_val + steer_val
-        right_motor_speed = throttle_val - steer_val
-
-        # --- 4. 速度制限とクリッピング (-1.0〜1.0に収める) ---
-        left_motor_speed = max(min(left_motor_speed, 1.0), -1.0)
-        right_motor_speed = max(min(right_motor_speed, 1.0), -1.0)
-
-        # --- 5. モーターへの出力 ---
-        # Pioneer 3-ATは4輪駆動。左2つ、右2つに分配
-        # motors配列順序: [front_left, back_left, front_right, back_right] と想定
-        
-        # 最大速度設定 (rad/s)
-        MAX_VELOCITY = min(self._motors[0].getMaxVelocity(), self.motor_velocity_cap)
-
-        final_speeds = [
-            left_motor_speed * MAX_VELOCITY,  # Front Left
-            left_motor_speed * MAX_VELOCITY,  # Back Left
-            right_motor_speed * MAX_VELOCITY, # Front Right
-            right_motor_speed * MAX_VELOCITY  # Back Right
-        ]
-
-        for i, m in enumerate(self._motors):
-            m.setVelocity(final_speeds[i])
+        t0 = self._trace.start()
+        output = self._mixer.mix(command)
+        t1 = self._trace.start()
+        self._trace.stop("mix", t0)
+
+        # Webots API の呼び出しが重いので、指令が変わったモーターだけ更新する
+        for i in np.flatnonzero(output != self._motor_output):
+            if self._mixer.is_position[i]:
+                self._motors[i].setPosition(output[i])
+            else:
+                self._motors[i].setVelocity(output[i])
+        self._motor_output = output
+        self._trace.stop("motor.set", t1)
 
     def _handle_image_stream(self, camera: Union[Camera, RangeFinder], port: int):
-        """Stream grayscale images over TCP
+        """Stream images over TCP, raw grayscale for legacy clients or in the
+        format negotiated by the client (see image_stream.py)
 
         Args:
             camera (Camera or RangeFinder): the camera to get images from
@@ -366,59 +462,45 @@ class WebotsArduVehicle():
             cam_sample_period = self.camera.getSamplingPeriod()
             cam_width = self.camera.getWidth()
             cam_height = self.camera.getHeight()
-            print(f"Camera stream started at 127.0.0.1:{port} (I{self._instance}) "
+            print(f"Camera stream started at {self._stream_address}:{port} (I{self._instance}) "
                   f"({cam_width}x{cam_height} @ {1000/cam_sample_period:0.2f}fps)")
         elif isinstance(camera, RangeFinder):
             cam_sample_period = self.rangefinder.getSamplingPeriod()
             cam_width = self.rangefinder.getWidth()
             cam_height = self.rangefinder.getHeight()
-            print(f"RangeFinder stream started at 127.0.0.1:{port} (I{self._instance}) "
+            print(f"RangeFinder stream started at {self._stream_address}:{port} (I{self._instance}) "
                   f"({cam_width}x{cam_height} @ {1000/cam_sample_period:0.2f}fps)")
         else:
             print(sys.stderr, f"Error: camera passed to _handle_image_stream is of invalid type "
                               f"'{type(camera)}' (I{self._instance})")
             return
 
-        # create a local TCP socket server
+        # create a TCP socket server (local only unless a stream address is configured)
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind(('127.0.0.1', port))
+        server.bind((self._stream_address, port))
         server.listen(1)
 
         # continuously send images
         while self._webots_connected:
             # wait for incoming connection
             conn, _ = server.accept()
-            print(f"Connected to camera client (I{self._instance})")
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # clients using the extended protocol announce themselves first, anything else is legacy
+            hello = image_stream.read_hello(conn)
+            if hello is None:
+                print(f"Connected to camera client (I{self._instance})")
+            else:
+                print(f"Connected to camera client (I{self._instance}) "
+                      f"(format={hello[0]}, channels={hello[1]}, quality={hello[2]})")
 
             # send images to client
             try:
-                while self._webots_connected:
-                    # delay at sample rate
-                    start_time = self.robot.getTime()
-
-                    # get image
-                    if isinstance(camera, Camera):
-                        img = self.get_camera_gray_image()
-                    elif isinstance(camera, RangeFinder):
-                        img = self.get_rangefinder_image()
-
-                    if img is None:
-                        print(f"No image received (I{self._instance})")
-                        time.sleep(cam_sample_period/1000)
-                        continue
-
-                    # create a header struct with image size
-                    header = struct.pack("=HH", cam_width, cam_height)
-
-                    # pack header and image and send
-                    data = header + img.tobytes()
-                    conn.sendall(data)
-
-                    # delay at sample rate
-                    while self.robot.getTime() - start_time < cam_sample_period/1000:
-                        time.sleep(0.001)
-
+                if hello is None:
+                    self._stream_legacy(conn, camera, cam_sample_period)
+                else:
+                    self._stream_extended(conn, camera, cam_sample_period, *hello)
             except ConnectionResetError:
                 pass
             except BrokenPipeError:
@@ -427,37 +509,253 @@ class WebotsArduVehicle():
                 conn.close()
                 print(f"Camera client disconnected (I{self._instance})")
 
+    def _capture_image(self, camera: Union[Camera, RangeFinder], channels: int = 1,
+                       depth: DepthProcessor = None, depth_format: str = "uint8") -> np.ndarray:
+        """Get a frame to stream from a camera (grayscale or RGB) or rangefinder
+
+        Rangefinder frames are written into the buffers of the given DepthProcessor.
+        """
+        trace = self._trace
+        t0 = trace.start()
+        if isinstance(camera, Camera):
+            raw = self.camera.getImage()
+            trace.stop("image.capture", t0)
+            if raw is None:
+                return None
+            t0 = trace.start()
+            img = self._camera_rgb(raw)
+            if channels != 3:
+                img = np.average(img, axis=2).astype(np.uint8)
+        else:
+            raw = self._get_rangefinder_raw()
+            trace.stop("image.capture", t0)
+            t0 = trace.start()
+            img = depth.normalized(raw, depth_format)
+        trace.stop("image.convert", t0)
+        return img
+
+    def _new_depth_processor(self) -> DepthProcessor:
+        """Create a DepthProcessor for the rangefinder (one per thread as it reuses buffers)"""
+        return DepthProcessor(self._rangefinder_width, self._rangefinder_height,
+                              self._rangefinder_min_range, self._rangefinder_max_range)
+
+    def _stream_legacy(self, conn: socket.socket, camera: Union[Camera, RangeFinder], cam_sample_period: int):
+        """Send `=HH` header + raw grayscale frames, as expected by the original receivers"""
+        depth = self._new_depth_processor() if isinstance(camera, RangeFinder) else None
+        while self._webots_connected:
+            # delay at sample rate
+            start_time = self.robot.getTime()
+
+            # get image
+            img = self._capture_image(camera, depth=depth)
+
+            if img is None:
+                print(f"No image received (I{self._instance})")
+                time.sleep(cam_sample_period/1000)
+                continue
+
+            # create a header struct with image size
+            header = struct.pack(image_stream.legacy_header_format, img.shape[1], img.shape[0])
+
+            # pack header and image and send
+            t0 = self._trace.start()
+            data = header + img.tobytes()
+            conn.sendall(data)
+            self._trace.stop("image.send", t0)
+
+            # delay at sample rate
+            while self.robot.getTime() - start_time < cam_sample_period/1000:
+                time.sleep(0.001)
+
+    def _stream_extended(self, conn: socket.socket, camera: Union[Camera, RangeFinder], cam_sample_period: int,
+                         fmt: int, channels: int, quality: int):
+        """Send frames with the extended header, encoding them on a worker thread
+
+        Capture stays at the sample rate; if encoding or the link is slower, stale frames
+        are dropped instead of queueing up latency.
+        """
+        depth = None
+        if isinstance(camera, RangeFinder):
+            channels = 1  # RangeFinder frames are single channel
+            depth = self._new_depth_processor()
+        sender = image_stream.FrameSender(conn, image_stream.FrameEncoder(fmt, quality), self._trace)
+        seq = 0
+        try:
+            while self._webots_connected and sender.alive():
+                start_time = self.robot.getTime()
+
+                img = self._capture_image(camera, channels, depth, self._rangefinder_depth_format)
+                if img is None:
+                    time.sleep(cam_sample_period/1000)
+                    continue
+                if depth is not None:
+                    img = img.copy()  # the sender thread holds on to it, the processor buffers get reused
+
+                seq += 1
+                sender.submit(seq, start_time, img)
+
+                # delay at sample rate
+                while self.robot.getTime() - start_time < cam_sample_period/1000:
+                    time.sleep(0.001)
+        finally:
+            sender.close()
+            if sender.dropped:
+                print(f"Camera stream dropped {sender.dropped} stale frames (I{self._instance})")
+
+    def _handle_image_shm(self, camera: Union[Camera, RangeFinder], notify_port: int):
+        """Write grayscale images into a shared memory ring buffer for local consumers
+
+        Args:
+            camera (Camera or RangeFinder): the camera to get images from
+            notify_port (int): localhost UDP port to send new frame notifications to
+        """
+        if isinstance(camera, Camera):
+            kind = "camera"
+            dtype = np.uint8
+            depth = None
+        elif isinstance(camera, RangeFinder):
+            kind = "rangefinder"
+            dtype = np.dtype(self._rangefinder_depth_format)
+            depth = self._new_depth_processor()
+        else:
+            print(sys.stderr, f"Error: camera passed to _handle_image_shm is of invalid type "
+                              f"'{type(camera)}' (I{self._instance})")
+            return
+
+        cam_sample_period = camera.getSamplingPeriod()
+        cam_width = camera.getWidth()
+        cam_height = camera.getHeight()
+
+        path = frame_ring_path(f"webots_{kind}_I{self._instance}")
+        ring = FrameRingWriter(path, (cam_height, cam_width), dtype, notify_port=notify_port)
+        print(f"{kind} shared memory stream started at {path}, notifying 127.0.0.1:{notify_port} "
+              f"(I{self._instance}) ({cam_width}x{cam_height} @ {1000/cam_sample_period:0.2f}fps)")
+
+        try:
+            while self._webots_connected:
+                start_time = self.robot.getTime()
+
+                img = self._capture_image(camera, depth=depth, depth_format=self._rangefinder_depth_format)
+                if img is None:
+                    time.sleep(cam_sample_period/1000)
+                    continue
+                t0 = self._trace.start()
+                ring.write(img, start_time)
+                self._trace.stop("image.send", t0)
+
+                # delay at sample rate
+                while self._webots_connected and self.robot.getTime() - start_time < cam_sample_period/1000:
+                    time.sleep(0.001)
+        finally:
+            ring.close()
+
+    def _handle_occupancy_map(self, port: int, size: float, resolution: float, home: tuple = None):
+        """Integrate every rangefinder frame into an occupancy grid and serve it as tiles
+
+        The rangefinder is assumed to sit at the vehicle origin looking forward.
+
+        Args:
+            port (int): HTTP port of the tile server
+            size (float): side of the mapped square in metres
+            resolution (float): cell size in metres
+            home (tuple, optional): (lat, lon) of the world origin for the GCS. Defaults to None.
+        """
+        max_range = self._rangefinder_max_range
+        # about one beam per cell at max range, more columns only add duplicate cells
+        beams = math.ceil(self._rangefinder_fov * max_range / resolution)
+        scan = DepthScan(self._rangefinder_width, self._rangefinder_height, self._rangefinder_fov, max_range, beams)
+        grid = OccupancyGrid(size, resolution)
+        server = OccupancyTileServer(grid, self._stream_address, port, home)
+        cam_sample_period = self.rangefinder.getSamplingPeriod()
+        print(f"Occupancy map served at http://{self._stream_address}:{port}/meta (I{self._instance}) "
+              f"({grid.cells}x{grid.cells} cells of {resolution}m, {len(scan.angles)} beams "
+              f"@ {1000/cam_sample_period:0.2f}fps)")
+
+        trace = self._trace
+        try:
+            while self._webots_connected:
+                start_time = self.robot.getTime()
+
+                started = time.perf_counter()
+                t0 = trace.start()
+                ranges = scan.ranges(self._get_rangefinder_raw())
+                pos = self.gps.getValues()
+                yaw = self.imu.getRollPitchYaw()[2]
+                t1 = trace.start()
+                trace.stop("map.scan", t0)
+                grid.update(pos[0], pos[1], yaw, scan.angles, ranges, max_range)
+                trace.stop("map.update", t1)
+                server.record(time.perf_counter() - started)
+
+                # delay at sample rate
+                while self._webots_connected and self.robot.getTime() - start_time < cam_sample_period/1000:
+                    time.sleep(0.001)
+        finally:
+            server.close()
+
     def webots_connected(self) -> bool:
         """Check if Webots client is connected"""
         return self._webots_connected
 
+    def preview_enabled(self) -> bool:
+        """Check if update_gui() does anything (False when running headless)"""
+        return self._preview_period is not None
+
     def update_gui(self):
-        if not self.webots_connected(): return
-        
-        try:
-            # カメラ映像の取得。まだ準備ができていない場合はスキップするようにします
-            if hasattr(self, 'camera') and self.camera:
-                img = self.get_camera_image()
-                if img is not None:
-                    cv2.imshow("Webots_Camera_View", cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
-            
-            # ソナーやレンジファインダーも同様
-            if hasattr(self, 'sonar') and self.sonar:
-                sonar_value = self.sonar.getValue()
-                # 1秒ごとにコンソールに出力 (500Hz想定のシミュレーションなら約100〜200ステップごと)
-                # ここでは正確な時間(Robot.getTime)を使用して判定
-                current_time = self.robot.getTime()
-                if not hasattr(self, '_last_print_time'):
-                    self._last_print_time = 0
-                
-                if current_time - self._last_print_time >= 1.0:
-                    print(f"{current_time:.1f}s: {sonar_value:.3f}m")
-                    self._last_print_time = current_time
+        """Show a downscaled camera preview and print the sonar distance (call from the main thread)
 
-            cv2.waitKey(1)
+        Runs at most preview_fps times per second and only redraws when the camera has a new frame.
+        """
+        if not self.webots_connected() or self._preview_period is None:
+            return
+        now = time.monotonic()
+        if now < self._preview_next:
+            return
+        self._preview_next = now + self._preview_period
+        t0 = self._trace.start()
+
+        try:
+            current_time = self.robot.getTime()
+
+            # カメラは samplingPeriod ごとにしか更新されないので、新しいフレームのときだけ描画する
+            camera = self.camera
+            if camera is not None:
+                frame = int(current_time * 1000) // max(1, camera.getSamplingPeriod())
+                if frame != self._preview_frame:
+                    raw = camera.getImage()
+                    if raw is not None:
+                        self._preview_frame = frame
+                        img = np.frombuffer(raw, np.uint8).reshape((camera.getHeight(), camera.getWidth(), 4))
+                        # Webots の BGRA からアルファを落とせばそのまま imshow の BGR になる (色変換不要)
+                        n = self._preview_downscale
+                        cv2.imshow("Webots_Camera_View", np.ascontiguousarray(img[::n, ::n, :3]))
+                        self._preview_window = True
+
+            # ソナーは 1秒ごと (シミュレーション時間) にコンソールに出力
+            if self.sonar is not None and current_time - self._last_print_time >= 1.0:
+                print(f"{current_time:.1f}s: {self.sonar.getValue():.3f}m")
+                self._last_print_time = current_time
+
+            if self._preview_window:
+                cv2.waitKey(1)
         except Exception as e:
             # エラーが出ても無視して次に進む
             print(f"GUI Update skip: {e}")
+        self._trace.stop("gui", t0)
+
+    def dump_trace(self, path: str = None):
+        """Write the recorded phase timings as Chrome trace JSON and print the busiest phases
+
+        Args:
+            path (str, optional): output file. Defaults to the trace_path given to the constructor.
+        """
+        if not self._trace.enabled:
+            return
+        self._trace.dump(path)
+        summary = sorted(self._trace.summary().items(), key=lambda item: -item[1]["total_ms"])
+        for name, s in summary[:10]:
+            print(f"  {name:<16} n={s['count']:<7} share={s['share']*100:5.1f}% "
+                  f"p50={s['p50_ms']:.3f}ms p99={s['p99_ms']:.3f}ms max={s['max_ms']:.3f}ms")
 
 
     def get_camera_gray_image(self) -> np.ndarray:
@@ -471,128 +769,129 @@ class WebotsArduVehicle():
         img = self.camera.getImage()
         if img is None:
             return None
+        return self._camera_rgb(img)
+
+    def _camera_rgb(self, raw: bytes) -> np.ndarray:
+        """Convert a raw Webots camera image to an RGB numpy array"""
         # Webots uses BGRA format internally
-        img = np.frombuffer(img, np.uint8).reshape((self.camera.getHeight(), self.camera.getWidth(), 4))
+        img = np.frombuffer(raw, np.uint8).reshape((self.camera.getHeight(), self.camera.getWidth(), 4))
         # Swap BGRA to RGB: B,G,R is at 0,1,2. We want R,G,B.
         return img[:, :, [2, 1, 0]] # Convert BGRA to RGB
 
-    def get_rangefinder_image(self, use_int16: bool = False) -> np.ndarray:
-        """Get the rangefinder depth image as a numpy array of int8 or int16"""\
-
-        # get range image size
-        height = self.rangefinder.getHeight()
-        width = self.rangefinder.getWidth()
-
-        # get image, and convert raw ctypes array to numpy array
+    def _get_rangefinder_raw(self) -> np.ndarray:
+        """Get a float32 view of the rangefinder image in metres (no copy, owned by Webots)"""
         # https://cyberbotics.com/doc/reference/rangefinder
         image_c_ptr = self.rangefinder.getRangeImage(data_type="buffer")
-        img_arr = np.ctypeslib.as_array(image_c_ptr, (width*height,))
-        img_floats = img_arr.reshape((height, width))
+        img_arr = np.ctypeslib.as_array(image_c_ptr, (self._rangefinder_width*self._rangefinder_height,))
+        return img_arr.reshape((self._rangefinder_height, self._rangefinder_width))
 
-        # normalize and set unknown values to max range
-        range_range = self.rangefinder.getMaxRange() - self.rangefinder.getMinRange()
-        img_normalized = (img_floats - self.rangefinder.getMinRange()) / range_range
-        img_normalized[img_normalized == float('inf')] = 1
+    def get_rangefinder_image(self, use_int16: bool = False) -> np.ndarray:
+        """Get the rangefinder depth image as a numpy array of uint8 or uint16
 
-        # convert to int8 or int16, allowing for the option of higher precision if desired
-        if use_int16:
-            img = (img_normalized * 65535).astype(np.uint16)
-        else:
-            img = (img_normalized * 255).astype(np.uint8)
+        Depth is normalized from [min range, max range], unknown (inf/NaN) values are set to max range
+        and out of range values are clipped. The returned array is reused by the next call.
+        """
+        if self._rangefinder_depth is None:
+            self._rangefinder_depth = self._new_depth_processor()
+        return self._rangefinder_depth.normalized(self._get_rangefinder_raw(), "uint16" if use_int16 else "uint8")
 
-        return img
+    def get_rangefinder_depth(self) -> np.ndarray:
+        """Get the rangefinder depth in metres as float32, clipped to the sensor range
+
+        The returned array is reused by the next call.
+        """
+        if self._rangefinder_depth is None:
+            self._rangefinder_depth = self._new_depth_processor()
+        return self._rangefinder_depth.metric(self._get_rangefinder_raw())
 
     def stop_motors(self):
         """Set all motors to zero velocity"""
-        for m in self._motors:
-            m.setPosition(float('inf'))
-            m.setVelocity(0)
-
-    def send_mavlink_distance(self):
-        """Send the center pixel distance from the RangeFinder to ArduPilot via MAVLink."""
-        if not (self.mav_link):
-            return
-
-        try:
-            # Prefer simple DistanceSensor (sonar) if available
-            if not (hasattr(self, 'sonar') and self.sonar is not None):
-                return
-
-            try:
-                distance_raw = self.sonar.getValue()
-                distance_m = float(distance_raw)
-            except Exception:
-                return
-
-            # Webots DistanceSensorのAPI差異を吸収
-            # - getMinRange/getMaxRange があれば使用
-            # - なければ getMinValue/getMaxValue を試す
-            # - 最後に安全な既定値
-            min_r = None
-            max_r = None
+        for m, is_position in zip(self._motors, self._mixer.is_position):
+            if is_position:
+                m.setPosition(0)
+            else:
+                m.setPosition(float('inf'))
+                m.setVelocity(0)
+        # force the next command to be applied to every motor
+        self._motor_output[:] = np.nan
+
+    @staticmethod
+    def _resolve_sonar_range_cm(sonar) -> tuple:
+        """Get the (min, max) range of a DistanceSensor in cm as sent in DISTANCE_SENSOR"""
+        # Webots DistanceSensorのAPI差異を吸収
+        # - getMinRange/getMaxRange があれば使用
+        # - なければ getMinValue/getMaxValue を試す
+        # - 最後に安全な既定値
+        min_r = 0.2
+        max_r = 5.0
+        if sonar is not None:
             for min_name, max_name in (
                 ('getMinRange', 'getMaxRange'),
                 ('getMinValue', 'getMaxValue'),
             ):
                 try:
-                    min_r = float(getattr(self.sonar, min_name)())
-                    max_r = float(getattr(self.sonar, max_name)())
+                    min_r = float(getattr(sonar, min_name)())
+                    max_r = float(getattr(sonar, max_name)())
                     break
                 except Exception:
                     continue
-            if min_r is None or max_r is None:
-                min_r = 0.2
-                max_r = 5.0
 
-            # inf/NaNは最大距離扱いにする
-            if distance_m == float('inf') or distance_m != distance_m:
-                distance_m = max_r
+        # ArduPilotへ送る値はcm(uint16)
+        min_cm = max(0, int(min_r * 100))
+        max_cm = max(min_cm + 1, int(max_r * 100))
+        return min_cm, max_cm
 
-            # ArduPilotへ送る値はcm(uint16)。範囲外はクランプして常に有効値にする
-            min_cm = max(0, int(min_r * 100))
-            max_cm = max(min_cm + 1, int(max_r * 100))
-            current_cm = int(distance_m * 100)
-            if current_cm < min_cm:
-                current_cm = min_cm
-            if current_cm > max_cm:
-                current_cm = max_cm
+    def send_mavlink_distance(self, distance_m: float = None):
+        """Send the sonar (DistanceSensor) distance to ArduPilot via MAVLink DISTANCE_SENSOR.
 
+        Args:
+            distance_m (float, optional): distance sampled on the physics thread. Reads the sonar if None.
+        """
+        if not self.mav_link or self.sonar is None:
+            return
 
-            # Send MAVLink DISTANCE_SENSOR
-            try:
-                # 自己紹介（ハートビート）を送信　。不要、コメントアウト
-                # 頻度を1秒に1回程度にし、状態を「ACTIVE」に明示
-                # if self._step_counter % 50 == 0: 
-                #     try:
-                #         self.mav_link.mav.heartbeat_send(
-                #             mavutil.mavlink.MAV_TYPE_ONBOARD_CONTROLLER,
-                #             mavutil.mavlink.MAV_AUTOPILOT_INVALID,
-                #             mavutil.mavlink.MAV_MODE_FLAG_SAFETY_ARMED,
-                #             0,
-                #             mavutil.mavlink.MAV_STATE_ACTIVE
-                #         )
-                #     except Exception:
-                #         pass
-                
-                safe_cm = max(0, current_cm)
-
-                # DISTANCE_SENSOR メッセージの送信
-                # RNGFND1_ORIENT=0 (ROTATION_NONE) 固定運用のため、orientation=0のみ送信。
-                self.mav_link.mav.distance_sensor_send(
-                    self.get_time_boot_ms(),
-                    min_cm,
-                    max_cm,
-                    safe_cm,
-                    mavutil.mavlink.MAV_DISTANCE_SENSOR_LASER,
-                    0,
-                    0,
-                    0,
-                )
-                # ↓ 成功したか確認するためのプリント文
-                # print(f"[Debug 1] OK: Sent {current_cm} cm to 14551") 
-            except Exception as e:
-                # ↓ エラーがあれば表示する
-                print(f"[MAVLink Send Error] {e}")
-            
-        except Exception:
+        t0 = self._trace.start()
+        if distance_m is None:
+            distance_m = self.sonar.getValue()
+        distance_m = float(distance_m)
+
+        # inf/NaNは最大距離扱いにする。範囲外はクランプして常に有効値にする
+        if distance_m == float('inf') or distance_m != distance_m:
+            current_cm = self._sonar_max_cm
+        else:
+            current_cm = min(max(int(distance_m * 100), self._sonar_min_cm), self._sonar_max_cm)
+
+        # DISTANCE_SENSOR メッセージの送信
+        # RNGFND1_ORIENT=0 (ROTATION_NONE) 固定運用のため、orientation=0のみ送信。
+        self.mav_link.mav.distance_sensor_send(
+            self.get_time_boot_ms(),
+            self._sonar_min_cm,
+            self._sonar_max_cm,
+            current_cm,
+            mavutil.mavlink.MAV_DISTANCE_SENSOR_LASER,
+            0,
+            0,
+            0,
+        )
+        self._trace.stop("mavlink.distance", t0)
+
+    def send_mavlink_obstacle_distance(self):
+        """Send the rangefinder image to ArduPilot as OBSTACLE_DISTANCE (72 sectors, body frame)."""
+        if not self.mav_link or self._obstacle_reducer is None:
             return
+
+        t0 = self._trace.start()
+        reducer = self._obstacle_reducer
+        distances = reducer.reduce(self._get_rangefinder_raw())
+        self.mav_link.mav.obstacle_distance_send(
+            self.get_time_boot_ms() * 1000,
+            mavutil.mavlink.MAV_DISTANCE_SENSOR_LASER,
+            distances.tolist(),
+            0,                 # increment (deg), superseded by increment_f
+            reducer.min_cm,
+            reducer.max_cm,
+            reducer.increment,
+            reducer.angle_offset,
+            mavutil.mavlink.MAV_FRAME_BODY_FRD,
+        )
+        self._trace.stop("mavlink.obstacle", t0)
@@ -1,86 +1,344 @@
 #!/usr/bin/env python3
 
 #
-# An example script that receives images from a WebotsArduVehicle on port 5599 
+# An example script that receives images from a WebotsArduVehicle on port 5599
 # and displays them overlaid with any ArUco markers using OpenCV.
 # Requires opencv-python (`pip3 install opencv-python`)
 #
+# The frames are processed as a pipeline so that a slow detector never makes
+# the latency grow:
+#   - a receiver thread reads each frame with recv_into into preallocated buffers
+#   - the newest frame is handed to the next idle detector process (shared
+#     memory, no pickling); frames arriving while every detector is busy are
+#     dropped ("latest frame wins")
+#   - once a marker has been found only a region of interest around it is
+#     searched, with a full frame detection every --full-interval frames
+#   - detections are sent as MAVLink LANDING_TARGET (angles from the camera
+#     field of view, distance from the apparent marker size). By default they go
+#     to the webotsrf MAVProxy module (UDP 14551); enable forwarding there with
+#     `webotsrf types add LANDING_TARGET`.
+#
+# Throughput (received / detected / dropped frames per second, detector time
+# and frame-to-result latency) is printed every few seconds.
+#
 
 # flake8: noqa
 
+import os
+import sys
 import cv2
+import math
+import time
 import socket
 import struct
+import argparse
+import threading
 import numpy as np
+import multiprocessing as mp
+from multiprocessing import connection, shared_memory
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "controllers", "ardupilot_vehicle_controller"))
+from image_stream import recv_into_exact
+
+
+def make_detector():
+    """Return detect(gray) -> (corners, ids) for both the old and new (>= 4.7) OpenCV ArUco APIs"""
+    if hasattr(cv2.aruco, "ArucoDetector"):
+        detector = cv2.aruco.ArucoDetector(cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50),
+                                           cv2.aruco.DetectorParameters())
+
+        def detect(gray):
+            corners, ids, _ = detector.detectMarkers(gray)
+            return corners, ids
+    else:
+        aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
+        aruco_params = cv2.aruco.DetectorParameters_create()
+
+        def detect(gray):
+            corners, ids, _ = cv2.aruco.detectMarkers(gray, aruco_dict, parameters=aruco_params)
+            return corners, ids
+    return detect
+
+
+def detector_worker(conn, shm_name):
+    """Detector process: waits for (seq, width, height, roi) jobs on conn, the image is in shared memory"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    detect = make_detector()
+    try:
+        while True:
+            job = conn.recv()
+            if job is None:
+                break
+            seq, width, height, roi = job
+            img = np.ndarray((height, width), np.uint8, shm.buf)
+            x0, y0 = 0, 0
+            if roi is not None:
+                x0, y0, x1, y1 = roi
+                img = img[y0:y1, x0:x1]
+            start = time.perf_counter()
+            corners, ids = detect(img)
+            detect_ms = (time.perf_counter() - start) * 1000
+            markers = []
+            if ids is not None:
+                for marker_corners, marker_id in zip(corners, ids.flatten()):
+                    markers.append((int(marker_id), marker_corners.reshape((4, 2)) + (x0, y0)))
+            del img
+            conn.send((seq, markers, roi is None, detect_ms))
+    finally:
+        shm.close()
+
+
+class DetectorPool():
+    """Fixed set of detector processes, each with its own shared memory frame slot"""
+
+    def __init__(self, workers: int, max_pixels: int):
+        ctx = mp.get_context("spawn")
+        self.max_pixels = max_pixels
+        self.slots = []
+        for _ in range(workers):
+            shm = shared_memory.SharedMemory(create=True, size=max_pixels)
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=detector_worker, args=(child, shm.name), daemon=True)
+            proc.start()
+            self.slots.append({"shm": shm, "conn": parent, "proc": proc, "busy": False})
+
+    def idle_slot(self):
+        for slot in self.slots:
+            if not slot["busy"]:
+                return slot
+        return None
+
+    def submit(self, slot, seq, img, roi):
+        height, width = img.shape
+        if width * height > self.max_pixels:
+            raise ValueError(f"frame {width}x{height} exceeds --max-pixels")
+        np.ndarray((height, width), np.uint8, slot["shm"].buf)[:] = img
+        slot["busy"] = True
+        slot["conn"].send((seq, width, height, roi))
+
+    def results(self, timeout: float):
+        """Yield (seq, markers, full, detect_ms) from every worker that finished"""
+        by_conn = {slot["conn"]: slot for slot in self.slots}
+        for conn in connection.wait(list(by_conn), timeout):
+            by_conn[conn]["busy"] = False
+            yield conn.recv()
+
+    def close(self):
+        for slot in self.slots:
+            try:
+                slot["conn"].send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for slot in self.slots:
+            slot["proc"].join(timeout=1.0)
+            slot["shm"].close()
+            slot["shm"].unlink()
+
+
+class FrameReceiver(threading.Thread):
+    """Reads the legacy "=HH" + grayscale stream into two preallocated buffers and publishes the newest"""
+
+    def __init__(self, address: str, port: int):
+        super().__init__(daemon=True)
+        self.sock = socket.create_connection((address, port))
+        self.lock = threading.Lock()
+        self.new_frame = threading.Condition(self.lock)
+        self.front = None          # newest complete frame (numpy view of its buffer)
+        self.seq = 0
+        self.stamp = 0.0           # receive time of the newest frame
+        self.received = 0
+        self.alive = True
+        self._front_buf = None
+        self._back = bytearray()
+
+    def run(self):
+        header = bytearray(struct.calcsize("=HH"))
+        try:
+            while True:
+                recv_into_exact(self.sock, memoryview(header))
+                width, height = struct.unpack("=HH", header)
+                if len(self._back) != width * height:
+                    self._back = bytearray(width * height)
+                recv_into_exact(self.sock, memoryview(self._back))
+                img = np.frombuffer(self._back, np.uint8).reshape((height, width))
+                with self.lock:
+                    # swap buffers: the frame we just filled becomes the front one and the
+                    # old front buffer is reused for the next frame (consumers copy under the lock)
+                    self._front_buf, self._back = self._back, self._front_buf
+                    self.front = img
+                    if self._back is None or len(self._back) != width * height:
+                        self._back = bytearray(width * height)
+                    self.seq += 1
+                    self.stamp = time.monotonic()
+                    self.received += 1
+                    self.new_frame.notify_all()
+        except (ConnectionError, OSError) as e:
+            print(f"[aruco] Stream closed: {e}")
+        finally:
+            self.alive = False
+            with self.lock:
+                self.new_frame.notify_all()
+
+    def close(self):
+        self.sock.close()
+
+
+class RoiTracker():
+    """Keeps a search window around the last detections; requests a full frame periodically or when lost"""
+
+    def __init__(self, full_interval: int, margin: float):
+        self.full_interval = full_interval
+        self.margin = margin
+        self.box = None
+        self.since_full = 0
+
+    def next_roi(self, width, height):
+        if self.box is None or self.since_full >= self.full_interval:
+            self.since_full = 0
+            return None
+        self.since_full += 1
+        x0, y0, x1, y1 = self.box
+        # grow by margin * marker size so the marker stays inside while moving
+        mx = (x1 - x0) * self.margin + 8
+        my = (y1 - y0) * self.margin + 8
+        return (max(0, int(x0 - mx)), max(0, int(y0 - my)),
+                min(width, int(x1 + mx)), min(height, int(y1 + my)))
+
+    def update(self, markers):
+        if not markers:
+            self.box = None
+            return
+        points = np.concatenate([c for _, c in markers])
+        self.box = (*points.min(axis=0), *points.max(axis=0))
+
+
+def send_landing_targets(mav, markers, width, height, fov, marker_size):
+    # pinhole model: focal length in pixels from the horizontal field of view
+    focal = (width / 2) / math.tan(fov / 2)
+    time_usec = int(time.time() * 1e6)
+    for marker_id, corners in markers:
+        cx, cy = corners.mean(axis=0)
+        side = np.mean(np.linalg.norm(corners - np.roll(corners, 1, axis=0), axis=1))
+        angle_x = math.atan2(cx - width / 2, focal)
+        angle_y = math.atan2(cy - height / 2, focal)
+        distance = marker_size * focal / side if side > 0 else 0.0
+        size = math.atan2(side, focal)
+        mav.mav.landing_target_send(time_usec, marker_id, mavutil.mavlink.MAV_FRAME_BODY_FRD,
+                                    angle_x, angle_y, distance, size, size)
+
+
+def draw_markers(img, markers):
+    for marker_id, corners in markers:
+        pts = corners.astype(np.int32)
+        cv2.polylines(img, [pts], True, (0, 255, 0), 2)
+        cX, cY = pts.mean(axis=0).astype(int)
+        cv2.circle(img, (int(cX), int(cY)), 4, (0, 0, 255), -1)
+        cv2.putText(img, str(marker_id), (int(pts[0][0]), int(pts[0][1]) - 15),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5599)
+    parser.add_argument("--workers", type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)),
+                        help="Number of detector processes")
+    parser.add_argument("--full-interval", type=int, default=10,
+                        help="Run a full frame detection at least every N frames while tracking")
+    parser.add_argument("--roi-margin", type=float, default=1.0,
+                        help="ROI margin around the tracked markers, in marker sizes")
+    parser.add_argument("--max-pixels", type=int, default=1920 * 1080, help="Largest frame size expected")
+    parser.add_argument("--fov", type=float, default=0.785398,
+                        help="Horizontal camera field of view in radians (Webots Camera fieldOfView)")
+    parser.add_argument("--marker-size", type=float, default=0.2, help="Marker side length in metres")
+    parser.add_argument("--mavlink", default="udpout:127.0.0.1:14551",
+                        help="Where to send LANDING_TARGET (pymavlink connection string, 'none' to disable)")
+    parser.add_argument("--no-display", action="store_true", help="Don't open a preview window")
+    parser.add_argument("--stats-interval", type=float, default=2.0, help="Seconds between throughput reports")
+    args = parser.parse_args()
+
+    mav = None
+    if args.mavlink != "none":
+        global mavutil
+        from pymavlink import mavutil
+        mav = mavutil.mavlink_connection(args.mavlink, source_system=1,
+                                         source_component=mavutil.mavlink.MAV_COMP_ID_ONBOARD_COMPUTER)
+
+    pool = DetectorPool(args.workers, args.max_pixels)
+    receiver = FrameReceiver(args.address, args.port)
+    receiver.start()
+    tracker = RoiTracker(args.full_interval, args.roi_margin)
+
+    dispatched_seq = 0           # newest frame handed to a detector
+    applied_seq = 0              # newest frame whose result has been used
+    in_flight = {}               # seq -> (receive time, width, height)
+    markers = []
+    stats = {"detected": 0, "full": 0, "dropped": 0, "detect_ms": 0.0, "latency_ms": 0.0}
+    last_received = 0
+    last_report = time.monotonic()
+
+    try:
+        while receiver.alive:
+            # hand the newest frame to an idle detector; anything older is simply skipped
+            slot = pool.idle_slot()
+            if slot is not None:
+                with receiver.lock:
+                    if receiver.seq == dispatched_seq and receiver.alive:
+                        receiver.new_frame.wait(timeout=0.005)
+                    if receiver.seq != dispatched_seq and receiver.front is not None:
+                        seq = receiver.seq
+                        height, width = receiver.front.shape
+                        pool.submit(slot, seq, receiver.front, tracker.next_roi(width, height))
+                        in_flight[seq] = (receiver.stamp, width, height)
+                        stats["dropped"] += seq - dispatched_seq - 1
+                        dispatched_seq = seq
+
+            for seq, found, full, detect_ms in pool.results(timeout=0 if pool.idle_slot() else 0.005):
+                stamp, width, height = in_flight.pop(seq)
+                stats["detected"] += 1
+                stats["full"] += full
+                stats["detect_ms"] += detect_ms
+                stats["latency_ms"] += (time.monotonic() - stamp) * 1000
+                # results can come back out of order from several workers: keep only newer ones
+                if seq < applied_seq:
+                    continue
+                applied_seq = seq
+                markers = found
+                tracker.update(markers)
+                if mav is not None and markers:
+                    send_landing_targets(mav, markers, width, height, args.fov, args.marker_size)
+
+            if not args.no_display:
+                with receiver.lock:
+                    frame = receiver.front.copy() if receiver.front is not None else None
+                if frame is not None:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+                    draw_markers(frame, markers)
+                    cv2.imshow("image", frame)
+                if cv2.waitKey(1) == ord("q"):
+                    break
+
+            now = time.monotonic()
+            if now - last_report >= args.stats_interval:
+                elapsed = now - last_report
+                received = receiver.received - last_received
+                n = max(1, stats["detected"])
+                print(f"[aruco] rx {received / elapsed:.1f} fps | detect {stats['detected'] / elapsed:.1f} fps "
+                      f"(full {stats['full'] / elapsed:.1f}) | dropped {stats['dropped'] / elapsed:.1f} fps | "
+                      f"detector {stats['detect_ms'] / n:.1f} ms | latency {stats['latency_ms'] / n:.1f} ms | "
+                      f"markers {[marker_id for marker_id, _ in markers]}")
+                stats = dict.fromkeys(stats, 0)
+                last_received = receiver.received
+                last_report = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.close()
+        pool.close()
+        if not args.no_display:
+            cv2.destroyAllWindows()
+
 
-# connect to WebotsArduVehicle
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect(("127.0.0.1", 5599))
-
-# ArUco setup
-aruco_dict = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_50)
-aruco_params = cv2.aruco.DetectorParameters_create()
-
-header_size = struct.calcsize("=HH")
-while True:
-    # receive header
-    header = s.recv(header_size)
-    if len(header) != header_size:
-        print("Header size mismatch")
-        break
-
-    # parse header
-    width, height = struct.unpack("=HH", header)
-
-    # for CV applications we may want camera intrinsics such as focal length: 
-    # https://stackoverflow.com/questions/61555182/webot-camera-default-parameters-like-pixel-size-and-focus
-    # cam_focal_length = 2 * np.arctan(np.tan(cam_fov * 0.5) / (cam_width / cam_height))
-
-    # receive image
-    bytes_to_read = width * height
-    img = bytes()
-    while len(img) < bytes_to_read:
-        img += s.recv(min(bytes_to_read - len(img), 4096))
-
-    # convert to numpy array
-    img = np.frombuffer(img, np.uint8).reshape((height, width))
-    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-
-    # detect ArUco markers
-    (corners, ids, rejected) = cv2.aruco.detectMarkers(img, aruco_dict, parameters=aruco_params)
-    if len(corners) > 0:
-        # flatten the ArUco IDs list
-        ids = ids.flatten()
-        # loop over the detected ArUCo corners
-        for (markerCorner, markerID) in zip(corners, ids):
-            # extract the marker corners (which are always returned in
-            # top-left, top-right, bottom-right, and bottom-left order)
-            corners = markerCorner.reshape((4, 2))
-            (topLeft, topRight, bottomRight, bottomLeft) = corners
-            # convert each of the (x, y)-coordinate pairs to integers
-            topRight = (int(topRight[0]), int(topRight[1]))
-            bottomRight = (int(bottomRight[0]), int(bottomRight[1]))
-            bottomLeft = (int(bottomLeft[0]), int(bottomLeft[1]))
-            topLeft = (int(topLeft[0]), int(topLeft[1]))
-
-            # draw the bounding box of the ArUCo detection
-            cv2.line(img, topLeft, topRight, (0, 255, 0), 2)
-            cv2.line(img, topRight, bottomRight, (0, 255, 0), 2)
-            cv2.line(img, bottomRight, bottomLeft, (0, 255, 0), 2)
-            cv2.line(img, bottomLeft, topLeft, (0, 255, 0), 2)
-            # compute and draw the center (x, y)-coordinates of the ArUco
-            # marker
-            cX = int((topLeft[0] + bottomRight[0]) / 2.0)
-            cY = int((topLeft[1] + bottomRight[1]) / 2.0)
-            cv2.circle(img, (cX, cY), 4, (0, 0, 255), -1)
-            # draw the ArUco marker ID on the image
-            cv2.putText(img, str(markerID),
-                (topLeft[0], topLeft[1] - 15), cv2.FONT_HERSHEY_SIMPLEX,
-                0.5, (0, 255, 0), 2)
-
-    # display image
-    cv2.imshow("image", img)
-    if cv2.waitKey(1) == ord("q"):
-        break
-
-s.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,111 @@
 #!/usr/bin/env python3
 
 #
-# An example script that receives images from a WebotsArduVehicle 
+# An example script that receives images from a WebotsArduVehicle
 # on port 5599 and displays using OpenCV.
 # Requires opencv-python (`pip3 install opencv-python`)
 #
+# With `--format raw|jpeg|png|delta` (and optionally `--rgb`) the script negotiates
+# the extended stream protocol (see image_stream.py), which is worth it when the
+# Webots host is another machine (start the controller with `--stream-address 0.0.0.0`).
+#
+# With `--transport shm` the frames are mapped straight out of the shared memory
+# ring buffer written by a controller started with `--image-transport shm`
+# (same machine only), and port 5599 is used for UDP new frame notifications.
+#
 
 # flake8: noqa
 
+import os
+import sys
 import cv2
 import socket
 import struct
+import argparse
 import numpy as np
 
-# connect to WebotsArduVehicle
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect(("127.0.0.1", 5599))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "controllers", "ardupilot_vehicle_controller"))
+from frame_ring import FrameRingReader, frame_ring_path
+import image_stream
 
-header_size = struct.calcsize("=HH")
-while True:
-    # receive header
-    header = s.recv(header_size)
-    if len(header) != header_size:
-        print("Header size mismatch")
-        break
+parser = argparse.ArgumentParser()
+parser.add_argument("--transport", choices=["tcp", "shm"], default="tcp")
+parser.add_argument("--address", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=5599)
+parser.add_argument("--format", choices=list(image_stream.FORMAT_NAMES), default=None,
+                    help="Request the extended stream in this format (default: legacy raw grayscale)")
+parser.add_argument("--rgb", action="store_true", help="Request colour frames (extended stream only)")
+parser.add_argument("--quality", type=int, default=80, help="JPEG quality / PNG compression level")
+parser.add_argument("--ring", default="webots_camera_I0",
+                    help="Shared memory ring name (webots_<camera|rangefinder>_I<instance>)")
+args = parser.parse_args()
+
+
+def tcp_frames():
+    # connect to WebotsArduVehicle
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((args.address, args.port))
+
+    header_size = struct.calcsize("=HH")
+    try:
+        while True:
+            # receive header
+            header = s.recv(header_size)
+            if len(header) != header_size:
+                print("Header size mismatch")
+                break
+
+            # parse header
+            width, height = struct.unpack("=HH", header)
 
-    # parse header
-    width, height = struct.unpack("=HH", header)
+            # receive image
+            bytes_to_read = width * height
+            img = bytes()
+            while len(img) < bytes_to_read:
+                img += s.recv(min(bytes_to_read - len(img), 4096))
 
-    # receive image
-    bytes_to_read = width * height
-    img = bytes()
-    while len(img) < bytes_to_read:
-        img += s.recv(min(bytes_to_read - len(img), 4096))
+            # convert incoming bytes to a numpy array (a grayscale image)
+            yield np.frombuffer(img, np.uint8).reshape((height, width))
+    finally:
+        s.close()
 
-    # convert incoming bytes to a numpy array (a grayscale image)
-    img = np.frombuffer(img, np.uint8).reshape((height, width))
 
+def extended_frames():
+    client = image_stream.ImageStreamClient(args.address, args.port,
+                                            image_stream.FORMAT_NAMES[args.format],
+                                            3 if args.rgb else 1, args.quality)
+    try:
+        while True:
+            info, img = client.recv()
+            if info["channels"] == 3 and info["format"] in (image_stream.FORMAT_RAW, image_stream.FORMAT_DELTA):
+                img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+            yield img
+    finally:
+        client.close()
+
+
+def shm_frames():
+    ring = FrameRingReader(frame_ring_path(args.ring), notify_port=args.port)
+    try:
+        while True:
+            if not ring.wait(timeout=1.0):
+                continue
+            # zero-copy view into the ring, valid until the writer laps this slot
+            seq, timestamp, img = ring.latest()
+            yield img
+    finally:
+        ring.close()
+
+
+if args.transport == "shm":
+    frames = shm_frames()
+elif args.format is not None:
+    frames = extended_frames()
+else:
+    frames = tcp_frames()
+
+for img in frames:
     # Do cool stuff with the image here
     # ...
 
@@ -44,5 +113,3 @@ while True:
     cv2.imshow("image", img)
     if cv2.waitKey(1) == ord("q"):
         break
-
-s.close()
\ No newline at end of file
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+#
+# A Webots-free stand-in for WebotsArduVehicle: simulates many skid-steer rovers
+# with a simple kinematic model in one process, speaking the same UDP protocol
+# as the Webots controller (16 float servo outputs in on 9002+10*instance, the
+# 16 double FDM struct back to SITL on port+1, lockstep: one step per packet).
+#
+# Each vehicle has a forward distance sensor ray-cast against the arena walls
+# and a few round obstacles; readings are sent as MAVLink DISTANCE_SENSOR to
+# udpout:<sitl>:14551+10*instance (the webotsrf MAVProxy module) like the Webots
+# controller does.
+#
+# All vehicles that have a new servo packet are stepped together with NumPy, so
+# the cost per step barely grows with the fleet size and SITL can run with
+# --speedup. `--benchmark N` runs N steps without SITL and reports the achieved
+# real-time factor (useful on CI boxes). See start_sitl4kinematic.sh.
+#
+# Requires numpy (and pymavlink for DISTANCE_SENSOR)
+#
+
+# flake8: noqa
+
+import math
+import time
+import socket
+import struct
+import argparse
+import selectors
+import numpy as np
+
+# same packet layouts as WebotsArduVehicle
+controls_struct_format = 'f'*16
+controls_struct_size = struct.calcsize(controls_struct_format)
+fdm_struct_format = 'd'*(1+3+3+3+3+3)
+fdm_struct_size = struct.calcsize(fdm_struct_format)
+
+GRAVITY = 9.80665
+
+
+class World():
+    """Square arena (walls at +-half_size) with round obstacles, for the distance sensor"""
+
+    def __init__(self, half_size: float = 50.0, obstacles: int = 20, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.half_size = half_size
+        self.centers = rng.uniform(-half_size * 0.8, half_size * 0.8, size=(obstacles, 2))
+        self.radii = rng.uniform(0.5, 2.0, size=obstacles)
+
+    def ranges(self, x: np.ndarray, y: np.ndarray, yaw: np.ndarray, max_range: float) -> np.ndarray:
+        """Distance along each heading to the nearest wall or obstacle (vectorized over vehicles)"""
+        dx, dy = np.cos(yaw), np.sin(yaw)
+        # walls: distance to the first x / y boundary crossed
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tx = np.where(dx > 0, (self.half_size - x) / dx, np.where(dx < 0, (-self.half_size - x) / dx, np.inf))
+            ty = np.where(dy > 0, (self.half_size - y) / dy, np.where(dy < 0, (-self.half_size - y) / dy, np.inf))
+        best = np.minimum(np.minimum(tx, ty), max_range)
+        if len(self.radii):
+            # ray-circle intersection for every (vehicle, obstacle) pair
+            ox = self.centers[None, :, 0] - x[:, None]
+            oy = self.centers[None, :, 1] - y[:, None]
+            along = ox * dx[:, None] + oy * dy[:, None]
+            perp2 = ox * ox + oy * oy - along * along
+            r2 = self.radii[None, :] ** 2
+            hit = (perp2 <= r2) & (along > 0)
+            t = np.where(hit, along - np.sqrt(np.maximum(r2 - perp2, 0)), np.inf)
+            best = np.minimum(best, np.maximum(t.min(axis=1), 0))
+        return best
+
+    def blocked(self, x: np.ndarray, y: np.ndarray, margin: float) -> np.ndarray:
+        inside = (np.abs(x) > self.half_size - margin) | (np.abs(y) > self.half_size - margin)
+        if len(self.radii):
+            d2 = (x[:, None] - self.centers[None, :, 0]) ** 2 + (y[:, None] - self.centers[None, :, 1]) ** 2
+            inside |= (d2 < (self.radii[None, :] + margin) ** 2).any(axis=1)
+        return inside
+
+
+class RoverFleet():
+    """Kinematic skid-steer model for n vehicles, states in NED (x north, y east, yaw clockwise)"""
+
+    def __init__(self, n: int, world: World, timestep: float, max_speed: float = 2.0, track: float = 0.5,
+                 tau: float = 0.2, spacing: float = 4.0):
+        self.n = n
+        self.world = world
+        self.dt = timestep
+        self.max_speed = max_speed
+        self.track = track
+        self.tau = tau
+        # start on a grid along the west wall, facing north, away from obstacles
+        cols = max(1, int(math.ceil(math.sqrt(n))))
+        self.x = -world.half_size * 0.9 + spacing * (np.arange(n) // cols)
+        self.y = -world.half_size * 0.9 + spacing * (np.arange(n) % cols)
+        self.yaw = np.zeros(n)
+        self.v = np.zeros(n)
+        self.w = np.zeros(n)
+        self.accel_fwd = np.zeros(n)
+        self.time = np.zeros(n)
+        self.steps = np.zeros(n, dtype=np.int64)
+        keep = ~self._near_start(world.centers, spacing)
+        world.centers, world.radii = world.centers[keep], world.radii[keep]
+        self._fdm = np.zeros((n, 16))
+
+    def _near_start(self, centers, spacing):
+        d2 = (centers[:, None, 0] - self.x[None, :]) ** 2 + (centers[:, None, 1] - self.y[None, :]) ** 2
+        return (d2 < (spacing + 2.0) ** 2).any(axis=1)
+
+    def step(self, idx: np.ndarray, commands: np.ndarray):
+        """Advance vehicles idx by one timestep with servo outputs commands (k x 16, 0..1, -1 unset)"""
+        raw = np.where(commands == -1, 0.5, commands)
+        steer = raw[:, 0] * 2 - 1
+        throttle = raw[:, 2] * 2 - 1
+        # same mix as the Webots skid mixer: left = throttle + steer, right = throttle - steer
+        left = np.clip(throttle + steer, -1, 1) * self.max_speed
+        right = np.clip(throttle - steer, -1, 1) * self.max_speed
+        v_cmd = (left + right) / 2
+        w_cmd = (left - right) / self.track
+
+        alpha = min(1.0, self.dt / self.tau)
+        v_old = self.v[idx]
+        v = v_old + (v_cmd - v_old) * alpha
+        w = self.w[idx] + (w_cmd - self.w[idx]) * alpha
+        yaw = self.yaw[idx] + w * self.dt
+        x = self.x[idx] + v * np.cos(yaw) * self.dt
+        y = self.y[idx] + v * np.sin(yaw) * self.dt
+
+        # stop at walls and obstacles instead of driving through them
+        blocked = self.world.blocked(x, y, self.track / 2)
+        x = np.where(blocked, self.x[idx], x)
+        y = np.where(blocked, self.y[idx], y)
+        v = np.where(blocked, 0.0, v)
+
+        self.accel_fwd[idx] = (v - v_old) / self.dt
+        self.x[idx], self.y[idx], self.yaw[idx] = x, y, (yaw + math.pi) % (2 * math.pi) - math.pi
+        self.v[idx], self.w[idx] = v, w
+        self.time[idx] += self.dt
+        self.steps[idx] += 1
+
+    def fdm(self, idx: np.ndarray) -> np.ndarray:
+        """FDM rows for vehicles idx (same field order and frames as WebotsArduVehicle sends)"""
+        v, w, yaw = self.v[idx], self.w[idx], self.yaw[idx]
+        out = self._fdm[:len(idx)]
+        out[:, 0] = self.time[idx]
+        # gyro (body rates), accelerometer (specific force in body FRD), attitude rpy
+        out[:, 1:4] = 0
+        out[:, 3] = w
+        out[:, 4] = self.accel_fwd[idx]
+        out[:, 5] = v * w
+        out[:, 6] = -GRAVITY
+        out[:, 7:9] = 0
+        out[:, 9] = yaw
+        # velocity and position NED
+        out[:, 10] = v * np.cos(yaw)
+        out[:, 11] = v * np.sin(yaw)
+        out[:, 12] = 0
+        out[:, 13] = self.x[idx]
+        out[:, 14] = self.y[idx]
+        out[:, 15] = 0
+        return out
+
+
+class DistanceSender():
+    """DISTANCE_SENSOR per vehicle at a fixed sim-time rate (optional, needs pymavlink)"""
+
+    def __init__(self, base_port: int, rate: float, max_range: float):
+        from pymavlink import mavutil
+        self.mavutil = mavutil
+        self.base_port = base_port
+        self.period = 1.0 / rate
+        self.max_cm = int(max_range * 100)
+        self.links = {}
+        self.next_due = {}
+
+    def due(self, idx: np.ndarray, sim_time: np.ndarray) -> np.ndarray:
+        nxt = np.array([self.next_due.get(i, 0.0) for i in idx.tolist()])
+        return idx[sim_time >= nxt]
+
+    def send(self, i: int, address: str, sim_time: float, distance_m: float):
+        self.next_due[i] = sim_time + self.period
+        link = self.links.get(i)
+        if link is None:
+            link = self.links[i] = self.mavutil.mavlink_connection(
+                f"udpout:{address}:{self.base_port + 10 * i}", source_system=2, source_component=158)
+        current_cm = min(max(int(distance_m * 100), 2), self.max_cm)
+        link.mav.distance_sensor_send(int(sim_time * 1000) & 0xFFFFFFFF, 2, self.max_cm, current_cm,
+                                      self.mavutil.mavlink.MAV_DISTANCE_SENSOR_LASER, 0, 0, 0)
+
+
+def run_benchmark(fleet: RoverFleet, steps: int, max_range: float):
+    rng = np.random.default_rng(1)
+    idx = np.arange(fleet.n)
+    commands = np.full((fleet.n, 16), -1.0)
+    start = time.perf_counter()
+    for k in range(steps):
+        if k % 100 == 0:
+            commands[:, 0] = rng.uniform(0.3, 0.7, fleet.n)
+            commands[:, 2] = rng.uniform(0.4, 1.0, fleet.n)
+        fleet.step(idx, commands)
+        packets = fleet.fdm(idx).tobytes()
+        fleet.world.ranges(fleet.x, fleet.y, fleet.yaw, max_range)
+    elapsed = time.perf_counter() - start
+    sim = steps * fleet.dt
+    print(f"[kinematic] {fleet.n} vehicles x {steps} steps in {elapsed:.2f}s: "
+          f"{fleet.n * steps / elapsed:,.0f} vehicle-steps/s, {sim / elapsed:.1f}x real time per vehicle "
+          f"(packets {len(packets)} bytes/step)")
+
+
+def run(fleet: RoverFleet, args):
+    sel = selectors.DefaultSelector()
+    socks = []
+    for i in range(fleet.n):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("0.0.0.0", args.base_port + 10 * i))
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ, i)
+        socks.append(s)
+    print(f"[kinematic] {fleet.n} vehicles listening for SITL on UDP {args.base_port}..{args.base_port + 10 * (fleet.n - 1)} "
+          f"(step {fleet.dt * 1000:.0f} ms)")
+
+    distance = None
+    if args.distance_rate > 0:
+        try:
+            distance = DistanceSender(args.mavlink_port, args.distance_rate, args.max_range)
+        except ImportError:
+            print("[kinematic] pymavlink not installed, DISTANCE_SENSOR disabled")
+    sitl = [None] * fleet.n
+    commands = np.empty((fleet.n, 16))
+    last_report, last_steps, last_time = time.monotonic(), 0, 0.0
+
+    while True:
+        events = sel.select(timeout=1.0)
+        # one packet per vehicle per round, then step every vehicle that had one together
+        ready = []
+        for key, _ in events:
+            i = key.data
+            try:
+                data, addr = socks[i].recvfrom(512)
+            except BlockingIOError:
+                continue
+            if len(data) < controls_struct_size:
+                continue
+            if sitl[i] is None:
+                print(f"[kinematic] Connected to ardupilot SITL (I{i}) at {addr[0]}")
+            sitl[i] = addr[0]
+            commands[len(ready)] = np.frombuffer(data, np.float32, 16)
+            ready.append(i)
+
+        if ready:
+            idx = np.array(ready)
+            fleet.step(idx, commands[:len(ready)])
+            rows = fleet.fdm(idx)
+            for row, i in zip(rows, ready):
+                socks[i].sendto(row.tobytes(), (sitl[i], args.base_port + 10 * i + 1))
+            if distance is not None:
+                due = distance.due(idx, fleet.time[idx])
+                if len(due):
+                    ranges = fleet.world.ranges(fleet.x[due], fleet.y[due], fleet.yaw[due], args.max_range)
+                    for i, r in zip(due.tolist(), ranges.tolist()):
+                        distance.send(i, sitl[i], fleet.time[i], r)
+
+        now = time.monotonic()
+        if now - last_report >= args.stats_interval:
+            steps = int(fleet.steps.sum())
+            connected = sum(a is not None for a in sitl)
+            sim_time = float(fleet.time[[i for i, a in enumerate(sitl) if a]].mean()) if connected else 0.0
+            elapsed = now - last_report
+            print(f"[kinematic] {connected}/{fleet.n} connected | {(steps - last_steps) / elapsed:,.0f} steps/s | "
+                  f"{(sim_time - last_time) / elapsed:.1f}x real time")
+            last_report, last_steps, last_time = now, steps, sim_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kinematic skid-steer rover fleet for ArduPilot SITL (webots-python model)")
+    parser.add_argument("--vehicles", "-n", type=int, default=1, help="Number of vehicles (instances 0..n-1)")
+    parser.add_argument("--timestep", type=float, default=0.01, help="Physics step per servo packet in seconds")
+    parser.add_argument("--base-port", type=int, default=9002, help="Port of instance 0 (instance i uses +10*i)")
+    parser.add_argument("--max-speed", type=float, default=2.0, help="Wheel speed at full throttle in m/s")
+    parser.add_argument("--track", type=float, default=0.5, help="Distance between left and right wheels in m")
+    parser.add_argument("--arena", type=float, default=50.0, help="Half size of the square arena in m")
+    parser.add_argument("--obstacles", type=int, default=20, help="Number of round obstacles")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--distance-rate", type=float, default=10, help="DISTANCE_SENSOR rate (sim time Hz), 0 disables")
+    parser.add_argument("--max-range", type=float, default=10.0, help="Distance sensor range in m")
+    parser.add_argument("--mavlink-port", type=int, default=14551,
+                        help="DISTANCE_SENSOR goes to udpout:<sitl>:port+10*instance (webotsrf)")
+    parser.add_argument("--stats-interval", type=float, default=5.0)
+    parser.add_argument("--benchmark", type=int, default=0, metavar="STEPS",
+                        help="Run STEPS steps of all vehicles without SITL and report the speed")
+    args = parser.parse_args()
+
+    world = World(args.arena, args.obstacles, args.seed)
+    fleet = RoverFleet(args.vehicles, world, args.timestep, args.max_speed, args.track)
+    if args.benchmark:
+        run_benchmark(fleet, args.benchmark, args.max_range)
+    else:
+        try:
+            run(fleet, args)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()